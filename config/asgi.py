@@ -3,6 +3,10 @@ ASGI config for config project.
 
 It exposes the ASGI callable as a module-level variable named ``application``.
 
+Serve it with an ASGI server (e.g. ``uvicorn config.asgi:application``) so the
+streaming chat endpoint (``chat/<id>/stream/``) can push tokens to the browser
+without holding a worker thread for the whole agent run.
+
 For more information on this file, see
 https://docs.djangoproject.com/en/6.0/howto/deployment/asgi/
 """
@@ -14,3 +18,8 @@ from django.core.asgi import get_asgi_application
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'config.settings')
 
 application = get_asgi_application()
+
+# Health checks + model warm-up (see core.llm.warm_up_if_enabled)
+from core.llm import warm_up_if_enabled  # noqa: E402
+
+warm_up_if_enabled()
@@ -48,6 +48,8 @@ MIDDLEWARE = [
     'django.contrib.auth.middleware.AuthenticationMiddleware',
     'django.contrib.messages.middleware.MessageMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
+    # Per-request timing breakdown + /metrics counters (core.tracing)
+    'core.tracing.TracingMiddleware',
 ]
 
 ROOT_URLCONF = 'config.urls'
@@ -77,6 +79,13 @@ DATABASES = {
     'default': {
         'ENGINE': 'django.db.backends.sqlite3',
         'NAME': BASE_DIR / 'db.sqlite3',
+        'OPTIONS': {
+            # Take the write lock when a transaction starts and wait up to 20s
+            # for it, so concurrent writers queue instead of failing with
+            # "database is locked"
+            'transaction_mode': 'IMMEDIATE',
+            'timeout': 20,
+        },
     }
 }
 
@@ -129,7 +138,111 @@ LOGGING = {
     "disable_existing_loggers": False,
     "handlers": {"console": {"class": "logging.StreamHandler"}},
     "root": {"handlers": ["console"], "level": "INFO"},
+    # One JSON line per request/job with its timing breakdown,
+    # set to DEBUG to also log every span
+    "loggers": {"core.trace": {"level": "INFO"}},
+}
+
+# Audit log (see core.audit): chat messages, replies, tool calls and file
+# writes as batched JSON lines, written by a background thread.
+# COMPRESS: zstd compress the files (.jsonl.zst)
+# MAX_BYTES / ROTATE_SECONDS: start a new file after this size / age
+# KEEP_FILES: older files are deleted
+# QUEUE_SIZE: records waiting to be written, beyond that they are dropped
+# Query with `manage.py audit_log`
+AUDIT_LOG = {
+    "ENABLED": True,
+    "DIR": BASE_DIR / "appdata" / "audit",
+    "COMPRESS": False,
+    "BATCH_SIZE": 200,
+    "FLUSH_SECONDS": 1.0,
+    "MAX_BYTES": 64 * 1024 * 1024,
+    "ROTATE_SECONDS": 3600,
+    "KEEP_FILES": 48,
+    "QUEUE_SIZE": 10000,
 }
 
+# Who may scrape /metrics without a staff login
+METRICS_ALLOWED_IPS = ["127.0.0.1", "::1"]
+
 # Sandbox root 
-FILE_SANDBOX_ROOT = BASE_DIR / "appdata" / "users"
\ No newline at end of file
+FILE_SANDBOX_ROOT = BASE_DIR / "appdata" / "users"
+
+# Per-user sandbox limits (see core.quota), 0 = no limit
+SANDBOX_QUOTA = {
+    "MAX_BYTES": 200 * 1024 * 1024,
+    "MAX_FILES": 5000,
+}
+
+# How sandbox files are stored (see core.fs_local / core.fs_cas)
+# BACKEND "files": a plain folder per user under FILE_SANDBOX_ROOT
+# BACKEND "cas": files stored once by content hash in DIR (shared by all users),
+#   each user has a tree of manifests. Rewriting a file with the same content is a
+#   no-op, agent turns take snapshots that can be restored (nothing is copied).
+#   Unreferenced objects are deleted by `manage.py gc_sandbox_objects`.
+# COMPRESS: zstd compress objects up to COMPRESS_MAX_BYTES (bigger ones stay
+#   raw so range reads don't have to decompress the whole file)
+# KEEP_SNAPSHOTS: per user, older snapshots are deleted
+SANDBOX_STORAGE = {
+    "BACKEND": "files",
+    "DIR": BASE_DIR / "appdata" / "cas",
+    "COMPRESS": True,
+    "COMPRESS_MAX_BYTES": 1024 * 1024,
+    "KEEP_SNAPSHOTS": 50,
+}
+
+# Local LLM (Ollama)
+OLLAMA_BASE_URL = "http://127.0.0.1:11434"
+# llama3.2:3b is smaller/faster but wasn't able to list all the user's files,
+# llama3.1:8b is bigger/stronger but slower
+OLLAMA_MODEL = "llama3.1:8b"
+# Plain chat turns go to this smaller model, tool use / long prompts go to
+# OLLAMA_MODEL (see core.routing). Empty string = always use OLLAMA_MODEL.
+OLLAMA_SMALL_MODEL = "llama3.2:3b"
+# Prompts longer than this (estimated tokens) start on OLLAMA_MODEL
+ROUTING_LARGE_CONTEXT_TOKENS = 1200
+# Several Ollama servers: [{"name": "gpu1", "url": "http://10.0.0.5:11434"}, ...]
+# Empty = one server at OLLAMA_BASE_URL (see core.llm_pool)
+OLLAMA_BACKENDS = []
+# Seconds between health checks of the backends, run by the web server and the
+# job workers (0 = no background checks)
+OLLAMA_HEALTH_CHECK_SECONDS = 15
+# How long Ollama keeps a model in memory after a request
+OLLAMA_KEEP_ALIVE = "30m"
+# Models the health check reloads on a backend when Ollama has unloaded them
+OLLAMA_RESIDENT_MODELS = [OLLAMA_MODEL, OLLAMA_SMALL_MODEL]
+# Size of the keep-alive HTTP connection pool per model client
+OLLAMA_MAX_CONNECTIONS = 20
+# Load the model when the web server starts (see core.llm.warm_up_if_enabled)
+OLLAMA_WARM_UP_ON_STARTUP = True
+
+# Model response cache (see core.llm_cache)
+# SHARED_ALIAS: optional name of a Django cache in CACHES (e.g. file or DB based)
+# shared by all processes, on top of the in-process LRU
+LLM_CACHE = {
+    "ENABLED": True,
+    "MAX_ENTRIES": 512,
+    "TTL_SECONDS": 600,
+    "SHARED_ALIAS": None,
+}
+
+# Background agent turns
+# When True the chat view only queues the reply, run `manage.py run_agent_workers`
+# to process the queue. When False the chat page streams the reply from the
+# model instead (core.views.chat_stream).
+AGENT_JOBS_ENABLED = True
+
+# Admission control for agent runs (see core.admission), per process
+# MAX_CONCURRENT: agent loops talking to Ollama at once
+# MAX_PER_USER: of those, per user
+# MAX_QUEUE / MAX_QUEUE_PER_USER: requests waiting for a slot before we answer 429
+# MAX_WAIT_SECONDS: longest wait for a slot before answering 429
+# MAX_QUEUED_JOBS_PER_USER: with AGENT_JOBS_ENABLED, unfinished jobs per user
+ADMISSION = {
+    "MAX_CONCURRENT": 4,
+    "MAX_PER_USER": 1,
+    "MAX_QUEUE": 32,
+    "MAX_QUEUE_PER_USER": 2,
+    "MAX_WAIT_SECONDS": 30,
+    "MAX_QUEUED_JOBS_PER_USER": 3,
+}
@@ -17,7 +17,7 @@ Including another URLconf
 from django.contrib import admin
 from django.urls import path
 from django.contrib.auth import views as auth_views
-from core.views import home, signup, new_chat, chat, fs_list_api, fs_write_api, fs_read_api, fs_page
+from core.views import home, signup, new_chat, chat, chat_stream, chat_message_status, chat_history_api, chat_search_api, fs_list_api, fs_search_api, fs_usage_api, fs_snapshots_api, fs_restore_api, fs_write_api, fs_read_api, fs_download_api, fs_upload_api, fs_page, metrics
 
 
 urlpatterns = [
@@ -30,9 +30,24 @@ urlpatterns = [
     path("logout/", auth_views.LogoutView.as_view(), name="logout"),
     path("chat/new/", new_chat, name="new_chat"),
     path("chat/<int:conversation_id>/", chat, name="chat"),
+    path("chat/<int:conversation_id>/stream/", chat_stream, name="chat_stream"),
+    path(
+        "chat/<int:conversation_id>/messages/<int:message_id>/status/",
+        chat_message_status,
+        name="chat_message_status",
+    ),
+    path("api/chat/<int:conversation_id>/messages/", chat_history_api, name="chat_history_api"),
+    path("api/chat/search/", chat_search_api, name="chat_search_api"),
     path("api/fs/list/", fs_list_api, name="fs_list_api"),
+    path("api/fs/search/", fs_search_api, name="fs_search_api"),
+    path("api/fs/usage/", fs_usage_api, name="fs_usage_api"),
+    path("api/fs/snapshots/", fs_snapshots_api, name="fs_snapshots_api"),
+    path("api/fs/snapshots/restore/", fs_restore_api, name="fs_restore_api"),
     path("api/fs/write/", fs_write_api, name="fs_write_api"),
     path("api/fs/read/", fs_read_api, name="fs_read_api"),
+    path("api/fs/download/", fs_download_api, name="fs_download_api"),
+    path("api/fs/upload/", fs_upload_api, name="fs_upload_api"),
     path("fs/", fs_page, name="fs_page"),
+    path("metrics", metrics, name="metrics"),
 
 ]
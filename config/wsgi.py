@@ -14,3 +14,8 @@ from django.core.wsgi import get_wsgi_application
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'config.settings')
 
 application = get_wsgi_application()
+
+# Health checks + model warm-up (see core.llm.warm_up_if_enabled)
+from core.llm import warm_up_if_enabled  # noqa: E402
+
+warm_up_if_enabled()
@@ -1,13 +1,45 @@
 from django.contrib import admin
-from .models import Conversation, Message
+from .models import Conversation, Message, AgentJob, SandboxFile, SandboxSnapshot, SandboxUsage
+from .message_search import matching
 
 @admin.register(Conversation)
 class ConversationAdmin(admin.ModelAdmin):
-    list_display = ("id", "session_id", "owner", "created_at")
+    list_display = ("id", "title", "session_id", "owner", "message_count", "last_message_at", "created_at")
     search_fields = ("id", "session_id", "owner__username")
 
 @admin.register(Message)
 class MessageAdmin(admin.ModelAdmin):
-    list_display = ("id", "conversation", "role", "created_at")
-    search_fields = ("conversation__id", "content")
+    list_display = ("id", "conversation", "role", "status", "model", "created_at")
+    list_filter = ("role", "model")
+    # content is searched through the full-text index (core.message_search),
+    # not with a LIKE '%...%' scan of the whole table
+    search_fields = ("conversation__id",)
 
+    def get_search_results(self, request, queryset, search_term):
+        if not search_term:
+            return queryset, False
+        matches = matching(queryset, search_term)
+        if search_term.strip().isdigit():
+            # A number may also be a conversation id
+            matches = matches | queryset.filter(conversation__id=int(search_term))
+        return matches, False
+
+@admin.register(AgentJob)
+class AgentJobAdmin(admin.ModelAdmin):
+    list_display = ("id", "message", "status", "attempts", "lease_owner", "lease_expires_at", "created_at")
+    list_filter = ("status",)
+
+@admin.register(SandboxFile)
+class SandboxFileAdmin(admin.ModelAdmin):
+    list_display = ("id", "owner", "path", "size", "indexed_at")
+    search_fields = ("owner__username", "path")
+
+@admin.register(SandboxUsage)
+class SandboxUsageAdmin(admin.ModelAdmin):
+    list_display = ("owner", "bytes", "files", "reconciled_at")
+    search_fields = ("owner__username",)
+
+@admin.register(SandboxSnapshot)
+class SandboxSnapshotAdmin(admin.ModelAdmin):
+    list_display = ("id", "owner", "conversation", "label", "tree", "created_at")
+    search_fields = ("owner__username", "label")
@@ -0,0 +1,243 @@
+# Admission control for agent runs.
+#
+# Every generate_reply/astream_reply loop keeps Ollama busy for seconds. Without
+# a limit, a burst of users makes every request slow and some time out. Instead:
+#   - at most ADMISSION["MAX_CONCURRENT"] runs at once in this process,
+#     and at most MAX_PER_USER per user
+#   - extra requests wait in a bounded queue (MAX_QUEUE, MAX_QUEUE_PER_USER)
+#     for up to MAX_WAIT_SECONDS
+#   - a free slot goes to the waiting users in turn (round robin), so one user
+#     sending many messages can't starve the others
+#   - when the queue is full (or the wait runs out) the request is rejected
+#     right away with a Retry-After hint (HTTP 429)
+import asyncio
+import math
+import threading
+import time
+from collections import OrderedDict, deque
+from contextlib import contextmanager
+
+from django.conf import settings
+
+from .metrics import REGISTRY
+
+RUNNING = REGISTRY.gauge("admission_running", "Agent runs in progress.")
+WAITING = REGISTRY.gauge("admission_waiting", "Agent runs waiting for a slot.")
+WAIT_SECONDS = REGISTRY.histogram("admission_wait_seconds", "Time agent runs waited for a slot.")
+REJECTED = REGISTRY.counter("admission_rejected_total", "Agent runs turned away.", ("reason",))
+
+# Starting guess for how long one run takes (seconds), refined as runs finish
+INITIAL_RUN_SECONDS = 5.0
+
+
+class Overloaded(Exception):
+    # No slot available: the client should retry after `retry_after` seconds
+    def __init__(self, reason: str, retry_after: int):
+        super().__init__(f"too many concurrent requests ({reason})")
+        self.reason = reason
+        self.retry_after = retry_after
+
+
+class _Waiter:
+    def __init__(self, user_id: int, notify):
+        self.user_id = user_id
+        self.notify = notify
+        self.granted = False
+        self.enqueued_at = time.monotonic()
+
+
+class AdmissionController:
+    def __init__(
+        self,
+        max_concurrent: int,
+        max_per_user: int,
+        max_queue: int,
+        max_queue_per_user: int,
+        max_wait: float,
+    ):
+        self.max_concurrent = max_concurrent
+        self.max_per_user = max_per_user
+        self.max_queue = max_queue
+        self.max_queue_per_user = max_queue_per_user
+        self.max_wait = max_wait
+        self.running = 0
+        self.running_by_user = {}
+        # user_id -> deque of waiters, in round robin order
+        self.queues = OrderedDict()
+        self.waiting = 0
+        # Moving average of run time, for the Retry-After hint
+        self.avg_run_seconds = INITIAL_RUN_SECONDS
+        self._lock = threading.Lock()
+
+    # -- bookkeeping (call with the lock held) --
+
+    def _can_run(self, user_id: int) -> bool:
+        return self.running < self.max_concurrent and self.running_by_user.get(user_id, 0) < self.max_per_user
+
+    def _start(self, user_id: int) -> None:
+        self.running += 1
+        self.running_by_user[user_id] = self.running_by_user.get(user_id, 0) + 1
+
+    def _dispatch(self) -> None:
+        # Hand free slots to waiting users in turn
+        while self.running < self.max_concurrent and self.waiting:
+            for user_id in list(self.queues):
+                if self.running_by_user.get(user_id, 0) < self.max_per_user:
+                    queue = self.queues[user_id]
+                    waiter = queue.popleft()
+                    if queue:
+                        # This user had their turn: go to the back of the line
+                        self.queues.move_to_end(user_id)
+                    else:
+                        del self.queues[user_id]
+                    self.waiting -= 1
+                    waiter.granted = True
+                    self._start(user_id)
+                    waiter.notify()
+                    break
+            else:
+                # Everyone waiting is at their per-user limit
+                return
+
+    def retry_after(self) -> int:
+        # Rough time until a slot frees up for a new request
+        ahead = self.waiting + 1
+        return max(1, math.ceil(self.avg_run_seconds * ahead / max(1, self.max_concurrent)))
+
+    def _reject(self, reason: str) -> Overloaded:
+        REJECTED.inc(reason=reason)
+        return Overloaded(reason, self.retry_after())
+
+    def _enter(self, user_id: int, notify) -> _Waiter | None:
+        # Run now (None), queue (a waiter to wait on) or raise Overloaded
+        with self._lock:
+            # No barging: with others already waiting a newcomer queues too
+            if not self.waiting and self._can_run(user_id):
+                self._start(user_id)
+                WAIT_SECONDS.observe(0.0)
+                return None
+            if self.waiting >= self.max_queue:
+                raise self._reject("queue_full")
+            queue = self.queues.get(user_id)
+            if queue is not None and len(queue) >= self.max_queue_per_user:
+                raise self._reject("user_queue_full")
+            waiter = _Waiter(user_id, notify)
+            self.queues.setdefault(user_id, deque()).append(waiter)
+            self.waiting += 1
+            # A slot may be free for this user even though others are waiting
+            self._dispatch()
+            return waiter
+
+    def _give_up(self, waiter: _Waiter) -> bool:
+        # Wait timed out/cancelled: leave the queue. Returns True if the slot
+        # was granted in the meantime (then the caller owns it after all).
+        with self._lock:
+            if waiter.granted:
+                return True
+            queue = self.queues.get(waiter.user_id)
+            if queue is not None and waiter in queue:
+                queue.remove(waiter)
+                self.waiting -= 1
+                if not queue:
+                    del self.queues[waiter.user_id]
+            return False
+
+    def _leave(self, user_id: int, started: float) -> None:
+        with self._lock:
+            self.running -= 1
+            left = self.running_by_user.get(user_id, 1) - 1
+            if left:
+                self.running_by_user[user_id] = left
+            else:
+                self.running_by_user.pop(user_id, None)
+            self.avg_run_seconds = 0.8 * self.avg_run_seconds + 0.2 * (time.monotonic() - started)
+            self._dispatch()
+
+    # -- public API --
+
+    def acquire(self, user_id: int):
+        # Wait for a slot (blocking, for sync views and workers) or raise Overloaded.
+        # Returns a release() callable (idempotent).
+        event = threading.Event()
+        waiter = self._enter(user_id, event.set)
+        if waiter is not None:
+            if not event.wait(self.max_wait) and not self._give_up(waiter):
+                raise self._reject("wait_timeout")
+            WAIT_SECONDS.observe(time.monotonic() - waiter.enqueued_at)
+        return self._releaser(user_id)
+
+    @contextmanager
+    def slot(self, user_id: int):
+        release = self.acquire(user_id)
+        try:
+            yield
+        finally:
+            release()
+
+    async def aacquire(self, user_id: int):
+        # Async version of acquire(): waits on the event loop, not in a thread,
+        # so the slot can be held for as long as a streaming response runs
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+
+        def notify():
+            loop.call_soon_threadsafe(lambda: future.done() or future.set_result(None))
+
+        waiter = self._enter(user_id, notify)
+        if waiter is not None:
+            try:
+                await asyncio.wait_for(future, self.max_wait)
+            except (asyncio.TimeoutError, asyncio.CancelledError) as exc:
+                granted = self._give_up(waiter)
+                if isinstance(exc, asyncio.CancelledError):
+                    if granted:
+                        # Granted just as the client went away: give the slot back
+                        self._leave(user_id, time.monotonic())
+                    raise
+                if not granted:
+                    raise self._reject("wait_timeout")
+            WAIT_SECONDS.observe(time.monotonic() - waiter.enqueued_at)
+        return self._releaser(user_id)
+
+    def _releaser(self, user_id: int):
+        started = time.monotonic()
+        released = []
+
+        def release():
+            if not released:
+                released.append(True)
+                self._leave(user_id, started)
+
+        return release
+
+    def collect_metrics(self) -> None:
+        RUNNING.set(self.running)
+        WAITING.set(self.waiting)
+
+
+_controller = None
+_controller_lock = threading.Lock()
+
+
+def get_controller() -> AdmissionController:
+    global _controller
+    if _controller is None:
+        with _controller_lock:
+            if _controller is None:
+                conf = settings.ADMISSION
+                _controller = AdmissionController(
+                    max_concurrent=conf.get("MAX_CONCURRENT", 4),
+                    max_per_user=conf.get("MAX_PER_USER", 1),
+                    max_queue=conf.get("MAX_QUEUE", 32),
+                    max_queue_per_user=conf.get("MAX_QUEUE_PER_USER", 2),
+                    max_wait=conf.get("MAX_WAIT_SECONDS", 30),
+                )
+    return _controller
+
+
+def _collect_admission_metrics() -> None:
+    if _controller is not None:
+        _controller.collect_metrics()
+
+
+REGISTRY.add_collector(_collect_admission_metrics)
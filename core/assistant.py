@@ -1,123 +1,292 @@
-# Chat model client for local Ollama models
-from langchain_ollama import ChatOllama
+# Run sync helpers (ORM, file tools) from async code without blocking the event loop
+from asgiref.sync import sync_to_async
 
-# Message types used by LangChain chat models
-from langchain_core.messages import SystemMessage, HumanMessage, AIMessage, ToolMessage
-# Decorator to register normal Python functions as LLM-callable tools
-from langchain_core.tools import tool
+# Token-budgeted history (+ rolling summary of older turns)
+from .context import build_context, update_summary
 
-# Local file-system helper functions (our shared business logic layer)
-from .fs_local import list_tree, read_file, write_file
+# Shared (process-wide) LLM client and tool registry
+from .llm import get_llm_with_tools
+# Response cache for repeated identical requests
+from .llm_cache import acached_invoke, cache_key, cacheable, cached_invoke, get_response_cache
+# Small/large model choice per turn
+from .routing import Route, choose_route, escalation_reason
+from .tools import FILE_WRITING_TOOLS, run_tool_calls
+# Tool results sized to the room left in the prompt, repeated reads replaced
+from .tool_output import ToolRun
+# Turns that write files snapshot the sandbox first (cas storage backend only)
+from .fs_local import snapshot
+from .models import make_title
+# Tool calls/file writes are audited with the conversation id
+from .audit import audit_context
+# Timing spans / metrics (see core.tracing)
+from .tracing import record_agent_steps, record_llm_call, span
 
 # Permanent instruction for the assistant (always sent first)
 SYSTEM_PROMPT = (
     "You are a helpful assistant. "
     "When useful, use available tools to inspect or edit files before answering."
-    "If the user asks about files (list/read/write), you MUST call the relevant fs_* tool. "
+    "If the user asks about files (list/read/write/search), you MUST call the relevant fs_* tool. "
     "Do not guess."
 )
 
+# Max model calls per turn (each tool round trip is one more call)
+MAX_STEPS = 5
 
+# Returned when the model keeps asking for tools until MAX_STEPS runs out
+GAVE_UP_TEXT = "I couldn't finish tool use in time. Please try again."
 
+# Streamed when the model stream ended without a single chunk (even after escalating)
+EMPTY_REPLY_TEXT = "The model sent an empty reply. Please try again."
 
 
-def generate_reply(user_text: str, conversation) -> str:
-    # Create a local LLM client.
-    # model: model name in Ollama
-    # temperature: lower = more stable/deterministic output
-    # num_ctx: max context window (how much past text model can consider)
-    # num_predict: max tokens to generate for one model turn
-    llm = ChatOllama(
-        model="llama3.1:8b", #model="llama3.2:3b" - this model wasn't able to list all the users files # smaller/faster while model="llama3.1:8b" was bigger/stronger but slower
-        temperature=0.2,
-        num_ctx=2048,
-        num_predict=256,
-    )
-
-    # We bind tools to the current conversation owner only
-    # This prevents the assistant from reading/writing another user's files
-    user_id = conversation.owner_id
-
-    @tool
-    def fs_list(path: str = "") -> str:
-        """List files/folders in this user's sandbox at a relative path."""
-        return "\n".join(list_tree(user_id, path))
-
-    @tool
-    def fs_read(path: str) -> str:
-        """Read one text file from this user's sandbox."""
-        try:
-            return read_file(user_id, path)
-        except FileNotFoundError:
-            # Return a clean tool error string (instead of crashing the run)
-            return "ERROR: file not found"
-
-    @tool
-    def fs_write(path: str, content: str) -> str:
-        """Create or overwrite a text file in this user's sandbox."""
-        write_file(user_id, path, content)
-        return f"OK: wrote {path}"
-
-    # Register available tools and attach them to the model
-    tools = [fs_list, fs_read, fs_write]
-    llm_with_tools = llm.bind_tools(tools)
-
-    # Pull recent chat history from DB to provide context
-    # order_by("-created_at"): newest first, then we reverse for chat order
-    # [:10]: keep context small for speed and token usage
-    history = list(conversation.messages.order_by("-created_at")[:10])
-
-    # Chat models expect chronological order: oldest -> newest.
-    history.reverse()
-
-    # Build message list in the format the model expects
-    # System prompt first, then user/assistant history
-    msgs = [SystemMessage(content=SYSTEM_PROMPT)]
-
-    # Convert DB rows into LangChain message objects.
-    for m in history:
-        if m.role == "user":
-            msgs.append(HumanMessage(content=m.content))
+def _snapshot_before_writes(tool_calls: list, conversation, user_text: str) -> bool:
+    # Before the first tool call of a turn that changes files, save the sandbox
+    # so the whole turn can be rolled back. True once the turn has its snapshot.
+    if not any(call.get("name") in FILE_WRITING_TOOLS for call in tool_calls):
+        return False
+    snapshot(conversation.owner_id, label=make_title(user_text), conversation_id=conversation.id)
+    return True
+
+
+def summarize_history(conversation) -> None:
+    # Run once the reply is saved: history that won't fit the next prompt is
+    # folded into the conversation summary (an extra model call, kept out of the
+    # time to the reply)
+    update_summary(conversation, SYSTEM_PROMPT)
+
+
+class _Turn:
+    # One run of the agent loop: history, routing, tool results and the
+    # sandbox snapshot. generate_reply, agenerate_reply and astream_reply only
+    # differ in how they wait (sync, async, streamed); every step goes through here.
+
+    def __init__(self, user_text: str, conversation, msgs: list):
+        self.user_text = user_text
+        self.conversation = conversation
+        # Tools run scoped to the conversation owner only
+        # This prevents the assistant from reading/writing another user's files
+        self.user_id = conversation.owner_id
+        # Keeps the conversation on one Ollama backend (its KV cache has our prompt prefix)
+        self.affinity = str(conversation.session_id)
+        self.msgs = msgs
+        # Small model for plain chat, large model for tools / long prompts
+        # (model clients and tool schemas are built once per process, see core.llm)
+        self.route = choose_route(user_text, msgs)
+        self.tool_run = ToolRun(msgs)
+        self.snapshotted = False
+
+    @classmethod
+    def start(cls, user_text: str, conversation, before_message_id: int | None = None) -> "_Turn":
+        # System prompt + as much recent chat history as fits the context window
+        with span("context"):
+            msgs = build_context(conversation, SYSTEM_PROMPT, before_message_id)
+        return cls(user_text, conversation, msgs)
+
+    @classmethod
+    async def astart(cls, user_text: str, conversation, before_message_id: int | None = None) -> "_Turn":
+        # History comes from the ORM, which is sync only here
+        with span("context"):
+            msgs = await sync_to_async(build_context)(conversation, SYSTEM_PROMPT, before_message_id)
+        return cls(user_text, conversation, msgs)
+
+    def llm(self):
+        return get_llm_with_tools(self.route.model, self.affinity)
+
+    def escalation(self, resp, step: int) -> str | None:
+        # A small-model answer that needs tools (or is broken, or missing) is
+        # thrown away and the step redone on the large model: switch the route
+        # and return why (None = keep the answer)
+        if self.route.on_large:
+            return None
+        reason = escalation_reason(resp) if resp is not None else "empty_reply"
+        if reason:
+            self.route.escalate(reason, step)
+        return reason
+
+    def invoke_step(self, step: int):
+        # One model step on the routed model. Identical requests (same history +
+        # unchanged sandbox) come from the cache.
+        resp = cached_invoke(self.llm(), self.route.model, self.msgs, self.user_id)
+        if self.escalation(resp, step):
+            resp = cached_invoke(self.llm(), self.route.model, self.msgs, self.user_id)
+        return resp
+
+    async def ainvoke_step(self, step: int):
+        resp = await acached_invoke(self.llm(), self.route.model, self.msgs, self.user_id)
+        if self.escalation(resp, step):
+            resp = await acached_invoke(self.llm(), self.route.model, self.msgs, self.user_id)
+        return resp
+
+    async def astream_step(self, result: dict):
+        # Stream one model step: yields token events, leaves the merged response
+        # in result["resp"] (None if the model sent nothing)
+        model = self.route.model
+        cache = get_response_cache()
+        key = None
+        resp = None
+        if cache is not None:
+            key = await sync_to_async(cache_key)(model, self.msgs, self.user_id)
+            resp = await cache.aget(key)
+
+        if resp is not None:
+            # A cached answer is sent in one piece instead of streamed
+            with span("llm", model=model, stream=True) as attrs:
+                record_llm_call(attrs, model, resp, cached=True)
+            if resp.content:
+                yield {"type": "token", "text": str(resp.content)}
         else:
-            # Here, non-user role means assistant.
-            msgs.append(AIMessage(content=m.content))
-
-    # Agent loop:
-    # 1) Model responds
-    # 2) If it requests tools, run them
-    # 3) Feed tool output back to model
-    # 4) Repeat until model gives final text
-    max_steps = 5
-    for _ in range(max_steps):
-        # Ask model for the next step (text answer or tool call).
-        resp = llm_with_tools.invoke(msgs)
-        msgs.append(resp)
-
-        # If no tool calls are requested we are done so we will return model response
-        tool_calls = getattr(resp, "tool_calls", None) or []
+            # Stream the model output and merge the chunks into one message,
+            # tool calls only become complete once the whole response is in.
+            with span("llm", model=model, stream=True) as attrs:
+                async for chunk in self.llm().astream(self.msgs):
+                    resp = chunk if resp is None else resp + chunk
+                    if chunk.content:
+                        yield {"type": "token", "text": str(chunk.content)}
+                if resp is not None:
+                    record_llm_call(attrs, model, resp)
+            if key is not None and resp is not None and cacheable(resp):
+                await cache.aset(key, resp)
+
+        result["resp"] = resp
+
+    def add_response(self, resp) -> list:
+        # Keep the model's answer in the history; returns the tool calls it
+        # asks for (none = it is the final reply)
+        self.msgs.append(resp)
+        return getattr(resp, "tool_calls", None) or []
+
+    def _snapshot(self, tool_calls: list) -> None:
+        if not self.snapshotted:
+            self.snapshotted = _snapshot_before_writes(tool_calls, self.conversation, self.user_text)
+
+    def run_tools(self, tool_calls: list) -> list:
+        # Execute the requested tool calls (concurrently) and attach the
+        # results in the same order the model asked for them
+        self._snapshot(tool_calls)
+        with audit_context(conversation_id=self.conversation.id):
+            tool_msgs = run_tool_calls(tool_calls, self.user_id, self.tool_run)
+        return self._add_tool_results(tool_msgs)
+
+    async def arun_tools(self, tool_calls: list) -> list:
+        await sync_to_async(self._snapshot)(tool_calls)
+        # File tools block on disk I/O, run them (concurrently) off the event loop
+        with audit_context(conversation_id=self.conversation.id):
+            tool_msgs = await sync_to_async(run_tool_calls, thread_sensitive=False)(
+                tool_calls, self.user_id, self.tool_run
+            )
+        return self._add_tool_results(tool_msgs)
+
+    def _add_tool_results(self, tool_msgs: list) -> list:
+        self.msgs.extend(tool_msgs)
+        # Make room for the results by dropping the oldest history if needed
+        self.tool_run.fit()
+        return tool_msgs
+
+
+def generate_reply(
+    user_text: str,
+    conversation,
+    before_message_id: int | None = None,
+    route_info: dict | None = None,
+) -> str:
+    # route_info (optional): filled with the routing decision (Route.as_dict())
+    # so the caller can store it on the assistant message
+    turn = _Turn.start(user_text, conversation, before_message_id)
+    try:
+        # Agent loop:
+        # 1) Model responds
+        # 2) If it requests tools, run them
+        # 3) Feed tool output back to model
+        # 4) Repeat until model gives final text
+        for step in range(1, MAX_STEPS + 1):
+            resp = turn.invoke_step(step)
+            tool_calls = turn.add_response(resp)
+            if not tool_calls:
+                record_agent_steps(step)
+                return str(resp.content)
+            turn.run_tools(tool_calls)
+
+        # Safety stop so the loop cannot run forever
+        record_agent_steps(MAX_STEPS)
+        return GAVE_UP_TEXT
+    finally:
+        if route_info is not None:
+            route_info.update(turn.route.as_dict())
+
+
+async def agenerate_reply(
+    user_text: str,
+    conversation,
+    before_message_id: int | None = None,
+    route_info: dict | None = None,
+) -> str:
+    # Async version of generate_reply for async views: model calls are awaited
+    # (ainvoke), so a worker process can wait on many turns at once
+    turn = await _Turn.astart(user_text, conversation, before_message_id)
+    try:
+        for step in range(1, MAX_STEPS + 1):
+            resp = await turn.ainvoke_step(step)
+            tool_calls = turn.add_response(resp)
+            if not tool_calls:
+                record_agent_steps(step)
+                return str(resp.content)
+            await turn.arun_tools(tool_calls)
+
+        record_agent_steps(MAX_STEPS)
+        return GAVE_UP_TEXT
+    finally:
+        if route_info is not None:
+            route_info.update(turn.route.as_dict())
+
+
+async def astream_reply(user_text: str, conversation, before_message_id: int | None = None):
+    # Same agent loop as generate_reply, but as an async generator of events
+    # so the web layer can push tokens to the browser as they arrive:
+    #   {"type": "token", "text": ...}        piece of model output
+    #   {"type": "escalate", "model": ...}    step restarted on the large model
+    #   {"type": "tool_call", "name": ...}    model asked for a tool
+    #   {"type": "tool_result", "name": ...}  tool finished
+    #   {"type": "done", "text": ..., "routing": ...}  final reply
+    #   {"type": "error", "reason": "empty_reply", "text": ..., "routing": ...}
+    #                                         the model sent nothing, no reply to save
+    # The last event is always "done" or "error".
+    turn = await _Turn.astart(user_text, conversation, before_message_id)
+
+    for step in range(1, MAX_STEPS + 1):
+        result = {}
+        async for event in turn.astream_step(result):
+            yield event
+        resp = result["resp"]
+
+        reason = turn.escalation(resp, step)
+        if reason:
+            # Tokens already shown came from the small model, the page drops them
+            yield {"type": "escalate", "model": turn.route.model, "reason": reason}
+            result = {}
+            async for event in turn.astream_step(result):
+                yield event
+            resp = result["resp"]
+
+        if resp is None:
+            record_agent_steps(step)
+            yield {"type": "error", "reason": "empty_reply", "text": EMPTY_REPLY_TEXT, "routing": turn.route.as_dict()}
+            return
+
+        tool_calls = turn.add_response(resp)
         if not tool_calls:
-            return str(resp.content)
+            record_agent_steps(step)
+            yield {"type": "done", "text": str(resp.content), "routing": turn.route.as_dict()}
+            return
 
-        # Execute each requested tool call and attach the result
         for call in tool_calls:
-            tool_name = call.get("name")
-            tool_args = call.get("args", {})
-            tool_id = call.get("id")
-
-            # Find the matching registered tool by name
-            selected_tool = next((t for t in tools if t.name == tool_name), None)
-            if selected_tool is None:
-                tool_output = f"ERROR: unknown tool '{tool_name}'"
-            else:
-                try:
-                    # Run tool with arguments provided by the model
-                    tool_output = selected_tool.invoke(tool_args)
-                except Exception as exc:
-                    # Keep loop alive even if one tool execution fails
-                    tool_output = f"ERROR: tool failed: {exc}"
-
-            # ToolMessage connects output to the exact tool call ID
-            msgs.append(ToolMessage(content=str(tool_output), tool_call_id=tool_id))
-
-    # Safety stop so the loop cannot run forever
-    return "I couldn't finish tool use in time. Please try again."
+            yield {"type": "tool_call", "name": call.get("name"), "args": call.get("args", {})}
+        tool_msgs = await turn.arun_tools(tool_calls)
+        for call, tool_msg in zip(tool_calls, tool_msgs):
+            yield {
+                "type": "tool_result",
+                "name": call.get("name"),
+                "ok": not str(tool_msg.content).startswith("ERROR"),
+            }
+
+    record_agent_steps(MAX_STEPS)
+    yield {"type": "done", "text": GAVE_UP_TEXT, "routing": turn.route.as_dict()}
@@ -0,0 +1,261 @@
+# Structured audit log.
+#
+# Who sent which message, which tools ran, which files were written, as one
+# JSON object per line:
+#   {"ts": "2026-10-18T07:54:41.869Z", "event": "chat_message", "user_id": 3, "conversation_id": 12, ...}
+#
+# audit() never blocks the request: it puts the record on a bounded in-memory
+# queue and a background thread writes the records in batches (one write per
+# batch, optionally zstd compressed) to files in AUDIT_LOG["DIR"]. Files rotate
+# by size and age, the oldest are deleted. If the sink can't keep up and the
+# queue is full, records are dropped and counted (audit_dropped_total) rather
+# than slowing requests down.
+#
+# Query the files with `manage.py audit_log` (by user, conversation, event, time).
+import atexit
+import contextvars
+import json
+import logging
+import os
+import queue
+import threading
+import time
+from contextlib import contextmanager
+from datetime import datetime, timezone
+from pathlib import Path
+
+from django.conf import settings
+
+from .metrics import REGISTRY
+from .tracing import current_trace
+
+logger = logging.getLogger(__name__)
+
+RECORDS = REGISTRY.counter("audit_records_total", "Audit records written.")
+DROPPED = REGISTRY.counter("audit_dropped_total", "Audit records dropped (queue full or write error).")
+QUEUED = REGISTRY.gauge("audit_queue_size", "Audit records waiting to be written.")
+
+FILE_PREFIX = "audit-"
+# Start time (UTC) in the file name, so queries can skip files by time range
+FILE_TIME_FORMAT = "%Y%m%dT%H%M%S"
+
+# Extra fields added to every record inside audit_context() (e.g. conversation_id)
+_context = contextvars.ContextVar("audit_context", default={})
+
+
+@contextmanager
+def audit_context(**fields):
+    # Records made inside the block (also from tool threads started in it) get these fields
+    token = _context.set({**_context.get(), **fields})
+    try:
+        yield
+    finally:
+        _context.reset(token)
+
+
+def _timestamp(now: float) -> str:
+    return datetime.fromtimestamp(now, timezone.utc).isoformat(timespec="milliseconds").replace("+00:00", "Z")
+
+
+def parse_file_start(name: str) -> datetime | None:
+    # audit-20261018T075441-1234-0001.jsonl[.zst] -> its start time
+    try:
+        stamp = name[len(FILE_PREFIX) :].split("-", 1)[0]
+        return datetime.strptime(stamp, FILE_TIME_FORMAT).replace(tzinfo=timezone.utc)
+    except ValueError:
+        return None
+
+
+def log_files(directory: Path) -> list[Path]:
+    # Oldest first
+    if not directory.is_dir():
+        return []
+    files = [p for p in directory.iterdir() if p.name.startswith(FILE_PREFIX) and parse_file_start(p.name)]
+    return sorted(files, key=lambda p: p.name)
+
+
+class _Flush:
+    # Queue marker: the writer sets `done` once everything before it is on disk
+    def __init__(self):
+        self.done = threading.Event()
+
+
+class AuditWriter:
+    def __init__(
+        self,
+        directory: Path,
+        compress: bool = False,
+        batch_size: int = 200,
+        flush_seconds: float = 1.0,
+        max_bytes: int = 64 * 1024 * 1024,
+        rotate_seconds: float = 3600,
+        keep_files: int = 48,
+        queue_size: int = 10000,
+    ):
+        self.directory = Path(directory)
+        self.compress = compress
+        self.batch_size = batch_size
+        self.flush_seconds = flush_seconds
+        self.max_bytes = max_bytes
+        self.rotate_seconds = rotate_seconds
+        self.keep_files = keep_files
+        self.queue = queue.Queue(maxsize=queue_size)
+        self._thread = None
+        self._start_lock = threading.Lock()
+        # Current file (only touched by the writer thread)
+        self._file = None
+        self._file_bytes = 0
+        self._file_opened = 0.0
+        self._file_seq = 0
+        self._compressor = None
+        if compress:
+            import zstandard
+
+            self._compressor = zstandard.ZstdCompressor(level=3)
+
+    def submit(self, record: dict) -> None:
+        self._ensure_started()
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            DROPPED.inc()
+
+    def flush(self, timeout: float = 5.0) -> bool:
+        # Wait until everything submitted so far is written (for commands/tests)
+        if self._thread is None:
+            return True
+        marker = _Flush()
+        try:
+            self.queue.put(marker, timeout=timeout)
+        except queue.Full:
+            return False
+        return marker.done.wait(timeout)
+
+    def _ensure_started(self) -> None:
+        if self._thread is None:
+            with self._start_lock:
+                if self._thread is None:
+                    thread = threading.Thread(target=self._run, name="audit-writer", daemon=True)
+                    thread.start()
+                    self._thread = thread
+
+    def _run(self) -> None:
+        while True:
+            # Wait for a first record, then collect more for up to flush_seconds
+            batch = [self.queue.get()]
+            deadline = time.monotonic() + self.flush_seconds
+            while len(batch) < self.batch_size and not isinstance(batch[-1], _Flush):
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(self.queue.get(timeout=remaining))
+                except queue.Empty:
+                    break
+
+            records = [r for r in batch if not isinstance(r, _Flush)]
+            if records:
+                try:
+                    self._write(records)
+                except Exception:
+                    DROPPED.inc(len(records))
+                    logger.exception("audit_write_failed records=%s", len(records))
+            for marker in batch:
+                if isinstance(marker, _Flush):
+                    marker.done.set()
+
+    def _write(self, records: list[dict]) -> None:
+        data = "".join(json.dumps(r, separators=(",", ":"), default=str) + "\n" for r in records).encode("utf-8")
+        if self._compressor is not None:
+            # One zstd frame per batch, readers decode the frames back to back
+            data = self._compressor.compress(data)
+        self._rotate_if_needed()
+        self._file.write(data)
+        self._file.flush()
+        self._file_bytes += len(data)
+        RECORDS.inc(len(records))
+
+    def _rotate_if_needed(self) -> None:
+        now = time.time()
+        if (
+            self._file is not None
+            and self._file_bytes < self.max_bytes
+            and now - self._file_opened < self.rotate_seconds
+        ):
+            return
+        if self._file is not None:
+            self._file.close()
+        self.directory.mkdir(parents=True, exist_ok=True)
+        # pid in the name: every process (web, workers) writes its own files,
+        # plus a sequence number for files started within the same second
+        stamp = datetime.fromtimestamp(now, timezone.utc).strftime(FILE_TIME_FORMAT)
+        suffix = ".jsonl.zst" if self._compressor is not None else ".jsonl"
+        self._file_seq += 1
+        path = self.directory / f"{FILE_PREFIX}{stamp}-{os.getpid()}-{self._file_seq:04d}{suffix}"
+        self._file = path.open("ab")
+        self._file_bytes = 0
+        self._file_opened = now
+        self._delete_old_files(keep=path)
+
+    def _delete_old_files(self, keep: Path) -> None:
+        files = [p for p in log_files(self.directory) if p != keep]
+        for old in files[: max(0, len(files) + 1 - self.keep_files)]:
+            old.unlink(missing_ok=True)
+
+    def collect_metrics(self) -> None:
+        QUEUED.set(self.queue.qsize())
+
+
+_writer = None
+_writer_lock = threading.Lock()
+
+
+def get_writer() -> AuditWriter | None:
+    # None when AUDIT_LOG["ENABLED"] is off
+    global _writer
+    conf = getattr(settings, "AUDIT_LOG", {})
+    if not conf.get("ENABLED", False):
+        return None
+    if _writer is None:
+        with _writer_lock:
+            if _writer is None:
+                _writer = AuditWriter(
+                    directory=conf["DIR"],
+                    compress=conf.get("COMPRESS", False),
+                    batch_size=conf.get("BATCH_SIZE", 200),
+                    flush_seconds=conf.get("FLUSH_SECONDS", 1.0),
+                    max_bytes=conf.get("MAX_BYTES", 64 * 1024 * 1024),
+                    rotate_seconds=conf.get("ROTATE_SECONDS", 3600),
+                    keep_files=conf.get("KEEP_FILES", 48),
+                    queue_size=conf.get("QUEUE_SIZE", 10000),
+                )
+    return _writer
+
+
+def audit(event: str, **fields) -> None:
+    # Record one audit event (returns at once, the write happens in the background)
+    writer = get_writer()
+    if writer is None:
+        return
+    record = {"ts": _timestamp(time.time()), "event": event, **_context.get(), **fields}
+    trace = current_trace()
+    if trace is not None:
+        # Ties the event to its request/job line in the trace log
+        record["trace_id"] = trace.trace_id
+    writer.submit(record)
+
+
+def flush(timeout: float = 5.0) -> bool:
+    writer = _writer
+    return writer.flush(timeout) if writer is not None else True
+
+
+def _collect_audit_metrics() -> None:
+    if _writer is not None:
+        _writer.collect_metrics()
+
+
+REGISTRY.add_collector(_collect_audit_metrics)
+
+# Write what's still queued when the process exits normally
+atexit.register(flush)
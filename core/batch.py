@@ -0,0 +1,358 @@
+# Offline agent runs over JSONL files (`manage.py run_batch`).
+#
+# Evaluation and backfill jobs: every input line is one turn
+#   {"user": 3 | "alice", "prompt": "...", "conversation": 12 | "thread-a" | null, "id": ...}
+# conversation: an existing conversation id of that user, a name (records of
+# the user with the same name are one new conversation, run in file order) or
+# nothing (a new conversation per record). "id" is copied to the result as it is.
+#
+# Turns are saved like a chat turn in the web app (user message, generate_reply,
+# assistant message) and run on a thread or (spawned) process pool. Records of
+# the same conversation run one after the other, everything else in parallel.
+#
+# The output file doubles as the checkpoint: one JSON line per finished record,
+# written and flushed as soon as it's done. `--resume` reads it back and skips
+# the input lines already in there (and reuses the conversations of named
+# threads), so a killed run continues where it stopped.
+import json
+import logging
+import os
+import time
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, ThreadPoolExecutor, wait
+from multiprocessing import get_context
+
+from django.contrib.auth import get_user_model
+from django.db import close_old_connections
+
+from .assistant import generate_reply, summarize_history
+from .audit import audit
+from .batch_process import init_process
+from .models import Conversation
+from .stats import latency_summary
+from .tracing import start_trace
+
+logger = logging.getLogger(__name__)
+
+# Records read ahead of the workers, per worker
+READ_AHEAD = 2
+
+
+class BatchError(Exception):
+    # A record that can't run (bad JSON, unknown user, ...), reported in its result line
+    pass
+
+
+def read_records(path):
+    # (line number, record or BatchError) for every non-empty input line, streamed
+    with open(path, encoding="utf-8") as f:
+        for line_no, line in enumerate(f, start=1):
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                record = json.loads(line)
+            except ValueError as exc:
+                yield line_no, BatchError(f"invalid JSON: {exc}")
+                continue
+            if not isinstance(record, dict):
+                yield line_no, BatchError("record is not a JSON object")
+                continue
+            yield line_no, record
+
+
+def read_checkpoint(path, retry_errors: bool = False) -> tuple[set, dict]:
+    # From an earlier output file: (input lines already done, (user id, conversation name) -> id).
+    # A line cut off by a crash is ignored (its record runs again).
+    done = set()
+    conversations = {}
+    try:
+        f = open(path, encoding="utf-8")
+    except FileNotFoundError:
+        return done, conversations
+    with f:
+        for line in f:
+            try:
+                result = json.loads(line)
+            except ValueError:
+                continue
+            if not isinstance(result, dict) or "line" not in result:
+                continue
+            if isinstance(result.get("conversation"), str) and result.get("conversation_id"):
+                conversations[(result.get("user_id"), result["conversation"])] = result["conversation_id"]
+            if result.get("error") and retry_errors:
+                done.discard(result["line"])
+            else:
+                done.add(result["line"])
+    return done, conversations
+
+
+class UserResolver:
+    # "user" field -> user id, by id or username (looked up once each)
+
+    def __init__(self):
+        self._ids = {}
+
+    def __call__(self, value) -> int:
+        if value in self._ids:
+            return self._ids[value]
+        User = get_user_model()
+        if isinstance(value, int) and not isinstance(value, bool):
+            found = User.objects.filter(id=value).values_list("id", flat=True).first()
+        elif isinstance(value, str) and value:
+            found = User.objects.filter(username=value).values_list("id", flat=True).first()
+        else:
+            raise BatchError("missing or invalid 'user'")
+        if found is None:
+            raise BatchError(f"unknown user {value!r}")
+        self._ids[value] = found
+        return found
+
+
+def prepare(line_no: int, record, resolve_user) -> dict:
+    # Input record -> the task a worker runs (plain data, so it can go to another process)
+    if isinstance(record, BatchError):
+        raise record
+    prompt = record.get("prompt")
+    if not isinstance(prompt, str) or not prompt.strip():
+        raise BatchError("missing or empty 'prompt'")
+    conversation = record.get("conversation")
+    if conversation is not None and (isinstance(conversation, bool) or not isinstance(conversation, (int, str))):
+        raise BatchError("'conversation' must be an id, a name or null")
+    return {
+        "line": line_no,
+        "id": record.get("id"),
+        "user_id": resolve_user(record.get("user")),
+        "prompt": prompt.strip(),
+        "conversation": conversation,
+        # Filled in just before the task runs for named conversations
+        "conversation_id": conversation if isinstance(conversation, int) else None,
+    }
+
+
+def chain_key(task: dict):
+    # Tasks with the same key run one after the other (None: no ordering)
+    conversation = task["conversation"]
+    if conversation is None:
+        return None
+    if isinstance(conversation, int):
+        return ("id", conversation)
+    return ("name", task["user_id"], conversation)
+
+
+def error_result(line_no: int, record, exc: Exception) -> dict:
+    return {
+        "line": line_no,
+        "id": record.get("id") if isinstance(record, dict) else None,
+        "error": str(exc),
+    }
+
+
+def run_task(task: dict) -> dict:
+    # One turn, in a pool worker. Never raises: failures are in result["error"].
+    close_old_connections()
+    result = {
+        "line": task["line"],
+        "id": task["id"],
+        "user_id": task["user_id"],
+        "conversation": task["conversation"],
+        "conversation_id": task["conversation_id"],
+        "prompt": task["prompt"],
+        "reply": "",
+        "model": "",
+        "routing": {},
+        "error": "",
+    }
+    start = time.perf_counter()
+    try:
+        with start_trace("batch", line=task["line"], user_id=task["user_id"]):
+            if task["conversation_id"] is None:
+                conv = Conversation.objects.create(owner_id=task["user_id"])
+            else:
+                conv = Conversation.objects.filter(id=task["conversation_id"], owner_id=task["user_id"]).first()
+                if conv is None:
+                    raise BatchError(f"conversation {task['conversation_id']} not found for user {task['user_id']}")
+            result["conversation_id"] = conv.id
+
+            conv.add_message("user", task["prompt"])
+            route_info = {}
+            text = generate_reply(task["prompt"], conv, route_info=route_info)
+            conv.add_message("assistant", text, model=route_info.get("model", ""), routing=route_info)
+            summarize_history(conv)
+
+        result.update(reply=text, model=route_info.get("model", ""), routing=route_info)
+        audit(
+            "assistant_reply",
+            user_id=conv.owner_id,
+            conversation_id=conv.id,
+            session_id=str(conv.session_id),
+            reply_len=len(text),
+            model=route_info.get("model", ""),
+            batch_line=task["line"],
+        )
+    except Exception as exc:
+        if not isinstance(exc, BatchError):
+            logger.exception("batch_record_failed line=%s", task["line"])
+        result["error"] = str(exc) or type(exc).__name__
+    result["latency_ms"] = round((time.perf_counter() - start) * 1000, 2)
+    return result
+
+
+def make_pool(kind: str, workers: int):
+    if kind == "process":
+        # spawn, not fork: the parent already runs threads (audit writer, HTTP
+        # client pools) whose locks a forked child could inherit held
+        return ProcessPoolExecutor(workers, mp_context=get_context("spawn"), initializer=init_process)
+    return ThreadPoolExecutor(workers, thread_name_prefix="batch")
+
+
+class Stats:
+    # Throughput and latency of the records run by this invocation
+
+    def __init__(self, skipped: int = 0):
+        self.started = time.perf_counter()
+        self.latencies = []
+        self.ok = 0
+        self.errors = 0
+        self.skipped = skipped
+        self.models = {}
+
+    def add(self, result: dict) -> None:
+        if result.get("error"):
+            self.errors += 1
+        else:
+            self.ok += 1
+            model = result.get("model") or "?"
+            self.models[model] = self.models.get(model, 0) + 1
+        if "latency_ms" in result:
+            self.latencies.append(result["latency_ms"] / 1000)
+
+    def summary(self) -> dict:
+        wall = time.perf_counter() - self.started
+        return {
+            "records": self.ok + self.errors,
+            "ok": self.ok,
+            "errors": self.errors,
+            "skipped": self.skipped,
+            "wall_s": round(wall, 2),
+            "throughput_rps": round((self.ok + self.errors) / wall, 2) if wall else 0.0,
+            **latency_summary(self.latencies),
+            "models": self.models,
+        }
+
+
+def run_batch(
+    input_path,
+    output_path,
+    workers: int = 4,
+    pool: str = "thread",
+    resume: bool = False,
+    retry_errors: bool = False,
+    limit: int | None = None,
+    on_result=None,
+) -> dict:
+    # Run every record of input_path not yet in output_path, append the results
+    # to output_path; returns the stats. on_result(result, stats) after each record.
+    done, conversations = read_checkpoint(output_path, retry_errors) if resume else (set(), {})
+    stats = Stats(skipped=len(done))
+    resolve_user = UserResolver()
+
+    # Records waiting for an earlier record of the same conversation
+    waiting = {}
+    running_chains = set()
+    pending = {}
+    buffered = 0
+    max_buffered = max(1, workers) * READ_AHEAD
+    records = iter(read_records(input_path))
+    exhausted = False
+    stopping = False
+    taken = 0
+
+    with open(output_path, "a", encoding="utf-8") as out, make_pool(pool, workers) as executor:
+        if out.tell() > 0:
+            # Don't glue the first new result to a line cut off by a crash
+            with open(output_path, "rb") as f:
+                f.seek(-1, os.SEEK_END)
+                if f.read(1) != b"\n":
+                    out.write("\n")
+
+        def write(result: dict) -> None:
+            out.write(json.dumps(result, ensure_ascii=False, default=str) + "\n")
+            out.flush()
+            stats.add(result)
+            if on_result is not None:
+                on_result(result, stats)
+
+        def submit(task: dict) -> None:
+            key = chain_key(task)
+            if key is not None:
+                running_chains.add(key)
+                if key[0] == "name":
+                    task["conversation_id"] = conversations.get(key[1:])
+            pending[executor.submit(run_task, task)] = task
+
+        while True:
+            try:
+                # Keep the workers busy without reading the whole file into memory
+                while not (exhausted or stopping) and len(pending) < max_buffered and buffered < max_buffered:
+                    try:
+                        line_no, record = next(records)
+                    except StopIteration:
+                        exhausted = True
+                        break
+                    if line_no in done:
+                        continue
+                    if limit is not None and taken >= limit:
+                        exhausted = True
+                        break
+                    taken += 1
+                    try:
+                        task = prepare(line_no, record, resolve_user)
+                    except BatchError as exc:
+                        write(error_result(line_no, record, exc))
+                        continue
+                    key = chain_key(task)
+                    if key in running_chains:
+                        waiting.setdefault(key, deque()).append(task)
+                        buffered += 1
+                    else:
+                        submit(task)
+
+                if not pending:
+                    break
+
+                finished, _ = wait(pending, return_when=FIRST_COMPLETED)
+                for future in finished:
+                    task = pending.pop(future)
+                    try:
+                        result = future.result()
+                    except Exception as exc:
+                        # The worker process died (run_task itself doesn't raise)
+                        result = error_result(task["line"], task, exc)
+                    write(result)
+
+                    key = chain_key(task)
+                    if key is None:
+                        continue
+                    running_chains.discard(key)
+                    if key[0] == "name" and result.get("conversation_id"):
+                        conversations[key[1:]] = result["conversation_id"]
+                    queue = waiting.get(key)
+                    if queue:
+                        buffered -= 1
+                        next_task = queue.popleft()
+                        if not queue:
+                            del waiting[key]
+                        if not stopping:
+                            submit(next_task)
+            except KeyboardInterrupt:
+                # Finish (and write) the running records, then stop; --resume picks up the rest
+                if stopping:
+                    raise
+                stopping = True
+                waiting.clear()
+                logger.warning("batch_interrupted pending=%s", len(pending))
+
+    stats_dict = stats.summary()
+    stats_dict["interrupted"] = stopping
+    return stats_dict
@@ -0,0 +1,14 @@
+# Start-up of the `run_batch --pool process` workers (see core.batch).
+#
+# Kept out of core.batch on purpose: a spawned process unpickles the
+# initializer before Django is set up, and core.batch imports the models.
+import signal
+
+import django
+
+
+def init_process() -> None:
+    # A fresh interpreter (DJANGO_SETTINGS_MODULE comes with the environment)
+    # that leaves Ctrl-C to the parent, which finishes the running records
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    django.setup()
@@ -0,0 +1,175 @@
+# Stand-in for an Ollama server, for benchmarks.
+#
+# Speaks enough of the Ollama HTTP API (/api/chat streaming and non-streaming,
+# /api/generate model loading, /api/tags, /api/ps, /api/version) for ChatOllama to talk to it, with configurable
+# time-to-first-token, token rate, and scripted tool calls, so we can measure
+# our own overhead without a GPU in the loop.
+import json
+import threading
+import time
+from datetime import datetime, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+class FakeOllamaServer:
+    def __init__(
+        self,
+        host: str = "127.0.0.1",
+        port: int = 0,
+        latency: float = 0.05,
+        token_rate: float = 200.0,
+        reply_tokens: int = 40,
+        tool_calls: list[dict] | None = None,
+    ):
+        # latency: seconds before the first token
+        # token_rate: generated tokens per second (0 = no delay)
+        # reply_tokens: length of each text reply
+        # tool_calls: [{"name": ..., "args": {...}}] requested on the first model
+        #   call of each turn (when the last message is from the user); the
+        #   call after the tool results gets a text reply
+        self.latency = latency
+        self.token_rate = token_rate
+        self.reply_tokens = reply_tokens
+        self.tool_calls = tool_calls or []
+        self.requests = 0
+        # Models "loaded" by a chat or an empty /api/generate call (see /api/ps)
+        self.loaded = set()
+        self._lock = threading.Lock()
+
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def log_message(self, *args):
+                # Keep benchmark output clean
+                pass
+
+            def _send_json(self, data, status=200):
+                body = json.dumps(data).encode()
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def do_GET(self):
+                if self.path == "/api/tags":
+                    self._send_json({"models": [{"name": "fake", "model": "fake"}]})
+                elif self.path == "/api/ps":
+                    self._send_json({"models": [{"name": m, "model": m} for m in sorted(server.loaded)]})
+                elif self.path == "/api/version":
+                    self._send_json({"version": "0.0.0-fake"})
+                else:
+                    self._send_json({"error": "not found"}, status=404)
+
+            def do_HEAD(self):
+                self.send_response(200)
+                self.send_header("Content-Length", "0")
+                self.end_headers()
+
+            def do_POST(self):
+                length = int(self.headers.get("Content-Length") or 0)
+                payload = json.loads(self.rfile.read(length) or b"{}")
+                if self.path == "/api/generate" and not payload.get("prompt"):
+                    server.loaded.add(payload.get("model", "fake"))
+                    self._send_json({"model": payload.get("model", "fake"), "response": "", "done": True})
+                    return
+                if self.path != "/api/chat":
+                    self._send_json({"error": "not found"}, status=404)
+                    return
+                server._handle_chat(self, payload)
+
+        self._httpd = ThreadingHTTPServer((host, port), Handler)
+        self._httpd.daemon_threads = True
+        self._thread = None
+
+    @property
+    def base_url(self) -> str:
+        host, port = self._httpd.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def start(self) -> "FakeOllamaServer":
+        self._thread = threading.Thread(target=self._httpd.serve_forever, name="fake-ollama", daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self) -> None:
+        self._httpd.shutdown()
+        self._httpd.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+    def _plan(self, messages: list[dict]):
+        # Tool calls for a fresh user turn, text once tool results are in
+        last_role = messages[-1]["role"] if messages else "user"
+        if self.tool_calls and last_role == "user":
+            return [{"function": {"name": c["name"], "arguments": c.get("args", {})}} for c in self.tool_calls]
+        return None
+
+    def _handle_chat(self, handler, payload: dict) -> None:
+        with self._lock:
+            self.requests += 1
+            self.loaded.add(payload.get("model", "fake"))
+
+        messages = payload.get("messages") or []
+        model = payload.get("model", "fake")
+        stream = payload.get("stream", True)
+        tool_calls = self._plan(messages)
+        prompt_tokens = sum(len(str(m.get("content", "")).split()) for m in messages)
+        n_tokens = 0 if tool_calls else self.reply_tokens
+        per_token = 1.0 / self.token_rate if self.token_rate else 0.0
+
+        def chunk(content, done, **extra):
+            return {
+                "model": model,
+                "created_at": datetime.now(timezone.utc).isoformat(),
+                "message": {"role": "assistant", "content": content, **extra},
+                "done": done,
+            }
+
+        final = chunk("", True)
+        final.update(
+            {
+                "done_reason": "stop",
+                "prompt_eval_count": prompt_tokens,
+                "eval_count": max(n_tokens, 1),
+                "total_duration": 0,
+            }
+        )
+
+        time.sleep(self.latency)
+
+        if not stream:
+            time.sleep(per_token * n_tokens)
+            data = chunk(" ".join(["tok"] * n_tokens), True)
+            if tool_calls:
+                data["message"]["tool_calls"] = tool_calls
+            data.update({k: v for k, v in final.items() if k not in ("message", "done")})
+            handler._send_json(data)
+            return
+
+        # Newline-delimited JSON, sent with chunked transfer encoding
+        handler.send_response(200)
+        handler.send_header("Content-Type", "application/x-ndjson")
+        handler.send_header("Transfer-Encoding", "chunked")
+        handler.end_headers()
+
+        def send(obj):
+            line = (json.dumps(obj) + "\n").encode()
+            handler.wfile.write(f"{len(line):x}\r\n".encode() + line + b"\r\n")
+            handler.wfile.flush()
+
+        if tool_calls:
+            send(chunk("", False, tool_calls=tool_calls))
+        for i in range(n_tokens):
+            if per_token:
+                time.sleep(per_token)
+            send(chunk("tok" if i == 0 else " tok", False))
+        send(final)
+        handler.wfile.write(b"0\r\n\r\n")
+        handler.wfile.flush()
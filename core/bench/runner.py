@@ -0,0 +1,261 @@
+# Benchmark scenarios for the chat and file paths.
+#
+# Every scenario is a function that performs one request and returns how many
+# DB queries it made. run_load() calls it N times from C threads and reports
+# latency percentiles, throughput and query counts.
+#
+# bench_database() runs all of it against a throwaway database and sandbox
+# folder, never the real ones.
+import contextvars
+import shutil
+import tempfile
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from pathlib import Path
+
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.db import connection, connections
+from django.db.backends.signals import connection_created
+from django.test import Client, override_settings
+from django.test.utils import setup_databases, teardown_databases
+
+from core import admission, fs_cas, llm_cache
+from core.assistant import generate_reply
+from core.fs_local import user_root, write_file
+from core.llm import reset_clients
+from core.models import Conversation
+from core.stats import latency_summary
+
+
+def summarize(latencies: list[float], queries: list[int], errors: int, wall: float) -> dict:
+    return {
+        "requests": len(latencies) + errors,
+        "errors": errors,
+        **latency_summary(latencies),
+        "throughput_rps": round(len(latencies) / wall, 2) if wall else 0.0,
+        "queries_mean": round(sum(queries) / len(queries), 2) if queries else 0.0,
+        "queries_max": max(queries) if queries else 0,
+    }
+
+
+# Query count of the request running in this context. sync_to_async and the
+# tool pool copy the context into their threads, so their queries count too.
+_request_queries = contextvars.ContextVar("bench_request_queries", default=None)
+
+
+class QueryCounter:
+    # Counts the SQL run on every DB connection while active, whichever thread
+    # opened it: an execute wrapper goes on each connection as it's created
+    # (CaptureQueriesContext only sees the current thread's connection).
+
+    def __init__(self):
+        self.total = 0
+        self._lock = threading.Lock()
+        self._wrapped = []
+
+    def __call__(self, execute, sql, params, many, context):
+        counter = _request_queries.get()
+        with self._lock:
+            self.total += 1
+            if counter is not None:
+                counter[0] += 1
+        return execute(sql, params, many, context)
+
+    def _install(self, sender=None, connection=None, **kwargs):
+        # connection_created fires again on every reconnect of the same wrapper
+        with self._lock:
+            if self not in connection.execute_wrappers:
+                connection.execute_wrappers.append(self)
+                self._wrapped.append(connection)
+
+    def __enter__(self):
+        connection_created.connect(self._install)
+        for conn in connections.all(initialized_only=True):
+            if conn.connection is not None:
+                self._install(connection=conn)
+        return self
+
+    def __exit__(self, *exc):
+        connection_created.disconnect(self._install)
+        with self._lock:
+            for conn in self._wrapped:
+                if self in conn.execute_wrappers:
+                    conn.execute_wrappers.remove(self)
+            self._wrapped = []
+
+
+def run_load(fn, total: int, concurrency: int) -> dict:
+    latencies = []
+    queries = []
+    errors = []
+    lock = threading.Lock()
+
+    def one(i):
+        counter = [0]
+        token = _request_queries.set(counter)
+        start = time.perf_counter()
+        try:
+            fn(i)
+            elapsed = time.perf_counter() - start
+            with lock:
+                latencies.append(elapsed)
+                queries.append(counter[0])
+        except Exception as exc:
+            with lock:
+                errors.append(repr(exc))
+        finally:
+            _request_queries.reset(token)
+            # Worker threads each open their own DB connection
+            connection.close()
+
+    wall_start = time.perf_counter()
+    with QueryCounter() as counter, ThreadPoolExecutor(max_workers=concurrency) as pool:
+        list(pool.map(one, range(total)))
+    wall = time.perf_counter() - wall_start
+
+    result = summarize(latencies, queries, len(errors), wall)
+    # Everything, including queries no request context reached (should stay 0)
+    result["queries_total"] = counter.total
+    result["queries_unattributed"] = counter.total - sum(queries)
+    if errors:
+        result["first_error"] = errors[0]
+    return result
+
+
+@contextmanager
+def bench_database(verbosity: int = 0):
+    # A fresh, migrated database (created like the test runner does, test_<NAME>)
+    # and a temporary sandbox/CAS folder for the whole run; both are removed
+    # afterwards. The folders have to move with the database: user ids in the
+    # bench database are real users' ids in FILE_SANDBOX_ROOT.
+    tmp = Path(tempfile.mkdtemp(prefix="bench-"))
+    test_conf = connections["default"].settings_dict["TEST"]
+    old_test_name = test_conf.get("NAME")
+    if connections["default"].vendor == "sqlite" and not old_test_name:
+        # The default in-memory SQLite test database locks tables across threads
+        test_conf["NAME"] = str(tmp / "bench.sqlite3")
+    overrides = {
+        "FILE_SANDBOX_ROOT": tmp / "users",
+        "SANDBOX_STORAGE": {**settings.SANDBOX_STORAGE, "DIR": tmp / "cas"},
+        # Records would name users of the bench database
+        "AUDIT_LOG": {**getattr(settings, "AUDIT_LOG", {}), "ENABLED": False},
+    }
+    try:
+        with override_settings(**overrides):
+            fs_cas._store = None
+            old_config = setup_databases(verbosity, interactive=False, aliases={"default"})
+            try:
+                yield
+            finally:
+                teardown_databases(old_config, verbosity)
+                fs_cas._store = None
+    finally:
+        test_conf["NAME"] = old_test_name
+        shutil.rmtree(tmp, ignore_errors=True)
+
+
+@contextmanager
+def bench_environment(base_url: str, use_cache: bool = False):
+    # Point the app at the fake server and run chat turns inline (no job queue).
+    # Creates a throwaway user + sandbox and removes them afterwards.
+    overrides = {
+        "OLLAMA_BASE_URL": base_url,
+        "AGENT_JOBS_ENABLED": False,
+        "LLM_CACHE": {**settings.LLM_CACHE, "ENABLED": use_cache, "SHARED_ALIAS": None},
+        "ALLOWED_HOSTS": [*settings.ALLOWED_HOSTS, "testserver"],
+        # All bench clients are one user: don't let the per-user limits turn them away
+        "ADMISSION": {**settings.ADMISSION, "MAX_PER_USER": 1000, "MAX_QUEUE_PER_USER": 1000},
+    }
+    User = get_user_model()
+    with override_settings(**overrides):
+        reset_clients()
+        llm_cache._cache = None
+        admission._controller = None
+        user = User.objects.create_user(username=f"bench-{uuid.uuid4().hex[:12]}", password=None)
+        try:
+            yield user
+        finally:
+            shutil.rmtree(user_root(user.id), ignore_errors=True)
+            user.delete()
+            reset_clients()
+            llm_cache._cache = None
+            admission._controller = None
+
+
+def seed_sandbox(user, files: int) -> list[str]:
+    paths = []
+    for i in range(files):
+        path = f"dir{i % 10}/file{i}.txt"
+        write_file(user.id, path, f"benchmark file {i}\n" + "lorem ipsum dolor sit amet\n" * 20)
+        paths.append(path)
+    return paths
+
+
+class _Clients(threading.local):
+    # One logged-in test client per worker thread
+    def __init__(self):
+        self.client = None
+
+
+def client_factory(user):
+    local = _Clients()
+
+    def get():
+        if local.client is None:
+            local.client = Client()
+            local.client.force_login(user)
+        return local.client
+
+    return get
+
+
+def _check(response):
+    if response.status_code >= 400:
+        raise RuntimeError(f"HTTP {response.status_code}")
+    return response
+
+
+def scenarios(user, paths: list[str]) -> dict:
+    # name -> fn(i) performing one request
+    client = client_factory(user)
+    conv_ids = []
+    conv_lock = threading.Lock()
+
+    def chat_view(i):
+        c = client()
+        # Spread the requests over up to 8 conversations (called from many threads)
+        with conv_lock:
+            if len(conv_ids) <= i % 8:
+                conv_ids.append(Conversation.objects.create(owner=user).id)
+            conv_id = conv_ids[i % len(conv_ids)]
+        _check(c.post(f"/chat/{conv_id}/", {"message": f"list my files please ({i})"}))
+
+    def reply(i):
+        conv = Conversation.objects.create(owner=user)
+        conv.add_message("user", f"what files do I have? ({i})")
+        generate_reply("what files do I have?", conv)
+
+    def fs_list(i):
+        _check(client().get("/api/fs/list/", {"depth": 2, "limit": 100}))
+
+    def fs_read(i):
+        _check(client().post("/api/fs/read/", {"path": paths[i % len(paths)]}))
+
+    def fs_write(i):
+        _check(client().post("/api/fs/write/", {"path": f"bench/w{i % 20}.txt", "content": f"write {i}\n" * 50}))
+
+    def fs_search(i):
+        _check(client().get("/api/fs/search/", {"q": f"benchmark file{i % len(paths)}"}))
+
+    return {
+        "chat_view": chat_view,
+        "generate_reply": reply,
+        "fs_list": fs_list,
+        "fs_read": fs_read,
+        "fs_write": fs_write,
+        "fs_search": fs_search,
+    }
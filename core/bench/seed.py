@@ -0,0 +1,260 @@
+# Production-sized fake data for local indexing, pagination and benchmark work
+# (`manage.py seed_scale`).
+#
+# Users, conversations and messages are inserted with bulk_create in batched
+# transactions: one password hash shared by every user, conversation stats
+# (title, preview, message_count, last_message_at) computed up front instead of
+# updated per message, dates spread over the last `days` days. Lengths follow
+# skewed (log-normal) distributions like real chats: short questions, longer
+# replies with now and then a code block, a few very long conversations.
+#
+# Sandbox files go through fs_local.write_file, so the storage backend, the
+# search index and the quota counters stay consistent with what the app writes.
+import math
+import random
+import time
+from contextlib import contextmanager
+from datetime import timedelta
+
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.contrib.auth.hashers import make_password
+from django.db import transaction
+from django.utils import timezone
+
+from core.fs_local import FileTooLarge, write_file
+from core.models import Conversation, Message, make_preview, make_title
+from core.quota import QuotaExceeded
+
+WORDS = (
+    "the a to and of in is it that for you this with on be are can file how what not do have use "
+    "if from or as your list read write error data function code python django model user request "
+    "response test value return line folder path query index page message reply server config time "
+    "need make why when where which should could would please thanks help run check fix update change "
+    "add remove find search open save report notes draft plan summary budget meeting project task "
+    "version build deploy cache token context prompt result output input json csv table row column"
+).split()
+
+CODE_LINES = (
+    "def handler(request):",
+    "    items = load_items(path)",
+    "    for item in items:",
+    "        total += item.size",
+    "    return JsonResponse({'ok': True})",
+    "if not rows:",
+    "    raise ValueError('empty')",
+    "import os",
+    "print(result)",
+)
+
+# Log-normal lengths in words: (median, sigma)
+USER_WORDS = (14, 0.9)
+ASSISTANT_WORDS = (90, 0.8)
+# Share of assistant replies with a code block
+CODE_SHARE = 0.2
+# Seconds between a reply and the next user message / between a message and its reply
+THINK_SECONDS = (60, 1.2)
+REPLY_SECONDS = (6, 0.6)
+
+
+def lognormal(rng: random.Random, median: float, sigma: float) -> float:
+    return rng.lognormvariate(math.log(median), sigma)
+
+
+def count_with_mean(rng: random.Random, mean: float, sigma: float) -> int:
+    # Skewed whole count >= 1 with the given mean (sigma 0 = always the mean)
+    if mean <= 0:
+        return 0
+    if mean <= 1 or sigma <= 0:
+        return max(1, round(mean))
+    return max(1, round(rng.lognormvariate(math.log(mean) - sigma * sigma / 2, sigma)))
+
+
+def sentence_text(rng: random.Random, words: int) -> str:
+    chosen = rng.choices(WORDS, k=max(1, words))
+    # Break into sentences of ~12 words
+    out = []
+    for i in range(0, len(chosen), 12):
+        part = chosen[i : i + 12]
+        out.append(" ".join(part).capitalize() + ".")
+    return " ".join(out)
+
+
+def user_text(rng: random.Random) -> str:
+    text = sentence_text(rng, round(lognormal(rng, *USER_WORDS)))
+    return text[:-1] + "?" if rng.random() < 0.5 else text
+
+
+def assistant_text(rng: random.Random) -> str:
+    text = sentence_text(rng, round(lognormal(rng, *ASSISTANT_WORDS)))
+    if rng.random() < CODE_SHARE:
+        code = "\n".join(rng.choices(CODE_LINES, k=rng.randint(3, 12)))
+        text += f"\n\n```python\n{code}\n```\n"
+    return text
+
+
+@contextmanager
+def explicit_created_at(*models):
+    # auto_now_add would stamp every bulk_create row with now(): keep the
+    # generated dates instead while seeding
+    fields = [model._meta.get_field("created_at") for model in models]
+    for field in fields:
+        field.auto_now_add = False
+    try:
+        yield
+    finally:
+        for field in fields:
+            field.auto_now_add = True
+
+
+class Seeder:
+    # Generates and inserts the rows; counts what it created in `created`
+
+    def __init__(
+        self,
+        conversations: int,
+        messages: int,
+        spread: float = 0.6,
+        days: int = 365,
+        batch_size: int = 20000,
+        seed: int | None = None,
+        log=None,
+    ):
+        self.conversations = conversations
+        self.messages = messages
+        self.spread = spread
+        self.days = days
+        self.batch_size = max(1, batch_size)
+        self.rng = random.Random(seed)
+        self.log = log or (lambda msg: None)
+        self.now = timezone.now()
+        self.models = [m for m in (settings.OLLAMA_MODEL, getattr(settings, "OLLAMA_SMALL_MODEL", "")) if m]
+        self.created = {"users": 0, "conversations": 0, "messages": 0, "files": 0, "bytes": 0}
+        # Conversations (with their messages) waiting for the next batch insert
+        self._convs = []
+        self._msgs = []
+
+    # Users
+
+    def create_users(self, prefix: str, count: int, password: str) -> list[int]:
+        # New users prefix000000..; names that already exist are skipped.
+        # Returns the ids of the users created.
+        User = get_user_model()
+        names = [f"{prefix}{i:06d}" for i in range(count)]
+        # One hash for everyone: hashing is ~100 ms per call by design
+        password_hash = make_password(password)
+
+        ids = []
+        for start in range(0, len(names), self.batch_size):
+            chunk = names[start : start + self.batch_size]
+            existing = set(User.objects.filter(username__in=chunk).values_list("username", flat=True))
+            users = [
+                User(username=name, password=password_hash, date_joined=self._past(self.days))
+                for name in chunk
+                if name not in existing
+            ]
+            with transaction.atomic():
+                User.objects.bulk_create(users, batch_size=1000)
+            ids.extend(user.pk for user in users)
+            self.created["users"] += len(users)
+            self.log(f"users: {self.created['users']}")
+        return ids
+
+    # Conversations and messages
+
+    def create_conversations(self, user_ids: list[int]) -> None:
+        for user_id in user_ids:
+            for _ in range(count_with_mean(self.rng, self.conversations, self.spread)):
+                self._add_conversation(user_id)
+                if len(self._msgs) >= self.batch_size:
+                    self.flush()
+        self.flush()
+
+    def _add_conversation(self, user_id: int) -> None:
+        n = count_with_mean(self.rng, self.messages, self.spread)
+        at = self._past(self.days)
+        conv = Conversation(owner_id=user_id, created_at=at)
+        msgs = []
+        for i in range(n):
+            if i % 2 == 0:
+                if i:
+                    at += timedelta(seconds=lognormal(self.rng, *THINK_SECONDS))
+                msgs.append(Message(role="user", content=user_text(self.rng), created_at=min(at, self.now)))
+            else:
+                at += timedelta(seconds=lognormal(self.rng, *REPLY_SECONDS))
+                msgs.append(
+                    Message(
+                        role="assistant",
+                        content=assistant_text(self.rng),
+                        created_at=min(at, self.now),
+                        model=self.rng.choice(self.models) if self.models else "",
+                    )
+                )
+        # What add_message would have left on the row
+        conv.title = make_title(msgs[0].content)
+        conv.preview = make_preview(msgs[-1].content)
+        conv.message_count = len(msgs)
+        conv.last_message_at = msgs[-1].created_at
+        self._convs.append((conv, msgs))
+        self._msgs.extend(msgs)
+
+    def flush(self) -> None:
+        if not self._convs:
+            return
+        with explicit_created_at(Conversation, Message), transaction.atomic():
+            convs = Conversation.objects.bulk_create([conv for conv, _ in self._convs], batch_size=1000)
+            for conv, (_, msgs) in zip(convs, self._convs):
+                for msg in msgs:
+                    msg.conversation_id = conv.id
+            Message.objects.bulk_create(self._msgs, batch_size=1000)
+        self.created["conversations"] += len(self._convs)
+        self.created["messages"] += len(self._msgs)
+        self._convs = []
+        self._msgs = []
+        self.log(f"conversations: {self.created['conversations']}, messages: {self.created['messages']}")
+
+    # Sandboxes
+
+    def create_sandbox(self, user_id: int, files: int, depth: int, fanout: int, file_bytes: int) -> None:
+        # `files` text files (log-normal sizes around file_bytes) in folders up to
+        # `depth` levels deep with `fanout` subfolders per folder
+        dirs = [""]
+        level = [""]
+        for _ in range(depth):
+            level = [f"{parent}{self._word()}_{i}/" for parent in level for i in range(fanout)]
+            dirs.extend(level)
+
+        # No transaction around the loop: each write_file already keeps its file,
+        # index row and quota in step, and a rollback here couldn't undo the disk
+        for i in range(files):
+            path = f"{self.rng.choice(dirs)}{self._word()}_{i}.{self.rng.choice(('txt', 'md', 'py', 'csv', 'log'))}"
+            content = self._file_text(max(1, round(lognormal(self.rng, file_bytes, 1.0))))
+            try:
+                write_file(user_id, path, content)
+            except (QuotaExceeded, FileTooLarge) as exc:
+                self.log(f"user {user_id}: stopped after {i} files ({exc})")
+                break
+            self.created["files"] += 1
+            self.created["bytes"] += len(content)
+
+    def _file_text(self, size: int) -> str:
+        lines = []
+        total = 0
+        while total < size:
+            line = sentence_text(self.rng, self.rng.randint(4, 16))
+            lines.append(line)
+            total += len(line) + 1
+        return "\n".join(lines)[:size]
+
+    # Helpers
+
+    def _word(self) -> str:
+        return self.rng.choice(WORDS)
+
+    def _past(self, days: int):
+        return self.now - timedelta(seconds=self.rng.uniform(0, days * 86400))
+
+
+def rate(count: int, started: float) -> str:
+    elapsed = time.perf_counter() - started
+    return f"{count} in {elapsed:.1f} s ({count / elapsed:.0f}/s)" if elapsed > 0 else str(count)
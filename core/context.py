@@ -0,0 +1,249 @@
+# Token-budgeted prompt building.
+#
+# The model only sees num_ctx tokens. Instead of "last 10 messages" we count
+# tokens and pack as much recent history as fits, newest first. Turns that no
+# longer fit are folded into a rolling summary stored on the Conversation,
+# which is extended in batches after a reply (not recomputed every turn).
+import json
+import logging
+from functools import lru_cache
+
+from langchain_core.messages import AIMessage, HumanMessage, SystemMessage
+from langchain_core.utils.function_calling import convert_to_openai_tool
+
+from .llm import LLM_OPTIONS, get_llm
+from .tracing import record_llm_call, span
+
+logger = logging.getLogger(__name__)
+
+# tiktoken encoding used to estimate token counts. It's not the llama tokenizer,
+# but it is close enough for budgeting (we keep a safety margin below).
+TOKEN_ENCODING = "cl100k_base"
+
+# Extra tokens per chat message for role markers/separators
+MESSAGE_OVERHEAD_TOKENS = 4
+
+# Tokens kept free for estimation error between tiktoken and the real tokenizer
+SAFETY_MARGIN_TOKENS = 128
+
+# Rolling summary limits
+SUMMARY_MAX_TOKENS = 200
+# Only call the summarizer once this many tokens of history fell out of the window
+SUMMARY_BATCH_TOKENS = 400
+# Max tokens of old messages sent to the summarizer in one go
+SUMMARY_INPUT_TOKENS = 1200
+
+SUMMARY_PROMPT = (
+    "You maintain a short running summary of a chat between a user and an assistant. "
+    "Update the summary with the new messages. Keep facts, file names, decisions and open "
+    "questions. Reply with the updated summary only, in at most 120 words."
+)
+
+
+@lru_cache(maxsize=1)
+def _encoding():
+    try:
+        import tiktoken
+
+        return tiktoken.get_encoding(TOKEN_ENCODING)
+    except Exception as exc:
+        # tiktoken downloads its encoding files on first use: without network
+        # access we fall back to a character-based estimate
+        logger.warning("tiktoken unavailable (%s), estimating tokens from length", exc)
+        return None
+
+
+def count_tokens(text: str) -> int:
+    enc = _encoding()
+    if enc is None:
+        return len(text) // 4 + 1
+    return len(enc.encode(text, disallowed_special=()))
+
+
+def message_tokens(content: str) -> int:
+    return count_tokens(content) + MESSAGE_OVERHEAD_TOKENS
+
+
+def truncate_to_tokens(text: str, max_tokens: int) -> str:
+    # Keep the start of the text, cut the rest
+    if max_tokens <= 0:
+        return ""
+    enc = _encoding()
+    if enc is None:
+        return text[: max_tokens * 4]
+    tokens = enc.encode(text, disallowed_special=())
+    if len(tokens) <= max_tokens:
+        return text
+    return enc.decode(tokens[:max_tokens])
+
+
+@lru_cache(maxsize=1)
+def tool_schema_tokens() -> int:
+    # The tool definitions are sent with every request, so they use context too
+    from .tools import TOOLS
+
+    return count_tokens(json.dumps([convert_to_openai_tool(t) for t in TOOLS]))
+
+
+def prompt_limit() -> int:
+    # Tokens the messages of one request may use
+    return LLM_OPTIONS["num_ctx"] - LLM_OPTIONS["num_predict"] - SAFETY_MARGIN_TOKENS - tool_schema_tokens()
+
+
+def history_budget(system_prompt: str, summary: str = "") -> int:
+    # Tokens left for chat history after everything else the request contains
+    budget = prompt_limit() - message_tokens(system_prompt)
+    if summary:
+        budget -= message_tokens(summary)
+    return max(budget, 0)
+
+
+def prompt_tokens(msgs: list) -> int:
+    # Estimated tokens of LangChain messages, including the tool calls the model made
+    total = 0
+    for m in msgs:
+        total += message_tokens(str(m.content))
+        if getattr(m, "tool_calls", None):
+            total += count_tokens(json.dumps(m.tool_calls, default=str))
+    return total
+
+
+def fit_prompt(msgs: list, turn_start: int) -> int:
+    # Tool results make the prompt grow during a turn. Drop the oldest history
+    # messages (never the system prompt/summary or msgs[turn_start:], the current
+    # turn) until it fits again, so the model server doesn't cut the start of
+    # the prompt itself. Changes msgs in place, returns the new turn_start.
+    total = prompt_tokens(msgs)
+    first = 0
+    while first < len(msgs) and msgs[first].type == "system":
+        first += 1
+    while total > prompt_limit() and first < turn_start:
+        total -= prompt_tokens([msgs.pop(first)])
+        turn_start -= 1
+    return turn_start
+
+
+def _to_langchain(m):
+    if m.role == "user":
+        return HumanMessage(content=m.content)
+    # Here, non-user role means assistant.
+    return AIMessage(content=m.content)
+
+
+def _summarize(previous: str, rows, affinity: str | None = None) -> tuple[str, int]:
+    # (new summary, id of the last row folded into it). Only as many rows as fit
+    # SUMMARY_INPUT_TOKENS are read, the rest is left for the next update.
+    lines = []
+    used = 0
+    upto_id = None
+    for m in rows:
+        line = f"{m.role}: {m.content}"
+        cost = count_tokens(line)
+        if used + cost > SUMMARY_INPUT_TOKENS:
+            if not lines:
+                # One huge message (e.g. a long paste): summarize its beginning,
+                # otherwise the summary could never move past it
+                lines.append(truncate_to_tokens(line, SUMMARY_INPUT_TOKENS))
+                upto_id = m.id
+            break
+        lines.append(line)
+        used += cost
+        upto_id = m.id
+
+    prompt = [
+        SystemMessage(content=SUMMARY_PROMPT),
+        HumanMessage(
+            content=f"Current summary:\n{previous or '(empty)'}\n\nNew messages:\n" + "\n".join(lines)
+        ),
+    ]
+    llm = get_llm(affinity=affinity)
+    with span("llm", purpose="summary") as attrs:
+        resp = llm.invoke(prompt, options={**LLM_OPTIONS, "num_predict": SUMMARY_MAX_TOKENS})
+        record_llm_call(attrs, llm.model, resp)
+    return truncate_to_tokens(str(resp.content).strip(), SUMMARY_MAX_TOKENS), upto_id
+
+
+def _update_summary(conversation, oldest_kept_id: int) -> None:
+    # Messages between the end of the current summary and the oldest message we
+    # still send verbatim are not covered by anything: fold them into the summary
+    # once enough of them have piled up.
+    gap = conversation.messages.filter(status="done", id__lt=oldest_kept_id)
+    if conversation.summary_upto_id is not None:
+        gap = gap.filter(id__gt=conversation.summary_upto_id)
+    gap = list(gap.order_by("id").only("id", "role", "content"))
+    if not gap:
+        return
+
+    gap_tokens = sum(message_tokens(m.content) for m in gap)
+    if gap_tokens < SUMMARY_BATCH_TOKENS:
+        return
+
+    try:
+        summary, upto_id = _summarize(conversation.summary, gap, affinity=str(conversation.session_id))
+    except Exception as exc:
+        # The reply is more important than the summary: try again next turn
+        logger.warning("summary_update_failed conv_id=%s: %s", conversation.id, exc)
+        return
+
+    # Conditional update: if another request already moved the summary on,
+    # keep theirs instead of overwriting it. Rows after upto_id didn't fit the
+    # summary input: they stay in the gap for the next turn.
+    updated = type(conversation).objects.filter(
+        id=conversation.id,
+        summary_upto_id=conversation.summary_upto_id,
+    ).update(summary=summary, summary_upto_id=upto_id)
+    if updated:
+        conversation.summary = summary
+        conversation.summary_upto_id = upto_id
+
+
+def _recent_history(conversation, budget: int, before_message_id: int | None = None) -> tuple[list, bool]:
+    # (newest messages that fit `budget`, newest first; True if older ones were left out)
+    # Only finished messages: skip replies that are still pending or failed
+    rows = conversation.messages.filter(status="done")
+    if before_message_id is not None:
+        # Background jobs answer the turn they were queued for,
+        # even if the user sent more messages in the meantime
+        rows = rows.filter(id__lt=before_message_id)
+
+    # Newest first, pulled in small chunks so a long chat isn't loaded whole
+    kept = []
+    used = 0
+    for m in rows.order_by("-created_at", "-id").only("id", "role", "content").iterator(chunk_size=20):
+        cost = message_tokens(m.content)
+        if used + cost > budget:
+            if not kept:
+                # The newest message alone is too long: send as much of it as fits
+                m.content = truncate_to_tokens(m.content, budget - MESSAGE_OVERHEAD_TOKENS)
+                kept.append(m)
+            return kept, True
+        kept.append(m)
+        used += cost
+    return kept, False
+
+
+def build_context(conversation, system_prompt: str, before_message_id: int | None = None) -> list:
+    # Uses the summary the conversation already has: it is extended after the
+    # reply (update_summary), never while a prompt is being built
+    budget = history_budget(system_prompt, conversation.summary)
+    kept, _ = _recent_history(conversation, budget, before_message_id)
+
+    # Chat models expect chronological order: oldest -> newest.
+    kept.reverse()
+
+    # System prompt first, then the summary of older turns, then recent history
+    msgs = [SystemMessage(content=system_prompt)]
+    if conversation.summary:
+        msgs.append(SystemMessage(content=f"Summary of the earlier conversation:\n{conversation.summary}"))
+    msgs.extend(_to_langchain(m) for m in kept)
+    return msgs
+
+
+def update_summary(conversation, system_prompt: str) -> None:
+    # Fold the history that no longer fits the next prompt into the rolling
+    # summary. Called once a reply is saved (job worker, end of a streamed
+    # reply), so the summarizer call doesn't hold up the reply itself.
+    budget = history_budget(system_prompt, conversation.summary)
+    kept, overflow = _recent_history(conversation, budget)
+    if overflow and kept:
+        _update_summary(conversation, kept[-1].id)
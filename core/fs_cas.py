@@ -0,0 +1,554 @@
+# Content-addressed sandbox storage (SANDBOX_STORAGE["BACKEND"] = "cas").
+#
+# Instead of a folder of files per user:
+#   - every file content is stored once, as an object named by its sha256, in
+#     SANDBOX_STORAGE["DIR"]/objects, shared by all users (zstd compressed when
+#     that makes it smaller)
+#   - a folder is an object too, a "tree": JSON {name: [kind, hash, size, mtime_ns]}
+#   - a user's sandbox is the hash of its root tree, the "head": a small file
+#     DIR/heads/<user_id>, read by every operation (a DB row would cost a query
+#     on every read)
+# Objects never change. A write stores the new file object plus new trees for
+# the folders on its path (everything else is shared with the old tree) and
+# then replaces the head file (atomic rename). So:
+#   - identical files (across users, or rewritten by the agent) are stored once,
+#     writing the content a file already has does nothing
+#   - a snapshot is the current root hash (one SandboxSnapshot row) and
+#     restoring it moves the head back: no data is copied either way
+# Quotas still count each user's file sizes: dedup saves disk, not quota.
+#
+# core.fs_local calls in here when the backend is on, its API stays the same.
+# sha256 rather than xxhash: objects are shared between users, so a hash
+# collision would show one user's content in another user's file.
+import errno
+import fcntl
+import hashlib
+import io
+import json
+import os
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+from fnmatch import fnmatch
+from functools import lru_cache
+from pathlib import Path
+
+from django.conf import settings
+
+from .audit import audit
+from .fs_local import MAX_FILE_BYTES, FileTooLarge, _is_temp_name
+from .metrics import REGISTRY
+from .models import SandboxSnapshot
+from .quota import StreamReservation, release, reserve
+from .sandbox import clean_parts, sandbox_path
+
+WRITTEN = REGISTRY.counter("sandbox_objects_written_total", "Objects added to the content-addressed store.")
+DEDUPLICATED = REGISTRY.counter("sandbox_objects_deduplicated_total", "Object writes skipped, the content was already stored.")
+UNCHANGED = REGISTRY.counter("sandbox_writes_unchanged_total", "File writes skipped, the file already had that content.")
+
+# Tree entry kinds
+FILE = "f"
+DIR = "d"
+
+# Hash of the empty tree (never stored, every lookup knows it)
+EMPTY_TREE = hashlib.sha256(b"{}").hexdigest()
+
+# Smaller objects are never compressed (zstd's frame header eats the gain)
+COMPRESS_MIN_BYTES = 64
+# A compressed object is only kept when it is at most this much of the original
+COMPRESS_RATIO = 0.9
+
+# Read size when copying objects (appends, imports)
+COPY_BLOCK = 1024 * 1024
+
+
+class ObjectStore:
+    # Immutable objects by sha256: objects/ab/abcdef... (or ...zst when compressed)
+
+    def __init__(self, directory: Path, compress: bool = True, compress_max_bytes: int = 1024 * 1024):
+        self.directory = Path(directory)
+        self.objects = self.directory / "objects"
+        # Objects are written here first, then renamed into place
+        self.tmp = self.directory / "tmp"
+        # Head (root tree hash) of every user
+        self.heads = self.directory / "heads"
+        for path in (self.objects, self.tmp, self.heads):
+            path.mkdir(parents=True, exist_ok=True)
+        self.compress_max_bytes = compress_max_bytes if compress else 0
+        # zstd (de)compressors can't be shared between threads
+        self._local = threading.local()
+
+    def path(self, digest: str, compressed: bool = False) -> Path:
+        return self.objects / digest[:2] / (digest + ".zst" if compressed else digest)
+
+    def _zstd(self):
+        local = self._local
+        if not hasattr(local, "compressor"):
+            import zstandard
+
+            local.compressor = zstandard.ZstdCompressor(level=3)
+            local.decompressor = zstandard.ZstdDecompressor()
+        return local
+
+    def open(self, digest: str):
+        # Binary file object with the content: the object file itself, or (for
+        # compressed objects, which are small) the decompressed content in memory
+        try:
+            return self.path(digest).open("rb")
+        except FileNotFoundError:
+            data = self.path(digest, compressed=True).read_bytes()
+        return io.BytesIO(self._zstd().decompressor.decompress(data))
+
+    def read(self, digest: str) -> bytes:
+        with self.open(digest) as f:
+            return f.read()
+
+    def _touch(self, digest: str) -> bool:
+        # Already stored? Then bump its mtime: gc only deletes objects older than
+        # its grace period, so one a write is about to reference stays
+        for compressed in (False, True):
+            try:
+                os.utime(self.path(digest, compressed))
+            except FileNotFoundError:
+                continue
+            DEDUPLICATED.inc()
+            return True
+        return False
+
+    def _compress(self, data: bytes) -> bytes | None:
+        if not COMPRESS_MIN_BYTES <= len(data) <= self.compress_max_bytes:
+            return None
+        compressed = self._zstd().compressor.compress(data)
+        return compressed if len(compressed) <= len(data) * COMPRESS_RATIO else None
+
+    def _install(self, tmp: Path, digest: str, compressed: bool) -> None:
+        path = self.path(digest, compressed)
+        # Two writers of the same content rename the same bytes into place: harmless
+        try:
+            os.replace(tmp, path)
+        except FileNotFoundError:
+            # First object of its objects/ab/ folder
+            path.parent.mkdir(exist_ok=True)
+            os.replace(tmp, path)
+        WRITTEN.inc()
+
+    def put(self, data: bytes, digest: str | None = None) -> str:
+        # Store bytes, returns their hash
+        digest = digest or hashlib.sha256(data).hexdigest()
+        if self._touch(digest):
+            return digest
+        compressed = self._compress(data)
+        tmp, path = self.new_file()
+        with tmp:
+            tmp.write(data if compressed is None else compressed)
+        self._install(path, digest, compressed is not None)
+        return digest
+
+    def new_file(self):
+        # (open temp file, its path) for content written piece by piece, see add_file()
+        path = self.tmp / f"{uuid.uuid4().hex}.tmp"
+        return path.open("xb"), path
+
+    def add_file(self, tmp: Path, digest: str, size: int) -> None:
+        # Move a finished temp file (from new_file()) into the store under its hash
+        if self._touch(digest):
+            tmp.unlink(missing_ok=True)
+            return
+        if COMPRESS_MIN_BYTES <= size <= self.compress_max_bytes:
+            compressed = self._compress(tmp.read_bytes())
+            if compressed is not None:
+                tmp.write_bytes(compressed)
+                self._install(tmp, digest, compressed=True)
+                return
+        self._install(tmp, digest, compressed=False)
+
+    def iter_objects(self):
+        # (hash, path) of every stored object, for gc
+        for fanout in self.objects.iterdir():
+            for path in fanout.iterdir():
+                yield path.name.removesuffix(".zst"), path
+
+
+_store = None
+_store_lock = threading.Lock()
+
+
+def get_store() -> ObjectStore:
+    global _store
+    if _store is None:
+        with _store_lock:
+            if _store is None:
+                conf = settings.SANDBOX_STORAGE
+                _store = ObjectStore(
+                    conf["DIR"],
+                    compress=conf.get("COMPRESS", True),
+                    compress_max_bytes=conf.get("COMPRESS_MAX_BYTES", 1024 * 1024),
+                )
+    return _store
+
+
+# Trees
+
+@lru_cache(maxsize=4096)
+def load_tree(digest: str) -> dict:
+    # Trees never change, so parsed ones are cached by hash.
+    # The returned dict is shared: copy it before changing it.
+    if digest == EMPTY_TREE:
+        return {}
+    return json.loads(get_store().read(digest))
+
+
+def _save_tree(entries: dict) -> str:
+    if not entries:
+        return EMPTY_TREE
+    return get_store().put(json.dumps(entries, sort_keys=True, separators=(",", ":")).encode("utf-8"))
+
+
+def _not_a_dir(parts: tuple) -> NotADirectoryError:
+    return NotADirectoryError(errno.ENOTDIR, os.strerror(errno.ENOTDIR), "/".join(parts))
+
+
+def _lookup(tree: str, parts: tuple) -> list | None:
+    # Entry [kind, hash, size, mtime_ns] at `parts` (None if missing), () = the root
+    entry = [DIR, tree, 0, 0]
+    for n, name in enumerate(parts):
+        if entry[0] != DIR:
+            raise _not_a_dir(parts[:n])
+        entry = load_tree(entry[1]).get(name)
+        if entry is None:
+            return None
+    return entry
+
+
+def _set_entry(tree: str, parts: tuple, entry: list, now_ns: int) -> str:
+    # New root with `entry` at `parts`: only the trees on the path are rewritten,
+    # missing folders are created
+    entries = dict(load_tree(tree))
+    name = parts[0]
+    current = entries.get(name)
+    if len(parts) == 1:
+        if current is not None and current[0] == DIR:
+            raise IsADirectoryError(errno.EISDIR, os.strerror(errno.EISDIR), name)
+        entries[name] = entry
+    else:
+        if current is not None and current[0] != DIR:
+            raise _not_a_dir((name,))
+        sub = current[1] if current is not None else EMPTY_TREE
+        entries[name] = [DIR, _set_entry(sub, parts[1:], entry, now_ns), 0, now_ns]
+    return _save_tree(entries)
+
+
+# Heads
+
+# Writes of one user are serialized: by a thread lock in this process and by
+# flock() on DIR/heads/<user_id>.lock across processes
+_USER_LOCKS = [threading.Lock() for _ in range(64)]
+
+
+@contextmanager
+def _user_lock(user_id: int):
+    with _USER_LOCKS[user_id % len(_USER_LOCKS)]:
+        fd = os.open(get_store().heads / f"{user_id}.lock", os.O_RDWR | os.O_CREAT | os.O_CLOEXEC, 0o644)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX)
+            yield
+        finally:
+            # Closing the file releases the flock
+            os.close(fd)
+
+
+def _write_head(user_id: int, tree: str, replace: bool = True) -> None:
+    heads = get_store().heads
+    tmp = heads / f"{user_id}.{uuid.uuid4().hex}.tmp"
+    tmp.write_text(tree)
+    try:
+        if replace:
+            os.replace(tmp, heads / str(user_id))
+        else:
+            # Only if there is no head yet (FileExistsError otherwise)
+            os.link(tmp, heads / str(user_id))
+    finally:
+        tmp.unlink(missing_ok=True)
+
+
+def get_head(user_id: int) -> str:
+    # Root tree hash of the user's sandbox
+    path = get_store().heads / str(user_id)
+    try:
+        return path.read_text()
+    except FileNotFoundError:
+        pass
+    # First use: start from what's already in the user's folder
+    # (e.g. files written before switching to this backend)
+    try:
+        _write_head(user_id, _import_folder(user_id), replace=False)
+    except FileExistsError:
+        # Another thread/process got there first
+        pass
+    return path.read_text()
+
+
+def head_user_ids() -> list[int]:
+    return sorted(int(p.name) for p in get_store().heads.iterdir() if p.name.isdigit())
+
+
+def _commit(user_id: int, change) -> str:
+    # Move the head from its tree to change(tree) (with _user_lock held)
+    old = get_head(user_id)
+    new = change(old)
+    if new != old:
+        _write_head(user_id, new)
+    return new
+
+
+def _import_folder(user_id: int) -> str:
+    # Tree of the files in the user's folder, the folder itself is left as it is
+    root = sandbox_path(user_id)
+    return _import_dir(get_store(), root) if root.is_dir() else EMPTY_TREE
+
+
+def _import_dir(store: ObjectStore, path: str | Path) -> str:
+    entries = {}
+    with os.scandir(path) as it:
+        for item in it:
+            # Symlinks are never followed (see core.sandbox)
+            if item.is_symlink() or _is_temp_name(item.name):
+                continue
+            st = item.stat(follow_symlinks=False)
+            if item.is_dir(follow_symlinks=False):
+                entries[item.name] = [DIR, _import_dir(store, item.path), 0, st.st_mtime_ns]
+            elif item.is_file(follow_symlinks=False):
+                hasher = hashlib.sha256()
+                tmp, tmp_path = store.new_file()
+                with tmp, open(item.path, "rb") as src:
+                    while block := src.read(COPY_BLOCK):
+                        hasher.update(block)
+                        tmp.write(block)
+                digest = hasher.hexdigest()
+                store.add_file(tmp_path, digest, st.st_size)
+                entries[item.name] = [FILE, digest, st.st_size, st.st_mtime_ns]
+    return _save_tree(entries)
+
+
+# The fs_local API
+
+def _walk(tree: str, parts: tuple, depth: int, max_depth, after: tuple, pattern: str, with_meta: bool):
+    # Same order, entries and cursor rules as fs_local._walk, over tree objects
+    entries = load_tree(tree)
+    for name in sorted(entries):
+        kind, digest, size, mtime_ns = entries[name]
+        entry_parts = parts + (name,)
+        is_dir = kind == DIR
+        can_descend = is_dir and (max_depth is None or depth < max_depth)
+
+        if after and entry_parts <= after:
+            if can_descend and entry_parts == after[: len(entry_parts)]:
+                yield from _walk(digest, entry_parts, depth + 1, max_depth, after, pattern, with_meta)
+            continue
+
+        rel = "/".join(entry_parts)
+        if not pattern or fnmatch(name, pattern) or fnmatch(rel, pattern):
+            item = {"path": rel, "name": name, "depth": depth, "is_dir": is_dir}
+            if with_meta:
+                item["size"] = size
+                item["mtime"] = mtime_ns / 1e9
+                item["mtime_ns"] = mtime_ns
+            yield item
+
+        if can_descend:
+            yield from _walk(digest, entry_parts, depth + 1, max_depth, (), pattern, with_meta)
+
+
+def iter_tree(user_id: int, rel_path: str = "", max_depth=None, pattern: str = "", cursor: str = "", with_meta: bool = False):
+    parts = clean_parts(rel_path) if rel_path else ()
+    after = tuple(p for p in cursor.split("/") if p) if cursor else ()
+    try:
+        entry = _lookup(get_head(user_id), parts)
+    except NotADirectoryError:
+        return
+    if entry is not None and entry[0] == DIR:
+        yield from _walk(entry[1], (), 1, max_depth, after, pattern, with_meta)
+
+
+def open_file(user_id: int, rel_path: str):
+    parts = clean_parts(rel_path)
+    if not parts:
+        raise ValueError("path is the sandbox folder itself")
+    entry = _lookup(get_head(user_id), parts)
+    if entry is None:
+        raise FileNotFoundError(errno.ENOENT, os.strerror(errno.ENOENT), rel_path)
+    if entry[0] == DIR:
+        raise IsADirectoryError(errno.EISDIR, os.strerror(errno.EISDIR), rel_path)
+    return get_store().open(entry[1])
+
+
+def _existing_file(user_id: int, parts: tuple) -> list | None:
+    # The file entry a write replaces (None = new file)
+    if not parts:
+        raise ValueError("path is the sandbox folder itself")
+    entry = _lookup(get_head(user_id), parts)
+    if entry is not None and entry[0] == DIR:
+        raise IsADirectoryError(errno.EISDIR, os.strerror(errno.EISDIR), "/".join(parts))
+    return entry
+
+
+def _set_file(user_id: int, parts: tuple, digest: str, size: int) -> int:
+    # Point the path at a stored object, returns the file's mtime_ns
+    now_ns = time.time_ns()
+    _commit(user_id, lambda tree: _set_entry(tree, parts, [FILE, digest, size, now_ns], now_ns))
+    return now_ns
+
+
+def write_file(user_id: int, rel_path: str, content: str) -> None:
+    data = content.encode("utf-8")
+    if len(data) > MAX_FILE_BYTES:
+        raise FileTooLarge(f"file larger than {MAX_FILE_BYTES} bytes")
+
+    parts = clean_parts(rel_path)
+    rel = "/".join(parts)
+    digest = hashlib.sha256(data).hexdigest()
+
+    with _user_lock(user_id):
+        old = _existing_file(user_id, parts)
+        if old is not None and old[1] == digest:
+            # Same content: nothing to store, index or count
+            UNCHANGED.inc()
+            audit("file_write", user_id=user_id, path=rel, mode="write", bytes=0, unchanged=True)
+            return
+        delta_bytes = len(data) - (old[2] if old else 0)
+        delta_files = 1 if old is None else 0
+        reserve(user_id, delta_bytes, delta_files)
+        try:
+            get_store().put(data, digest)
+            mtime_ns = _set_file(user_id, parts, digest, len(data))
+        except BaseException:
+            release(user_id, delta_bytes, delta_files)
+            raise
+
+    from .fs_index import record_write
+
+    record_write(user_id, rel, len(data), mtime_ns, content)
+    audit("file_write", user_id=user_id, path=rel, mode="write", bytes=len(data))
+
+
+def write_chunks(user_id: int, rel_path: str, chunks, append: bool = False) -> int:
+    parts = clean_parts(rel_path)
+    rel = "/".join(parts)
+    store = get_store()
+
+    with _user_lock(user_id):
+        old = _existing_file(user_id, parts)
+        old_size = old[2] if old else 0
+        # Reserved as the data streams in, before it reaches the disk
+        quota = StreamReservation(user_id, None if old is None else old_size)
+
+        # Hash the content while it streams into a temp file
+        hasher = hashlib.sha256()
+        tmp, tmp_path = store.new_file()
+        start = size = 0
+        try:
+            with tmp:
+                if append and old is not None:
+                    # Objects never change: the appended file is a new object
+                    # (old content + the new part)
+                    with store.open(old[1]) as src:
+                        while block := src.read(COPY_BLOCK):
+                            hasher.update(block)
+                            tmp.write(block)
+                    start = size = old_size
+                for chunk in chunks:
+                    size += len(chunk)
+                    if size > MAX_FILE_BYTES:
+                        raise FileTooLarge(f"file larger than {MAX_FILE_BYTES} bytes")
+                    quota.grow(size)
+                    hasher.update(chunk)
+                    tmp.write(chunk)
+        except BaseException:
+            tmp_path.unlink(missing_ok=True)
+            quota.cancel()
+            raise
+
+        digest = hasher.hexdigest()
+        if old is not None and old[1] == digest:
+            tmp_path.unlink(missing_ok=True)
+            quota.cancel()
+            UNCHANGED.inc()
+            audit("file_write", user_id=user_id, path=rel, mode="append" if append else "write", bytes=0, unchanged=True)
+            return size
+
+        try:
+            quota.settle(size)
+            store.add_file(tmp_path, digest, size)
+            mtime_ns = _set_file(user_id, parts, digest, size)
+        except BaseException:
+            tmp_path.unlink(missing_ok=True)
+            quota.cancel()
+            raise
+
+    from .fs_index import record_write
+
+    record_write(user_id, rel, size, mtime_ns)
+    audit("file_write", user_id=user_id, path=rel, mode="append" if append else "write", bytes=size - start)
+    return size
+
+
+# Snapshots
+
+def _prune_snapshots(user_id: int) -> None:
+    keep = settings.SANDBOX_STORAGE.get("KEEP_SNAPSHOTS", 50)
+    old_ids = list(
+        SandboxSnapshot.objects.filter(owner_id=user_id).order_by("-id").values_list("id", flat=True)[keep:]
+    )
+    if old_ids:
+        SandboxSnapshot.objects.filter(id__in=old_ids).delete()
+
+
+def snapshot(user_id: int, label: str = "", conversation_id: int | None = None) -> SandboxSnapshot:
+    # Save the current state of the sandbox: one row with the root hash
+    snap = SandboxSnapshot.objects.create(
+        owner_id=user_id,
+        conversation_id=conversation_id,
+        tree=get_head(user_id),
+        label=label[:200],
+    )
+    _prune_snapshots(user_id)
+    return snap
+
+
+def restore(user_id: int, snapshot_id: int) -> SandboxSnapshot:
+    # Put the sandbox back the way it was at a snapshot. The current state is
+    # saved as a snapshot first (returned), so a restore can be undone as well.
+    snap = SandboxSnapshot.objects.get(owner_id=user_id, id=snapshot_id)
+    with _user_lock(user_id):
+        undo = snapshot(user_id, label=f"before restoring snapshot {snap.id}")
+        _commit(user_id, lambda tree: snap.tree)
+
+    # Search index and quota totals follow the restored files
+    # (only files whose size/mtime changed are read again)
+    from .fs_index import reconcile
+
+    reconcile(user_id, force=True)
+    audit("sandbox_restore", user_id=user_id, snapshot_id=snap.id, undo_snapshot_id=undo.id)
+    return undo
+
+
+def reachable_objects() -> set[str]:
+    # Hashes of every object a head or a snapshot still uses (trees shared
+    # between snapshots are only walked once)
+    store = get_store()
+    trees = {(store.heads / str(user_id)).read_text() for user_id in head_user_ids()}
+    trees.update(SandboxSnapshot.objects.values_list("tree", flat=True))
+    seen = set()
+    pending = list(trees)
+    while pending:
+        tree = pending.pop()
+        if tree in seen:
+            continue
+        seen.add(tree)
+        for kind, digest, _, _ in load_tree(tree).values():
+            if kind == DIR:
+                pending.append(digest)
+            else:
+                seen.add(digest)
+    return seen
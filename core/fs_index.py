@@ -0,0 +1,215 @@
+# Per-user sandbox search index.
+#
+# For every file in a user's sandbox we keep path/size/mtime/content hash
+# (SandboxFile) and an inverted index word -> files (SandboxTerm), so the
+# assistant can find files with one fs_search call instead of listing and
+# reading candidates one model round trip at a time.
+#
+# write_file updates the index as it writes. Files changed outside the app are
+# picked up by reconcile(), which compares size/mtime with the disk.
+import io
+import logging
+import re
+import threading
+import time
+from collections import Counter
+
+import xxhash
+from django.db import transaction
+from django.db.models import Count, Sum
+
+from .fs_local import in_worker_thread
+from .models import SandboxFile, SandboxTerm
+from .quota import mark_changed, set_usage
+
+logger = logging.getLogger(__name__)
+
+# Bigger files get a metadata row but their content isn't indexed
+INDEX_MAX_BYTES = 1024 * 1024
+
+# Keep only the most frequent words of a file
+MAX_TERMS_PER_FILE = 2000
+
+# Words in the file path count as if they appeared this many times
+PATH_TERM_WEIGHT = 5
+
+# Don't walk a user's sandbox more often than this (seconds) when searching
+RECONCILE_INTERVAL = 30
+
+# Max number of results to attach a matching line to
+SNIPPET_RESULTS = 5
+
+_WORD_RE = re.compile(r"[A-Za-z0-9_]{2,64}")
+
+# user_id -> time.monotonic() of the last reconcile in this process
+_last_reconcile: dict[int, float] = {}
+_reconcile_lock = threading.Lock()
+
+
+def tokenize(text: str) -> Counter:
+    return Counter(w.lower() for w in _WORD_RE.findall(text))
+
+
+def content_hash(data: bytes) -> str:
+    return xxhash.xxh3_128_hexdigest(data)
+
+
+def _terms_for(rel_path: str, content: str | None) -> Counter:
+    terms = Counter()
+    for word, n in tokenize(rel_path).items():
+        terms[word] += n * PATH_TERM_WEIGHT
+    if content is not None:
+        terms.update(tokenize(content))
+    return Counter(dict(terms.most_common(MAX_TERMS_PER_FILE)))
+
+
+def index_file(user_id: int, rel_path: str, size: int, mtime_ns: int, content: str | None) -> None:
+    # Insert/update one file. `content` is None for files we don't index the text of.
+    digest = content_hash(content.encode("utf-8")) if content is not None else ""
+
+    with transaction.atomic():
+        row, created = SandboxFile.objects.get_or_create(
+            owner_id=user_id,
+            path=rel_path,
+            defaults={"size": size, "mtime_ns": mtime_ns, "content_hash": digest},
+        )
+        if not created:
+            unchanged = row.content_hash == digest
+            row.size = size
+            row.mtime_ns = mtime_ns
+            row.content_hash = digest
+            row.save(update_fields=["size", "mtime_ns", "content_hash", "indexed_at"])
+            if unchanged:
+                # Same content (e.g. rewritten with identical text): terms are still right
+                return
+            row.terms.all().delete()
+
+        SandboxTerm.objects.bulk_create(
+            [
+                SandboxTerm(owner_id=user_id, file=row, term=term, count=n)
+                for term, n in _terms_for(rel_path, content).items()
+            ],
+            batch_size=500,
+        )
+
+
+def record_write(user_id: int, rel_path: str, size: int, mtime_ns: int, content: str | None = None) -> None:
+    # Called by write_file/write_chunks after the file is written, with its
+    # size and mtime. `content` is the full text when the caller has it, otherwise
+    # (appends, uploads) we read it back if the file is small enough to index.
+    # The index is a cache: if updating it fails the write still counts,
+    # the next reconcile() fixes the row.
+    mark_changed(user_id)
+    try:
+        if content is not None and size <= INDEX_MAX_BYTES:
+            text = content
+        else:
+            text = _read_for_index(user_id, rel_path, size)
+        index_file(user_id, rel_path, size, mtime_ns, text)
+    except Exception as exc:
+        logger.warning("fs_index_update_failed user_id=%s path=%s: %s", user_id, rel_path, exc)
+
+
+def _read_for_index(user_id: int, rel_path: str, size: int) -> str | None:
+    from .fs_local import open_file
+
+    if size > INDEX_MAX_BYTES:
+        return None
+    try:
+        with open_file(user_id, rel_path) as f:
+            data = f.read(INDEX_MAX_BYTES + 1)
+    except (OSError, ValueError):
+        return None
+    # Binary files: index the path only
+    if b"\0" in data[:8192]:
+        return None
+    return data.decode("utf-8", errors="replace")
+
+
+def reconcile(user_id: int, force: bool = False) -> int:
+    # Bring the index in line with the disk: (re)index new or changed files
+    # (by size/mtime) and drop rows for deleted files. Returns rows changed.
+    from .fs_local import iter_tree
+
+    now = time.monotonic()
+    with _reconcile_lock:
+        last = _last_reconcile.get(user_id)
+        if not force and last is not None and now - last < RECONCILE_INTERVAL:
+            return 0
+        _last_reconcile[user_id] = now
+
+    known = {
+        path: (size, mtime_ns)
+        for path, size, mtime_ns in SandboxFile.objects.filter(owner_id=user_id).values_list("path", "size", "mtime_ns")
+    }
+
+    changed = 0
+    seen = set()
+    total_bytes = 0
+    for item in iter_tree(user_id, with_meta=True):
+        if item["is_dir"]:
+            continue
+        seen.add(item["path"])
+        total_bytes += item["size"]
+        if known.get(item["path"]) == (item["size"], item["mtime_ns"]):
+            continue
+        content = _read_for_index(user_id, item["path"], item["size"])
+        index_file(user_id, item["path"], item["size"], item["mtime_ns"], content)
+        changed += 1
+
+    gone = [path for path in known if path not in seen]
+    if gone:
+        SandboxFile.objects.filter(owner_id=user_id, path__in=gone).delete()
+        changed += len(gone)
+
+    # The walk also gives the real sandbox size: reset the quota counters
+    # (a write racing with the walk may be off until the next reconcile)
+    set_usage(user_id, total_bytes, len(seen), changed=bool(changed))
+    return changed
+
+
+def _snippet(user_id: int, rel_path: str, words: set[str]) -> str:
+    # First line of the file that contains one of the query words
+    from .fs_local import open_file
+
+    try:
+        with io.TextIOWrapper(open_file(user_id, rel_path), encoding="utf-8", errors="replace") as f:
+            for n, line in enumerate(f, start=1):
+                if words & set(tokenize(line)):
+                    return f"{n}: {line.strip()[:200]}"
+    except (OSError, ValueError):
+        pass
+    return ""
+
+
+def search(user_id: int, query: str, limit: int = 10) -> list[dict]:
+    # Files containing the query words, best first:
+    # more distinct words matched, then more occurrences
+    words = set(tokenize(query))
+    if not words:
+        return []
+
+    reconcile(user_id)
+
+    ranked = list(
+        SandboxTerm.objects.filter(owner_id=user_id, term__in=words)
+        .values("file_id")
+        .annotate(matched=Count("term"), score=Sum("count"))
+        .order_by("-matched", "-score", "file_id")[:limit]
+    )
+    files = SandboxFile.objects.in_bulk([r["file_id"] for r in ranked])
+
+    results = []
+    for n, r in enumerate(ranked):
+        f = files.get(r["file_id"])
+        if f is None:
+            continue
+        item = {"path": f.path, "size": f.size, "matched": r["matched"], "score": r["score"]}
+        if n < SNIPPET_RESULTS and f.size <= INDEX_MAX_BYTES:
+            item["snippet"] = _snippet(user_id, f.path, words)
+        results.append(item)
+    return results
+
+
+# For async views: reconcile (a walk over the files) + queries run in a worker thread
+asearch = in_worker_thread(search)
@@ -1,53 +1,488 @@
+import functools
+import io
+import mmap
+import os
+import threading
+import zlib
+from fnmatch import fnmatch
 from pathlib import Path
+from asgiref.sync import sync_to_async
 from django.conf import settings
+from django.db import close_old_connections
+
+from .audit import audit
+from .quota import StreamReservation, release, reserve
+# Every path below goes through an open handle of the user's folder (core.sandbox)
+from .sandbox import DIR_FLAGS, clean_parts, sandbox, sandbox_path
+
+# Size caps
+# Largest file write_file/uploads may produce
+MAX_FILE_BYTES = 50 * 1024 * 1024
+# Largest file read_file returns whole (use range/line reads for bigger ones)
+READ_FILE_MAX_BYTES = 2 * 1024 * 1024
+# Largest single range read
+READ_RANGE_MAX_BYTES = 1024 * 1024
+# Chunk size when streaming a download
+DOWNLOAD_CHUNK_BYTES = 64 * 1024
+# Longest text one read_lines call returns
+READ_LINES_MAX_BYTES = 64 * 1024
+
+
+class FileTooLarge(ValueError):
+    pass
+
+
+# Writes to the same file are serialized with one of these locks
+# (picked by path hash, so the number of locks stays fixed)
+_WRITE_LOCKS = [threading.Lock() for _ in range(64)]
+
+
+def _write_lock(user_id: int, rel: str) -> threading.Lock:
+    return _WRITE_LOCKS[zlib.crc32(f"{user_id}/{rel}".encode()) % len(_WRITE_LOCKS)]
+
+def _cas():
+    # core.fs_cas when SANDBOX_STORAGE["BACKEND"] is "cas" (files stored by
+    # content hash, with snapshots), None for a plain folder per user
+    if getattr(settings, "SANDBOX_STORAGE", {}).get("BACKEND", "files") != "cas":
+        return None
+    from . import fs_cas
+
+    return fs_cas
 
 def user_root(user_id: int) -> Path:
-    root = Path(settings.FILE_SANDBOX_ROOT) / str(user_id)
-    root.mkdir(parents=True, exist_ok=True)
-    return root
+    # The user's folder on disk (created if missing), for code that needs the path
+    with sandbox(user_id):
+        return sandbox_path(user_id)
+
+# Default/max number of entries one listing call returns
+LIST_DEFAULT_LIMIT = 200
+LIST_MAX_LIMIT = 1000
+
+
+def _is_temp_name(name: str) -> bool:
+    # In-flight temp files from write_file
+    return name.startswith(".") and name.endswith(".tmp")
+
+
+def _walk(dir_fd: int, parts: tuple, depth: int, max_depth, after: tuple, pattern: str, with_meta: bool):
+    # Depth-first walk with os.scandir, entries sorted by name in each folder.
+    # That makes the walk order the same as sorting the relative paths as tuples
+    # of parts, which is what lets a cursor skip whole subtrees.
+    # Folders are opened relative to their parent's fd (see core.sandbox).
+    try:
+        with os.scandir(dir_fd) as it:
+            entries = sorted((e for e in it if not _is_temp_name(e.name)), key=lambda e: e.name)
+    except (FileNotFoundError, NotADirectoryError, PermissionError):
+        return
+
+    for entry in entries:
+        entry_parts = parts + (entry.name,)
+        # Never follow symlinks: a link must not lead the walk outside the sandbox
+        is_dir = entry.is_dir(follow_symlinks=False)
+        can_descend = is_dir and (max_depth is None or depth < max_depth)
+
+        if after and entry_parts <= after:
+            # Already returned on an earlier page. Only the folders on the way
+            # to the cursor can still have unreturned children.
+            if can_descend and entry_parts == after[: len(entry_parts)]:
+                yield from _walk_into(dir_fd, entry.name, entry_parts, depth + 1, max_depth, after, pattern, with_meta)
+            continue
+
+        rel = "/".join(entry_parts)
+        if not pattern or fnmatch(entry.name, pattern) or fnmatch(rel, pattern):
+            item = {"path": rel, "name": entry.name, "depth": depth, "is_dir": is_dir}
+            if with_meta:
+                st = entry.stat(follow_symlinks=False)
+                item["size"] = 0 if is_dir else st.st_size
+                item["mtime"] = st.st_mtime
+                item["mtime_ns"] = st.st_mtime_ns
+            yield item
 
+        if can_descend:
+            yield from _walk_into(dir_fd, entry.name, entry_parts, depth + 1, max_depth, (), pattern, with_meta)
 
-def resolve_safe(root: Path, rel_path: str) -> Path:
-    # clean common junk the model may pass
-    rel_path = rel_path.strip().strip("`").strip('"').strip("'")
 
-    p = Path(rel_path)
+def _walk_into(dir_fd: int, name: str, *args):
+    try:
+        sub_fd = os.open(name, DIR_FLAGS, dir_fd=dir_fd)
+    except OSError:
+        # Gone meanwhile, or swapped for a symlink
+        return
+    try:
+        yield from _walk(sub_fd, *args)
+    finally:
+        os.close(sub_fd)
 
-    # block absolute paths like /etc/passwd
-    if p.is_absolute():
-        raise ValueError("absolute paths not allowed")
 
-    # build full path and normalize (resolves .. and .)
-    full = (root / p).resolve()
-    root_resolved = root.resolve()
+def iter_tree(
+    user_id: int,
+    rel_path: str = "",
+    max_depth: int | None = None,
+    pattern: str = "",
+    cursor: str = "",
+    with_meta: bool = False,
+):
+    # Lazily yield entries under rel_path (depth 1 = direct children),
+    # starting after `cursor` (the "path" of the last entry already seen)
+    cas = _cas()
+    if cas is not None:
+        yield from cas.iter_tree(user_id, rel_path, max_depth, pattern, cursor, with_meta)
+        return
+    parts = clean_parts(rel_path) if rel_path else ()
+    after = tuple(p for p in cursor.split("/") if p) if cursor else ()
+    with sandbox(user_id) as sb:
+        try:
+            base_fd = sb.open_dir(parts)
+        except (FileNotFoundError, NotADirectoryError):
+            return
+        try:
+            yield from _walk(base_fd, (), 1, max_depth, after, pattern, with_meta)
+        finally:
+            os.close(base_fd)
 
-    # block escape from sandbox
-    if full != root_resolved and root_resolved not in full.parents:
-        raise ValueError("path escapes sandbox")
 
-    return full
+def list_entries(
+    user_id: int,
+    rel_path: str = "",
+    max_depth: int | None = None,
+    pattern: str = "",
+    limit: int = LIST_DEFAULT_LIMIT,
+    cursor: str = "",
+    with_meta: bool = False,
+) -> tuple[list[dict], str | None]:
+    # One page of entries + the cursor for the next page (None when done)
+    limit = max(1, min(limit, LIST_MAX_LIMIT))
+    items = []
+    for item in iter_tree(user_id, rel_path, max_depth, pattern, cursor, with_meta):
+        if len(items) == limit:
+            # There is at least one more entry
+            return items, items[-1]["path"]
+        items.append(item)
+    return items, None
 
-def list_tree(user_id: int, rel_path: str = "") -> list[str]:
-    root = user_root(user_id)
-    base = (root / rel_path) if rel_path else resolve_safe(root, rel_path)
-    if not base.exists():
-        return []
 
+def format_entries(items: list[dict], flat: bool = False) -> list[str]:
+    # Tree-style lines ("  name/"), or full relative paths when flat
     lines = []
-    for p in sorted(base.rglob("*")):
-        rel = p.relative_to(base)
-        indent = "  " * (len(rel.parts) - 1)
-        name = rel.parts[-1] + ("/" if p.is_dir() else "")
-        lines.append(f"{indent}{name}")
+    for item in items:
+        suffix = "/" if item["is_dir"] else ""
+        if flat:
+            lines.append(item["path"] + suffix)
+        else:
+            lines.append("  " * (item["depth"] - 1) + item["name"] + suffix)
     return lines
 
+
+def list_tree(
+    user_id: int,
+    rel_path: str = "",
+    max_depth: int | None = None,
+    pattern: str = "",
+    limit: int = LIST_DEFAULT_LIMIT,
+) -> list[str]:
+    items, _ = list_entries(user_id, rel_path, max_depth, pattern, limit)
+    # A glob filter drops parent folders, so show full paths in that case
+    return format_entries(items, flat=bool(pattern))
+
+def _existing_size(dir_fd: int, name: str) -> int | None:
+    try:
+        return os.stat(name, dir_fd=dir_fd, follow_symlinks=False).st_size
+    except FileNotFoundError:
+        return None
+
+
+def _open_new(dir_fd: int, name: str, flags: int) -> int:
+    return os.open(name, flags | os.O_NOFOLLOW | os.O_CLOEXEC, 0o644, dir_fd=dir_fd)
+
+
+def _unlink_quietly(dir_fd: int, name: str) -> None:
+    try:
+        os.unlink(name, dir_fd=dir_fd)
+    except FileNotFoundError:
+        pass
+
+
+def _truncate_quietly(dir_fd: int, name: str, size: int) -> None:
+    try:
+        fd = os.open(name, os.O_WRONLY | os.O_NOFOLLOW | os.O_CLOEXEC, dir_fd=dir_fd)
+    except OSError:
+        return
+    try:
+        os.ftruncate(fd, size)
+    finally:
+        os.close(fd)
+
+
 def write_file(user_id: int, rel_path: str, content: str) -> None:
-    root = user_root(user_id)
-    target = resolve_safe(root, rel_path)
-    target.parent.mkdir(parents=True, exist_ok=True)
-    target.write_text(content, encoding="utf-8")
+    cas = _cas()
+    if cas is not None:
+        return cas.write_file(user_id, rel_path, content)
+    data = content.encode("utf-8")
+    if len(data) > MAX_FILE_BYTES:
+        raise FileTooLarge(f"file larger than {MAX_FILE_BYTES} bytes")
+
+    parts = clean_parts(rel_path)
+    rel = "/".join(parts)
+
+    # Write to a temp file and rename it over the target, so readers never see
+    # a half-written file, and hold the path lock so concurrent writes
+    # (e.g. parallel fs_write tool calls) can't interleave
+    with sandbox(user_id) as sb, sb.parent(parts, create=True) as (dir_fd, name), _write_lock(user_id, rel):
+        # Count the size change against the user's quota before writing
+        # (raises QuotaExceeded, the disk is untouched)
+        old_size = _existing_size(dir_fd, name)
+        delta_bytes = len(data) - (old_size or 0)
+        delta_files = 1 if old_size is None else 0
+        reserve(user_id, delta_bytes, delta_files)
+        tmp = f".{name}.{threading.get_ident()}.tmp"
+        try:
+            with os.fdopen(_open_new(dir_fd, tmp, os.O_WRONLY | os.O_CREAT | os.O_TRUNC), "wb") as f:
+                f.write(data)
+                st = os.fstat(f.fileno())
+            os.replace(tmp, name, src_dir_fd=dir_fd, dst_dir_fd=dir_fd)
+        except BaseException:
+            _unlink_quietly(dir_fd, tmp)
+            release(user_id, delta_bytes, delta_files)
+            raise
+
+    # Keep the search index in step with the file we just wrote
+    from .fs_index import record_write
+
+    record_write(user_id, rel, st.st_size, st.st_mtime_ns, content)
+    audit("file_write", user_id=user_id, path=rel, mode="write", bytes=len(data))
+
+
+def write_chunks(user_id: int, rel_path: str, chunks, append: bool = False) -> int:
+    # Write an iterable of bytes chunks (e.g. UploadedFile.chunks()) without
+    # holding the whole file in memory. append=True adds to the end of the file.
+    # Returns the new file size.
+    cas = _cas()
+    if cas is not None:
+        return cas.write_chunks(user_id, rel_path, chunks, append)
+    parts = clean_parts(rel_path)
+    rel = "/".join(parts)
+
+    with sandbox(user_id) as sb, sb.parent(parts, create=True) as (dir_fd, name), _write_lock(user_id, rel):
+        old_size = _existing_size(dir_fd, name)
+        # The total size isn't known up front: the quota is reserved as the
+        # data comes in, before it reaches the disk (what it replaces is freed)
+        quota = StreamReservation(user_id, old_size)
+
+        if append:
+            start = old_size or 0
+            tmp = None
+            f = os.fdopen(_open_new(dir_fd, name, os.O_WRONLY | os.O_CREAT | os.O_APPEND), "ab")
+        else:
+            start = 0
+            tmp = f".{name}.{threading.get_ident()}.tmp"
+            f = os.fdopen(_open_new(dir_fd, tmp, os.O_WRONLY | os.O_CREAT | os.O_TRUNC), "wb")
+
+        size = start
+        try:
+            with f:
+                for chunk in chunks:
+                    size += len(chunk)
+                    if size > MAX_FILE_BYTES:
+                        raise FileTooLarge(f"file larger than {MAX_FILE_BYTES} bytes")
+                    quota.grow(size)
+                    f.write(chunk)
+                f.flush()
+                st = os.fstat(f.fileno())
+            quota.settle(size)
+        except BaseException:
+            # Leave the old file as it was
+            if tmp is not None:
+                _unlink_quietly(dir_fd, tmp)
+            elif old_size is None:
+                _unlink_quietly(dir_fd, name)
+            else:
+                _truncate_quietly(dir_fd, name, start)
+            quota.cancel()
+            raise
+
+        if tmp is not None:
+            os.replace(tmp, name, src_dir_fd=dir_fd, dst_dir_fd=dir_fd)
+
+    from .fs_index import record_write
+
+    record_write(user_id, rel, st.st_size, st.st_mtime_ns)
+    audit("file_write", user_id=user_id, path=rel, mode="append" if append else "write", bytes=size - start)
+    return size
+
+
+def append_file(user_id: int, rel_path: str, content: str) -> int:
+    return write_chunks(user_id, rel_path, [content.encode("utf-8")], append=True)
+
+
+def open_file(user_id: int, rel_path: str):
+    # Binary file object for a sandbox file (never through a symlink)
+    cas = _cas()
+    if cas is not None:
+        return cas.open_file(user_id, rel_path)
+    with sandbox(user_id) as sb:
+        return os.fdopen(sb.open(clean_parts(rel_path), os.O_RDONLY), "rb")
+
+
+def _size(f) -> int:
+    # Size of an open file (also for the in-memory files of the cas backend),
+    # leaves the position at the start
+    size = f.seek(0, io.SEEK_END)
+    f.seek(0)
+    return size
+
 
 def read_file(user_id: int, rel_path: str) -> str:
-    root = user_root(user_id)
-    target = resolve_safe(root, rel_path)
-    return target.read_text(encoding="utf-8")
\ No newline at end of file
+    with open_file(user_id, rel_path) as f:
+        if _size(f) > READ_FILE_MAX_BYTES:
+            raise FileTooLarge(f"file larger than {READ_FILE_MAX_BYTES} bytes, read it in ranges")
+        return f.read().decode("utf-8")
+
+
+def _trim_partial_utf8(data: bytes) -> bytes:
+    # Drop a UTF-8 character cut in half at the end of a range,
+    # the next range starts at its first byte instead
+    for back in range(1, min(4, len(data)) + 1):
+        byte = data[-back]
+        if byte & 0b1100_0000 != 0b1000_0000:
+            # Lead byte (or ASCII): how long should its sequence be?
+            if byte >= 0b1111_0000:
+                need = 4
+            elif byte >= 0b1110_0000:
+                need = 3
+            elif byte >= 0b1100_0000:
+                need = 2
+            else:
+                need = 1
+            return data if need <= back else data[:-back]
+    return data
+
+
+def read_range(user_id: int, rel_path: str, offset: int = 0, length: int = READ_RANGE_MAX_BYTES) -> tuple[bytes, int]:
+    # Bytes [offset, offset+length) of a file + the file size.
+    # Uses mmap so only the pages we touch are read from disk.
+    offset = max(0, offset)
+    length = max(0, min(length, READ_RANGE_MAX_BYTES))
+
+    with open_file(user_id, rel_path) as f:
+        size = _size(f)
+        if offset >= size or length == 0:
+            return b"", size
+        try:
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                return mm[offset : offset + length], size
+        except (ValueError, OSError):
+            # Files that can't be mapped (special files, some filesystems,
+            # compressed objects of the cas backend)
+            f.seek(offset)
+            return f.read(length), size
+
+
+def read_text_range(user_id: int, rel_path: str, offset: int = 0, length: int = READ_RANGE_MAX_BYTES) -> dict:
+    # Text version of read_range: never splits a UTF-8 character at the end,
+    # next_offset is None once the end of the file is reached
+    data, size = read_range(user_id, rel_path, offset, length)
+    end = offset + len(data)
+    if end < size:
+        data = _trim_partial_utf8(data)
+        end = offset + len(data)
+    return {
+        "content": data.decode("utf-8", errors="replace"),
+        "offset": offset,
+        "size": size,
+        "next_offset": end if end < size else None,
+    }
+
+
+def read_lines(
+    user_id: int,
+    rel_path: str,
+    start_line: int = 1,
+    max_lines: int = 100,
+    max_bytes: int = READ_LINES_MAX_BYTES,
+) -> dict:
+    # Lines start_line.. (1-based) of a text file, reading it as a stream.
+    # next_line is the line to continue from, or None at the end of the file.
+    start_line = max(1, start_line)
+
+    lines = []
+    used = 0
+    next_line = None
+    with io.TextIOWrapper(open_file(user_id, rel_path), encoding="utf-8", errors="replace") as f:
+        for n, line in enumerate(f, start=1):
+            if n < start_line:
+                continue
+            if len(lines) >= max_lines or (lines and used + len(line) > max_bytes):
+                next_line = n
+                break
+            if not lines and len(line) > max_bytes:
+                # One giant line: return a slice of it rather than nothing
+                line = line[:max_bytes]
+            lines.append(line)
+            used += len(line)
+
+    return {"content": "".join(lines), "start_line": start_line, "next_line": next_line}
+
+
+def open_for_download(user_id: int, rel_path: str):
+    # (open file handle, size) for streaming a file to the client (caller closes it)
+    f = open_file(user_id, rel_path)
+    return f, _size(f)
+
+
+async def aiter_file(f, chunk_size: int = DOWNLOAD_CHUNK_BYTES):
+    # The file as async chunks, for a StreamingHttpResponse in an async view:
+    # each read runs in a worker thread and only one chunk is in memory at a
+    # time (Django reads a sync iterator whole into a list before sending it
+    # under ASGI). Closes f at the end.
+    read = sync_to_async(f.read, thread_sensitive=False)
+    try:
+        while True:
+            chunk = await read(chunk_size)
+            if not chunk:
+                break
+            yield chunk
+    finally:
+        await sync_to_async(f.close, thread_sensitive=False)()
+
+
+def snapshot(user_id: int, label: str = "", conversation_id: int | None = None):
+    # Save the sandbox as it is now, so it can be restored later. Costs one row
+    # whatever the sandbox size. Only the cas backend has snapshots (else None).
+    cas = _cas()
+    return cas.snapshot(user_id, label, conversation_id) if cas is not None else None
+
+
+def restore_snapshot(user_id: int, snapshot_id: int):
+    # Put the sandbox back the way it was at a snapshot, returns the snapshot
+    # of the state it replaced (to undo the restore)
+    cas = _cas()
+    if cas is None:
+        raise ValueError("snapshots need SANDBOX_STORAGE['BACKEND'] = 'cas'")
+    return cas.restore(user_id, snapshot_id)
+
+
+# Async versions for the async views: the blocking file I/O runs in a worker
+# thread (not on the event loop, and not in Django's one thread for sync code).
+# The writes also use the ORM there (quota, index, snapshots): those threads
+# aren't request threads, so nothing else would close the DB connection they
+# open. Each call starts and ends like a request does (close_old_connections:
+# closed after the call with CONN_MAX_AGE = 0, kept for reuse within its age).
+def in_worker_thread(fn):
+    @functools.wraps(fn)
+    def call(*args, **kwargs):
+        close_old_connections()
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            close_old_connections()
+
+    return sync_to_async(call, thread_sensitive=False)
+
+
+alist_entries = in_worker_thread(list_entries)
+awrite_file = in_worker_thread(write_file)
+awrite_chunks = in_worker_thread(write_chunks)
+aappend_file = in_worker_thread(append_file)
+aread_text_range = in_worker_thread(read_text_range)
+aopen_for_download = in_worker_thread(open_for_download)
+arestore_snapshot = in_worker_thread(restore_snapshot)
@@ -0,0 +1,212 @@
+# Background agent turns.
+#
+# The chat view only enqueues a job (a pending assistant Message + AgentJob row).
+# Workers (`manage.py run_agent_workers`) claim jobs from the DB, run the agent
+# loop and fill in the message, so web capacity and LLM capacity scale separately.
+#
+# Claiming uses a lease: a worker atomically flips a job to "running" with
+# lease_owner/lease_expires_at set, and keeps pushing lease_expires_at forward
+# while the turn runs (a heartbeat thread). If the worker dies, the lease
+# expires and another worker can claim the job again (up to MAX_ATTEMPTS).
+import logging
+import threading
+from contextlib import contextmanager
+from datetime import timedelta
+
+from django.db import connection, transaction
+from django.db.models import F, Q
+from django.utils import timezone
+
+from .assistant import generate_reply, summarize_history
+from .audit import audit
+from .models import AgentJob, Message
+from .tracing import start_trace
+
+logger = logging.getLogger(__name__)
+
+# Give up on a job after this many claims (e.g. it keeps crashing its worker)
+MAX_ATTEMPTS = 3
+
+# How many candidate rows one claim attempt looks at
+CLAIM_BATCH = 10
+
+# Default lease length (s); the heartbeat renews it every third of that
+LEASE_SECONDS = 300
+
+FAILED_TEXT = "Sorry, I couldn't generate a reply. Please try again."
+
+
+def enqueue_reply(conversation, user_text: str) -> AgentJob:
+    # Create the placeholder reply and its job together, so a worker never
+    # sees a job without a message (or the other way around)
+    with transaction.atomic():
+        msg = conversation.add_message("assistant", "", status=Message.STATUS_PENDING)
+        return AgentJob.objects.create(message=msg, user_text=user_text)
+
+
+def queued_jobs_for(user_id: int) -> int:
+    # Turns of this user still waiting for (or being handled by) a worker
+    return AgentJob.objects.filter(
+        message__conversation__owner_id=user_id,
+        status__in=[AgentJob.STATUS_QUEUED, AgentJob.STATUS_RUNNING],
+    ).count()
+
+
+def _claimable(now):
+    # Queued jobs, or running jobs whose worker stopped renewing its lease
+    return Q(status=AgentJob.STATUS_QUEUED) | Q(status=AgentJob.STATUS_RUNNING, lease_expires_at__lt=now)
+
+
+def claim_job(worker_id: str, lease_seconds: int = LEASE_SECONDS) -> AgentJob | None:
+    now = timezone.now()
+    candidates = list(
+        AgentJob.objects.filter(_claimable(now), attempts__lt=MAX_ATTEMPTS)
+        .order_by("id")
+        .values_list("id", flat=True)[:CLAIM_BATCH]
+    )
+
+    for job_id in candidates:
+        # Compare-and-set: the UPDATE only matches if nobody claimed the job
+        # since we read it, so two workers can never both get it.
+        claimed = AgentJob.objects.filter(_claimable(now), id=job_id, attempts__lt=MAX_ATTEMPTS).update(
+            status=AgentJob.STATUS_RUNNING,
+            lease_owner=worker_id,
+            lease_expires_at=now + timedelta(seconds=lease_seconds),
+            attempts=F("attempts") + 1,
+            started_at=now,
+        )
+        if claimed:
+            return AgentJob.objects.select_related("message__conversation").get(id=job_id)
+
+    return None
+
+
+def renew_lease(job_id: int, worker_id: str, lease_seconds: float = LEASE_SECONDS) -> bool:
+    # Push the lease end forward, only while we still own the job.
+    # False: the lease expired and another worker took the job over.
+    return bool(
+        AgentJob.objects.filter(id=job_id, status=AgentJob.STATUS_RUNNING, lease_owner=worker_id).update(
+            lease_expires_at=timezone.now() + timedelta(seconds=lease_seconds)
+        )
+    )
+
+
+@contextmanager
+def lease_heartbeat(job: AgentJob, worker_id: str, lease_seconds: float = LEASE_SECONDS):
+    # Renew the job's lease in the background while the block runs, so a turn
+    # longer than the lease (several slow model calls + tools) isn't claimed
+    # and run a second time by another worker
+    stop = threading.Event()
+
+    def beat():
+        try:
+            while not stop.wait(lease_seconds / 3):
+                if not renew_lease(job.id, worker_id, lease_seconds):
+                    logger.warning("agent_job_lease_lost job_id=%s worker=%s", job.id, worker_id)
+                    return
+        except Exception:
+            logger.exception("agent_job_heartbeat_failed job_id=%s", job.id)
+        finally:
+            # The heartbeat thread has its own DB connection
+            connection.close()
+
+    thread = threading.Thread(target=beat, name=f"lease-{job.id}", daemon=True)
+    thread.start()
+    try:
+        yield
+    finally:
+        stop.set()
+        thread.join()
+
+
+def fail_abandoned_jobs() -> int:
+    # Jobs that used up all attempts and whose last lease expired are dead:
+    # mark them (and their messages) as failed so the UI stops waiting
+    now = timezone.now()
+    dead = AgentJob.objects.filter(
+        status=AgentJob.STATUS_RUNNING,
+        lease_expires_at__lt=now,
+        attempts__gte=MAX_ATTEMPTS,
+    )
+    count = 0
+    for job in dead.select_related("message__conversation"):
+        _finish(job, job.lease_owner, FAILED_TEXT, failed=True, error="lease expired too many times")
+        count += 1
+    return count
+
+
+def _finish(
+    job: AgentJob,
+    worker_id: str,
+    text: str,
+    failed: bool = False,
+    error: str = "",
+    route_info: dict | None = None,
+) -> bool:
+    now = timezone.now()
+    with transaction.atomic():
+        # Only the current lease owner may complete the job. If our lease
+        # expired and someone else picked the job up, drop our result.
+        updated = AgentJob.objects.filter(
+            id=job.id,
+            status=AgentJob.STATUS_RUNNING,
+            lease_owner=worker_id,
+        ).update(
+            status=AgentJob.STATUS_FAILED if failed else AgentJob.STATUS_DONE,
+            error=error,
+            finished_at=now,
+            lease_expires_at=None,
+        )
+        if not updated:
+            return False
+
+        Message.objects.filter(id=job.message_id).update(
+            content=text,
+            status=Message.STATUS_FAILED if failed else Message.STATUS_DONE,
+            model=(route_info or {}).get("model", ""),
+            routing=route_info or {},
+        )
+        job.message.conversation.message_updated(text)
+    return True
+
+
+def run_job(job: AgentJob, worker_id: str, lease_seconds: float = LEASE_SECONDS) -> None:
+    # Same timing breakdown as a web request (see core.tracing)
+    with start_trace("job", job_id=job.id, worker=worker_id), lease_heartbeat(job, worker_id, lease_seconds):
+        _run_job(job, worker_id)
+
+
+def _run_job(job: AgentJob, worker_id: str) -> None:
+    conv = job.message.conversation
+    route_info = {}
+    try:
+        # Only answer with the history up to this turn, not messages sent later
+        text = generate_reply(job.user_text, conv, before_message_id=job.message_id, route_info=route_info)
+    except Exception as exc:
+        logger.exception("agent_job_failed job_id=%s conv_id=%s attempt=%s", job.id, conv.id, job.attempts)
+        if job.attempts >= MAX_ATTEMPTS:
+            _finish(job, worker_id, FAILED_TEXT, failed=True, error=str(exc))
+        else:
+            # Put it back in the queue for another try
+            AgentJob.objects.filter(id=job.id, lease_owner=worker_id).update(
+                status=AgentJob.STATUS_QUEUED,
+                lease_owner="",
+                lease_expires_at=None,
+                error=str(exc),
+            )
+        return
+
+    if _finish(job, worker_id, text, route_info=route_info):
+        audit(
+            "assistant_reply",
+            user_id=conv.owner_id,
+            conversation_id=conv.id,
+            session_id=str(conv.session_id),
+            job_id=job.id,
+            reply_len=len(text),
+            model=route_info.get("model", ""),
+        )
+        # The reply is visible now; the summary for the next turns is worker time
+        summarize_history(conv)
+    else:
+        logger.warning("agent_job_lost_lease job_id=%s worker=%s", job.id, worker_id)
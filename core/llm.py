@@ -0,0 +1,211 @@
+# Process-wide LLM client registry.
+#
+# Building a ChatOllama (and its HTTP clients) and calling bind_tools() is not free:
+# every new client opens new HTTP connections and bind_tools() converts each tool to
+# a JSON schema again. We build them once per process (per backend and model) and
+# reuse them for every turn.
+#
+# With several Ollama servers (OLLAMA_BACKENDS) each call goes through the
+# backend pool in core.llm_pool: sticky per conversation, least busy otherwise,
+# failing over to the next server when one is unreachable.
+import asyncio
+import logging
+import threading
+import weakref
+
+import httpx
+from django.conf import settings
+from langchain_core.messages import HumanMessage
+from langchain_ollama import ChatOllama
+
+from .llm_pool import FAILOVER_ERRORS, Backend, get_pool, reset_pool, start_health_checks
+
+logger = logging.getLogger(__name__)
+
+# Sampling/context options shared by every chat turn
+# temperature: lower = more stable/deterministic output
+# num_ctx: max context window (how much past text model can consider)
+# num_predict: max tokens to generate for one model turn
+LLM_OPTIONS = {
+    "temperature": 0.2,
+    "num_ctx": 2048,
+    "num_predict": 256,
+}
+
+# (backend url, model, with tools) -> ChatOllama / model bound to our tools
+_clients: dict[tuple, object] = {}
+# Same, for async calls: event loop -> {key: client}. An async client is bound to
+# the loop it was first used on, and under WSGI (runserver) every async view runs
+# in its own short-lived loop, so each loop gets its own clients.
+_async_clients: weakref.WeakKeyDictionary = weakref.WeakKeyDictionary()
+_lock = threading.Lock()
+
+
+def _build_client(backend: Backend, model: str) -> ChatOllama:
+    # Keep a pool of open keep-alive connections to Ollama
+    # so each turn does not pay a new TCP handshake.
+    max_conn = getattr(settings, "OLLAMA_MAX_CONNECTIONS", 20)
+    limits = httpx.Limits(max_connections=max_conn, max_keepalive_connections=max_conn)
+    return ChatOllama(
+        model=model,
+        base_url=backend.url,
+        client_kwargs={"limits": limits},
+        # How long Ollama keeps the model loaded after this call
+        keep_alive=settings.OLLAMA_KEEP_ALIVE,
+        **LLM_OPTIONS,
+    )
+
+
+def _client(backend: Backend, model: str, with_tools: bool):
+    key = (backend.url, model, with_tools)
+    client = _clients.get(key)
+    if client is None:
+        with _lock:
+            client = _clients.get(key)
+            if client is None:
+                client = _build_client(backend, model)
+                if with_tools:
+                    # Tool schemas are computed here, once per model per process
+                    # (core.tools is imported here: it needs core.context, which needs us)
+                    from .tools import TOOLS
+
+                    client = client.bind_tools(TOOLS)
+                _clients[key] = client
+    return client
+
+
+def _aclient(backend: Backend, model: str, with_tools: bool):
+    loop = asyncio.get_running_loop()
+    key = (backend.url, model, with_tools)
+    with _lock:
+        clients = _async_clients.setdefault(loop, {})
+        client = clients.get(key)
+        if client is None:
+            client = _build_client(backend, model)
+            if with_tools:
+                from .tools import TOOLS
+
+                client = client.bind_tools(TOOLS)
+            clients[key] = client
+    return client
+
+
+class PooledChat:
+    # Looks like a ChatOllama for invoke/ainvoke/astream, but sends each call
+    # to a backend from the pool (see core.llm_pool)
+
+    def __init__(self, model: str, with_tools: bool, affinity: str | None = None):
+        self.model = model
+        self.with_tools = with_tools
+        self.affinity = affinity
+
+    def _candidates(self) -> list[Backend]:
+        return get_pool().candidates(self.affinity)
+
+    def invoke(self, msgs, **kwargs):
+        last_exc = None
+        for backend in self._candidates():
+            backend.begin()
+            ok = False
+            try:
+                resp = _client(backend, self.model, self.with_tools).invoke(msgs, **kwargs)
+                ok = True
+                return resp
+            except FAILOVER_ERRORS as exc:
+                backend.mark_failed(exc)
+                last_exc = exc
+                logger.warning("ollama_failover backend=%s model=%s: %s", backend.name, self.model, exc)
+            finally:
+                backend.end(ok)
+        raise last_exc
+
+    async def ainvoke(self, msgs, **kwargs):
+        last_exc = None
+        for backend in self._candidates():
+            backend.begin()
+            ok = False
+            try:
+                resp = await _aclient(backend, self.model, self.with_tools).ainvoke(msgs, **kwargs)
+                ok = True
+                return resp
+            except FAILOVER_ERRORS as exc:
+                backend.mark_failed(exc)
+                last_exc = exc
+                logger.warning("ollama_failover backend=%s model=%s: %s", backend.name, self.model, exc)
+            finally:
+                backend.end(ok)
+        raise last_exc
+
+    async def astream(self, msgs, **kwargs):
+        # Fails over only until the first chunk arrives:
+        # after that the caller already has part of the answer
+        last_exc = None
+        for backend in self._candidates():
+            backend.begin()
+            ok = False
+            started = False
+            try:
+                async for chunk in _aclient(backend, self.model, self.with_tools).astream(msgs, **kwargs):
+                    started = True
+                    yield chunk
+                ok = True
+                return
+            except FAILOVER_ERRORS as exc:
+                backend.mark_failed(exc)
+                if started:
+                    raise
+                last_exc = exc
+                logger.warning("ollama_failover backend=%s model=%s: %s", backend.name, self.model, exc)
+            finally:
+                backend.end(ok)
+        raise last_exc
+
+
+def get_llm(model: str | None = None, affinity: str | None = None) -> PooledChat:
+    # affinity: a key (the conversation's session_id) that keeps calls on one backend
+    return PooledChat(model or settings.OLLAMA_MODEL, with_tools=False, affinity=affinity)
+
+
+def get_llm_with_tools(model: str | None = None, affinity: str | None = None) -> PooledChat:
+    return PooledChat(model or settings.OLLAMA_MODEL, with_tools=True, affinity=affinity)
+
+
+def reset_clients() -> None:
+    # Drop cached clients (e.g. after changing OLLAMA_* settings in tests/benchmarks)
+    with _lock:
+        _clients.clear()
+        _async_clients.clear()
+    reset_pool()
+
+
+def warm_up(model: str | None = None, background: bool = True) -> None:
+    # Build the clients + tool schemas and ask every backend to load the model
+    # into memory, so the first real chat after a deploy does not pay the cold-start cost.
+    model = model or settings.OLLAMA_MODEL
+
+    def _run():
+        for backend in get_pool().backends:
+            try:
+                _client(backend, model, with_tools=True)
+                # A 1-token generation is enough to make Ollama load the weights
+                _client(backend, model, with_tools=False).invoke(
+                    [HumanMessage(content="hi")], options={**LLM_OPTIONS, "num_predict": 1}
+                )
+                logger.info("llm_warm_up backend=%s model=%s ok", backend.name, model)
+            except Exception as exc:
+                # Warm-up is best effort: the server must still start if Ollama is down
+                logger.warning("llm_warm_up backend=%s model=%s failed: %s", backend.name, model, exc)
+
+    if background:
+        threading.Thread(target=_run, name="llm-warm-up", daemon=True).start()
+    else:
+        _run()
+
+
+def warm_up_if_enabled() -> None:
+    # Web server startup (config.asgi / config.wsgi): start the backend health
+    # checks and, with OLLAMA_WARM_UP_ON_STARTUP, pre-build the LLM client and
+    # load the model in the background, so the first chat after a deploy is not slow
+    start_health_checks()
+    if settings.OLLAMA_WARM_UP_ON_STARTUP:
+        warm_up()
@@ -0,0 +1,262 @@
+# Cache of model responses.
+#
+# A lot of turns send exactly the same request (same model, options, system
+# prompt, history) e.g. "list my files" in a fresh conversation. We key each
+# model call on a hash of everything that can change the answer, including a
+# fingerprint of the user's sandbox, so answers that depended on file contents
+# stop matching as soon as the files change.
+#
+# Two tiers:
+# - an in-process LRU with TTL (always on when the cache is enabled)
+# - optionally a shared Django cache (LLM_CACHE["SHARED_ALIAS"], e.g. a file
+#   or database cache) so several workers/processes share hits
+import json
+import logging
+import threading
+import time
+from collections import OrderedDict
+
+import xxhash
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.core.cache import caches
+from langchain_core.messages import message_to_dict, messages_from_dict
+
+from .llm import LLM_OPTIONS
+from .metrics import REGISTRY
+from .quota import fingerprint as quota_fingerprint
+from .tracing import record_llm_call, span
+
+logger = logging.getLogger(__name__)
+
+# Bump when the key format changes so old shared entries stop matching
+KEY_VERSION = 1
+
+
+class LRUCache:
+    # Thread-safe LRU with a per-entry time to live
+
+    def __init__(self, max_entries: int, ttl: float):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._data = OrderedDict()  # key -> (expires_at, value)
+        self._lock = threading.Lock()
+        self.evictions = 0
+        self.expirations = 0
+
+    def get(self, key):
+        with self._lock:
+            item = self._data.get(key)
+            if item is None:
+                return None
+            expires_at, value = item
+            if expires_at < time.monotonic():
+                del self._data[key]
+                self.expirations += 1
+                return None
+            # Recently used entries move to the end, evictions take from the front
+            self._data.move_to_end(key)
+            return value
+
+    def set(self, key, value) -> None:
+        with self._lock:
+            self._data[key] = (time.monotonic() + self.ttl, value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.max_entries:
+                self._data.popitem(last=False)
+                self.evictions += 1
+
+    def clear(self) -> None:
+        with self._lock:
+            self._data.clear()
+
+    def __len__(self):
+        return len(self._data)
+
+
+class ResponseCache:
+    def __init__(self, max_entries: int, ttl: float, shared_alias: str | None = None):
+        self.ttl = ttl
+        self.memory = LRUCache(max_entries, ttl)
+        self.shared_alias = shared_alias
+        self._stats_lock = threading.Lock()
+        self.hits = 0
+        self.shared_hits = 0
+        self.misses = 0
+        self.stores = 0
+
+    def _count(self, name: str) -> None:
+        with self._stats_lock:
+            setattr(self, name, getattr(self, name) + 1)
+
+    def get(self, key: str):
+        data = self.memory.get(key)
+        if data is None and self.shared_alias:
+            try:
+                data = caches[self.shared_alias].get(f"llm:{key}")
+            except Exception as exc:
+                # A broken shared cache must not break chat
+                logger.warning("llm_cache_shared_get_failed: %s", exc)
+                data = None
+            if data is not None:
+                self.memory.set(key, data)
+                self._count("shared_hits")
+
+        if data is None:
+            self._count("misses")
+            return None
+        self._count("hits")
+        return messages_from_dict([data])[0]
+
+    def set(self, key: str, message) -> None:
+        data = message_to_dict(message)
+        self.memory.set(key, data)
+        if self.shared_alias:
+            try:
+                caches[self.shared_alias].set(f"llm:{key}", data, timeout=self.ttl)
+            except Exception as exc:
+                logger.warning("llm_cache_shared_set_failed: %s", exc)
+        self._count("stores")
+
+    # From async code: the shared tier can do DB/file I/O (not allowed / blocking
+    # on the event loop), so it runs in a thread. The memory tier alone doesn't.
+    async def aget(self, key: str):
+        if not self.shared_alias:
+            return self.get(key)
+        return await sync_to_async(self.get)(key)
+
+    async def aset(self, key: str, message) -> None:
+        if not self.shared_alias:
+            return self.set(key, message)
+        await sync_to_async(self.set)(key, message)
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "shared_hits": self.shared_hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / lookups, 4) if lookups else 0.0,
+            "stores": self.stores,
+            "entries": len(self.memory),
+            "evictions": self.memory.evictions,
+            "expirations": self.memory.expirations,
+        }
+
+
+_cache = None
+_cache_lock = threading.Lock()
+
+
+def get_response_cache() -> ResponseCache | None:
+    # The process-wide cache, or None when LLM_CACHE["ENABLED"] is off
+    global _cache
+    conf = settings.LLM_CACHE
+    if not conf.get("ENABLED"):
+        return None
+    if _cache is None:
+        with _cache_lock:
+            if _cache is None:
+                _cache = ResponseCache(
+                    max_entries=conf.get("MAX_ENTRIES", 512),
+                    ttl=conf.get("TTL_SECONDS", 600),
+                    shared_alias=conf.get("SHARED_ALIAS"),
+                )
+    return _cache
+
+
+# Cache counters on /metrics, copied from stats() at scrape time
+CACHE_STATS = REGISTRY.gauge("llm_cache", "Model response cache counters (see ResponseCache.stats).", ("stat",))
+
+
+def _collect_cache_stats() -> None:
+    if _cache is not None:
+        for name, value in _cache.stats().items():
+            CACHE_STATS.set(value, stat=name)
+
+
+REGISTRY.add_collector(_collect_cache_stats)
+
+
+def sandbox_fingerprint(user_id: int) -> str:
+    # Changes whenever a file in the user's sandbox is added, removed or changed:
+    # the usage row's totals and change counter (core.quota), one row read.
+    # Changes made outside the app count once a reconcile (fs_search, restores)
+    # has picked them up.
+    return quota_fingerprint(user_id)
+
+
+def _message_key_data(m) -> dict:
+    data = {"type": m.type, "content": m.content}
+    tool_calls = getattr(m, "tool_calls", None)
+    if tool_calls:
+        data["tool_calls"] = [{"name": c.get("name"), "args": c.get("args")} for c in tool_calls]
+    if getattr(m, "tool_call_id", None):
+        data["tool_call_id"] = m.tool_call_id
+    return data
+
+
+def cache_key(model: str, msgs: list, user_id: int, options: dict | None = None) -> str:
+    payload = {
+        "v": KEY_VERSION,
+        "model": model,
+        "options": options or LLM_OPTIONS,
+        # The system prompt is msgs[0], so it is part of the key too
+        "messages": [_message_key_data(m) for m in msgs],
+        "sandbox": sandbox_fingerprint(user_id),
+    }
+    raw = json.dumps(payload, sort_keys=True, default=str).encode("utf-8")
+    return xxhash.xxh3_128_hexdigest(raw)
+
+
+def cacheable(resp) -> bool:
+    # Don't keep broken answers around
+    if getattr(resp, "invalid_tool_calls", None):
+        return False
+    return bool(resp.content) or bool(getattr(resp, "tool_calls", None))
+
+
+def cached_invoke(llm, model: str, msgs: list, user_id: int):
+    # llm.invoke(msgs), answered from the cache when an identical request was seen
+    with span("llm", model=model) as attrs:
+        cache = get_response_cache()
+        if cache is None:
+            resp = llm.invoke(msgs)
+            record_llm_call(attrs, model, resp)
+            return resp
+
+        key = cache_key(model, msgs, user_id)
+        resp = cache.get(key)
+        if resp is not None:
+            record_llm_call(attrs, model, resp, cached=True)
+            return resp
+
+        resp = llm.invoke(msgs)
+        record_llm_call(attrs, model, resp)
+        if cacheable(resp):
+            cache.set(key, resp)
+        return resp
+
+
+async def acached_invoke(llm, model: str, msgs: list, user_id: int):
+    # cached_invoke for async code: the model call is awaited (llm.ainvoke),
+    # the cache key needs the DB (sandbox fingerprint) and the shared cache
+    # tier may too, so those run in a thread
+    with span("llm", model=model) as attrs:
+        cache = get_response_cache()
+        if cache is None:
+            resp = await llm.ainvoke(msgs)
+            record_llm_call(attrs, model, resp)
+            return resp
+
+        key = await sync_to_async(cache_key)(model, msgs, user_id)
+        resp = await cache.aget(key)
+        if resp is not None:
+            record_llm_call(attrs, model, resp, cached=True)
+            return resp
+
+        resp = await llm.ainvoke(msgs)
+        record_llm_call(attrs, model, resp)
+        if cacheable(resp):
+            await cache.aset(key, resp)
+        return resp
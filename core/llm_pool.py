@@ -0,0 +1,249 @@
+# Pool of Ollama servers.
+#
+# OLLAMA_BACKENDS lists the inference servers. Each model call goes to one of
+# them:
+#   - a conversation sticks to "its" backend (rendezvous hash of the
+#     conversation's session_id), so repeated turns hit the server that already
+#     has the prompt prefix in its KV cache
+#   - if that backend is down or much busier than the others, the call goes to
+#     the healthy backend with the fewest requests in flight
+#   - a connection error marks the backend down and the call fails over to
+#     the next one
+# A background thread checks /api/version on every backend and keeps the
+# models in OLLAMA_RESIDENT_MODELS loaded (Ollama unloads idle models after
+# keep_alive runs out). It is started by the server and the job workers
+# (start_health_checks), not by the first model call, so tests never run it.
+import logging
+import threading
+
+import httpx
+import xxhash
+from django.conf import settings
+
+from .metrics import REGISTRY
+
+logger = logging.getLogger(__name__)
+
+# Errors that mean "this server is unreachable", worth retrying elsewhere.
+# (The ollama client turns httpx.ConnectError into ConnectionError.)
+FAILOVER_ERRORS = (ConnectionError, httpx.TransportError)
+
+# A backend is marked down after this many failures in a row
+MAX_FAILURES = 2
+
+# The sticky backend is skipped when it has this many more requests in flight
+# than the least busy one (a warm KV cache isn't worth queueing behind others)
+AFFINITY_SLACK = 2
+
+HEALTH_TIMEOUT = 2.0
+
+# Loading a model can take minutes: done on its own thread, not in the check round
+MODEL_LOAD_TIMEOUT = 120
+
+BACKEND_HEALTHY = REGISTRY.gauge("ollama_backend_healthy", "1 if the backend passed its last check.", ("backend",))
+BACKEND_OUTSTANDING = REGISTRY.gauge("ollama_backend_outstanding", "Model calls in flight.", ("backend",))
+BACKEND_REQUESTS = REGISTRY.counter("ollama_backend_requests_total", "Model calls sent.", ("backend", "outcome"))
+
+
+class Backend:
+    def __init__(self, name: str, url: str):
+        self.name = name
+        self.url = url.rstrip("/")
+        self.healthy = True
+        self.failures = 0
+        self.outstanding = 0
+        self.last_error = ""
+        self._lock = threading.Lock()
+
+    def begin(self) -> None:
+        with self._lock:
+            self.outstanding += 1
+
+    def end(self, ok: bool) -> None:
+        with self._lock:
+            self.outstanding -= 1
+            if ok:
+                self.failures = 0
+        BACKEND_REQUESTS.inc(backend=self.name, outcome="ok" if ok else "error")
+
+    def mark_failed(self, exc: Exception) -> None:
+        with self._lock:
+            self.failures += 1
+            self.last_error = str(exc)
+            if self.failures >= MAX_FAILURES and self.healthy:
+                self.healthy = False
+                logger.warning("ollama_backend_down backend=%s: %s", self.name, exc)
+
+    def mark_down(self, exc: Exception) -> None:
+        # Failed health check: down straight away
+        with self._lock:
+            self.failures = max(self.failures + 1, MAX_FAILURES)
+            self.last_error = str(exc)
+            if self.healthy:
+                self.healthy = False
+                logger.warning("ollama_backend_down backend=%s: %s", self.name, exc)
+
+    def mark_healthy(self) -> None:
+        with self._lock:
+            if not self.healthy:
+                logger.info("ollama_backend_up backend=%s", self.name)
+            self.healthy = True
+            self.failures = 0
+
+    def __repr__(self):
+        return f"Backend({self.name}, {self.url})"
+
+
+def _affinity_score(key: str, backend: Backend) -> int:
+    # Rendezvous hashing: every key has a stable preferred backend, and adding
+    # or removing a backend only moves the keys that belonged to it
+    return xxhash.xxh64_intdigest(f"{key}|{backend.name}".encode())
+
+
+class BackendPool:
+    def __init__(self, backends: list[Backend]):
+        self.backends = backends
+        self.by_name = {b.name: b for b in backends}
+        # (backend name, model) loads in flight
+        self._loading = set()
+        self._loading_lock = threading.Lock()
+
+    def candidates(self, affinity: str | None = None) -> list[Backend]:
+        # Backends to try, best first. Down backends come last (their status
+        # may be stale, trying them beats failing the request outright).
+        healthy = [b for b in self.backends if b.healthy]
+        down = [b for b in self.backends if not b.healthy]
+        healthy.sort(key=lambda b: b.outstanding)
+
+        if affinity and healthy:
+            sticky = max(healthy, key=lambda b: _affinity_score(affinity, b))
+            if sticky.outstanding - healthy[0].outstanding <= AFFINITY_SLACK:
+                healthy.remove(sticky)
+                healthy.insert(0, sticky)
+        return healthy + down
+
+    def check(self) -> None:
+        # One health check round over all backends
+        for backend in self.backends:
+            try:
+                httpx.get(f"{backend.url}/api/version", timeout=HEALTH_TIMEOUT).raise_for_status()
+            except Exception as exc:
+                backend.mark_down(exc)
+                continue
+            backend.mark_healthy()
+            self._keep_resident(backend)
+
+    def _keep_resident(self, backend: Backend) -> None:
+        models = [m for m in getattr(settings, "OLLAMA_RESIDENT_MODELS", []) if m]
+        if not models:
+            return
+        try:
+            resp = httpx.get(f"{backend.url}/api/ps", timeout=HEALTH_TIMEOUT)
+            resp.raise_for_status()
+            running = resp.json().get("models", [])
+            loaded = {m.get("name") for m in running} | {m.get("model") for m in running}
+        except Exception as exc:
+            logger.debug("ollama_ps_failed backend=%s: %s", backend.name, exc)
+            return
+        for model in models:
+            if model in loaded:
+                continue
+            with self._loading_lock:
+                if (backend.name, model) in self._loading:
+                    continue
+                self._loading.add((backend.name, model))
+            threading.Thread(
+                target=self._load_model, args=(backend, model), name="ollama-load", daemon=True
+            ).start()
+
+    def _load_model(self, backend: Backend, model: str) -> None:
+        # A generate call without a prompt just loads the model
+        try:
+            httpx.post(
+                f"{backend.url}/api/generate",
+                json={"model": model, "keep_alive": settings.OLLAMA_KEEP_ALIVE},
+                timeout=MODEL_LOAD_TIMEOUT,
+            )
+            logger.info("ollama_model_loaded backend=%s model=%s", backend.name, model)
+        except Exception as exc:
+            logger.warning("ollama_model_load_failed backend=%s model=%s: %s", backend.name, model, exc)
+        finally:
+            with self._loading_lock:
+                self._loading.discard((backend.name, model))
+
+    def collect_metrics(self) -> None:
+        for b in self.backends:
+            BACKEND_HEALTHY.set(1 if b.healthy else 0, backend=b.name)
+            BACKEND_OUTSTANDING.set(b.outstanding, backend=b.name)
+
+
+def backends_from_settings() -> list[Backend]:
+    # OLLAMA_BACKENDS = [{"name": ..., "url": ...}], empty = just OLLAMA_BASE_URL
+    configured = getattr(settings, "OLLAMA_BACKENDS", None) or []
+    if not configured:
+        return [Backend("default", settings.OLLAMA_BASE_URL)]
+    return [Backend(b.get("name") or b["url"], b["url"]) for b in configured]
+
+
+_pool = None
+_pool_lock = threading.Lock()
+_stop_checks = None
+
+
+def _health_loop(stop: threading.Event, interval: float) -> None:
+    while not stop.wait(interval):
+        try:
+            get_pool().check()
+        except Exception:
+            logger.exception("ollama_health_check_failed")
+
+
+def get_pool() -> BackendPool:
+    global _pool
+    if _pool is None:
+        with _pool_lock:
+            if _pool is None:
+                _pool = BackendPool(backends_from_settings())
+    return _pool
+
+
+def start_health_checks() -> bool:
+    # Start the background health checker (once per process). Called at server
+    # and worker startup; False if OLLAMA_HEALTH_CHECK_SECONDS is 0 or it runs already.
+    global _stop_checks
+    interval = getattr(settings, "OLLAMA_HEALTH_CHECK_SECONDS", 0)
+    with _pool_lock:
+        if not interval or _stop_checks is not None:
+            return False
+        _stop_checks = threading.Event()
+        threading.Thread(
+            target=_health_loop,
+            args=(_stop_checks, interval),
+            name="ollama-health",
+            daemon=True,
+        ).start()
+    return True
+
+
+def stop_health_checks() -> None:
+    global _stop_checks
+    with _pool_lock:
+        if _stop_checks is not None:
+            _stop_checks.set()
+        _stop_checks = None
+
+
+def _collect_pool_metrics() -> None:
+    if _pool is not None:
+        _pool.collect_metrics()
+
+
+REGISTRY.add_collector(_collect_pool_metrics)
+
+
+def reset_pool() -> None:
+    # Forget the backends (e.g. after changing OLLAMA_* settings). A running
+    # health checker moves on to the new pool at its next round.
+    global _pool
+    with _pool_lock:
+        _pool = None
@@ -0,0 +1,131 @@
+import io
+import json
+import re
+from datetime import datetime, timedelta, timezone
+from pathlib import Path
+
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.core.management.base import BaseCommand, CommandError
+
+from core.audit import FILE_PREFIX, log_files, parse_file_start
+
+# "30m", "2h", "7d" = that long ago
+RELATIVE_RE = re.compile(r"^(\d+)([smhd])$")
+UNITS = {"s": "seconds", "m": "minutes", "h": "hours", "d": "days"}
+
+
+def parse_time(value: str | None) -> datetime | None:
+    if not value:
+        return None
+    match = RELATIVE_RE.match(value)
+    if match:
+        return datetime.now(timezone.utc) - timedelta(**{UNITS[match.group(2)]: int(match.group(1))})
+    try:
+        when = datetime.fromisoformat(value.replace("Z", "+00:00"))
+    except ValueError:
+        raise CommandError(f"invalid time {value!r} (use ISO 8601 or e.g. 30m, 2h, 7d)")
+    return when if when.tzinfo else when.replace(tzinfo=timezone.utc)
+
+
+def read_lines(path: Path):
+    # Raw (bytes) lines of one log file, plain or zstd compressed
+    if path.name.endswith(".zst"):
+        import zstandard
+
+        with path.open("rb") as f:
+            # The writer appends one frame per batch
+            reader = zstandard.ZstdDecompressor().stream_reader(f, read_across_frames=True)
+            yield from io.BufferedReader(reader)
+    else:
+        with path.open("rb") as f:
+            yield from f
+
+
+class Command(BaseCommand):
+    help = "Search the audit log (core.audit) by user, conversation, event and time range. Prints JSON lines."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--user", help="User id or username.")
+        parser.add_argument("--conversation", type=int, help="Conversation id.")
+        parser.add_argument("--event", action="append", help="Event name (repeat for several).")
+        parser.add_argument("--since", help="ISO time or age like 30m, 2h, 7d.")
+        parser.add_argument("--until", help="ISO time or age like 30m, 2h, 7d.")
+        parser.add_argument("--limit", type=int, default=0, help="Stop after this many records (0 = all).")
+        parser.add_argument("--count", action="store_true", help="Only print the number of matches.")
+        parser.add_argument("--dir", help="Log directory (default AUDIT_LOG['DIR']).")
+
+    def handle(self, *args, **options):
+        directory = Path(options["dir"] or settings.AUDIT_LOG["DIR"])
+        since = parse_time(options["since"])
+        until = parse_time(options["until"])
+        user_id = self._user_id(options["user"])
+        conversation_id = options["conversation"]
+        events = set(options["event"] or [])
+        limit = options["limit"]
+
+        # Cheap byte checks before parsing a line (the writer uses compact JSON);
+        # they can only give false positives, the parsed record is checked again
+        needles = []
+        if user_id is not None:
+            needles.append(b'"user_id":%d' % user_id)
+        if conversation_id is not None:
+            needles.append(b'"conversation_id":%d' % conversation_id)
+
+        matched = 0
+        for path in self._files(directory, since, until):
+            for line in read_lines(path):
+                if any(n not in line for n in needles):
+                    continue
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    # A line cut short by a crash
+                    continue
+                if user_id is not None and record.get("user_id") != user_id:
+                    continue
+                if conversation_id is not None and record.get("conversation_id") != conversation_id:
+                    continue
+                if events and record.get("event") not in events:
+                    continue
+                if since or until:
+                    ts = parse_time(record.get("ts"))
+                    if (since and ts < since) or (until and ts > until):
+                        continue
+                matched += 1
+                if not options["count"]:
+                    self.stdout.write(line.decode("utf-8").rstrip("\n"))
+                if limit and matched >= limit:
+                    break
+            if limit and matched >= limit:
+                break
+
+        if options["count"]:
+            self.stdout.write(str(matched))
+
+    def _user_id(self, value: str | None) -> int | None:
+        if not value:
+            return None
+        if value.isdigit():
+            return int(value)
+        user = get_user_model().objects.filter(username=value).first()
+        if user is None:
+            raise CommandError(f"no user {value!r}")
+        return user.id
+
+    def _files(self, directory: Path, since: datetime | None, until: datetime | None) -> list[Path]:
+        # A file holds records from its start time (in the name) to its last write (mtime),
+        # files entirely outside the time range are not opened
+        files = []
+        for path in log_files(directory):
+            start = parse_file_start(path.name)
+            if until and start > until:
+                continue
+            if since:
+                last_write = datetime.fromtimestamp(path.stat().st_mtime, timezone.utc)
+                if last_write < since:
+                    continue
+            files.append(path)
+        if not files and not directory.is_dir():
+            self.stderr.write(f"no {FILE_PREFIX}* files in {directory}")
+        return files
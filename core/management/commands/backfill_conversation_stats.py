@@ -0,0 +1,54 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.db.models import Count, Max, OuterRef, Subquery
+from django.db.models.functions import Coalesce
+
+from core.models import Conversation, Message, make_preview, make_title
+
+
+class Command(BaseCommand):
+    help = "Fill in Conversation title/preview/message_count/last_message_at from existing messages."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--batch-size", type=int, default=500)
+
+    def handle(self, *args, **options):
+        batch_size = options["batch_size"]
+
+        # First user message (title) and newest non-empty message (preview) per conversation
+        first_user = Message.objects.filter(conversation=OuterRef("pk"), role="user").order_by("created_at", "id")
+        last_text = Message.objects.filter(conversation=OuterRef("pk")).exclude(content="").order_by("-created_at", "-id")
+
+        last_id = 0
+        total = 0
+        while True:
+            # Walk conversations by id in batches, every aggregate comes from one query per batch
+            batch = list(
+                Conversation.objects.filter(id__gt=last_id)
+                .order_by("id")
+                .annotate(
+                    n_messages=Count("messages"),
+                    newest=Coalesce(Max("messages__created_at"), "created_at"),
+                    first_user_text=Subquery(first_user.values("content")[:1]),
+                    last_text=Subquery(last_text.values("content")[:1]),
+                )[:batch_size]
+            )
+            if not batch:
+                break
+
+            for conv in batch:
+                conv.message_count = conv.n_messages
+                conv.last_message_at = conv.newest
+                conv.title = make_title(conv.first_user_text or "")
+                conv.preview = make_preview(conv.last_text or "")
+
+            with transaction.atomic():
+                Conversation.objects.bulk_update(
+                    batch, ["message_count", "last_message_at", "title", "preview"]
+                )
+
+            last_id = batch[-1].id
+            total += len(batch)
+            self.stdout.write(f"Updated {total} conversations...")
+
+        self.stdout.write(self.style.SUCCESS(f"Done. {total} conversations backfilled."))
@@ -0,0 +1,115 @@
+import json
+import platform
+import subprocess
+from datetime import datetime, timezone
+
+import django
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from core.bench.fake_ollama import FakeOllamaServer
+from core.bench.runner import bench_database, bench_environment, run_load, scenarios, seed_sandbox
+
+
+def _git_revision() -> str:
+    try:
+        out = subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            cwd=settings.BASE_DIR,
+            capture_output=True,
+            text=True,
+            timeout=5,
+        )
+        return out.stdout.strip()
+    except Exception:
+        return ""
+
+
+class Command(BaseCommand):
+    help = (
+        "Benchmark the chat and /api/fs/* paths against a local fake Ollama server, "
+        "in a throwaway database and sandbox folder."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--scenarios",
+            default="chat_view,generate_reply,fs_list,fs_read,fs_write,fs_search",
+            help="Comma separated scenario names.",
+        )
+        parser.add_argument("--requests", type=int, default=50, help="Requests per scenario.")
+        parser.add_argument("--concurrency", type=int, default=4, help="Parallel clients.")
+        parser.add_argument("--latency", type=float, default=0.05, help="Fake model time to first token (s).")
+        parser.add_argument("--token-rate", type=float, default=200.0, help="Fake model tokens per second.")
+        parser.add_argument("--reply-tokens", type=int, default=40, help="Tokens per fake text reply.")
+        parser.add_argument(
+            "--tool-calls",
+            default="fs_list",
+            help="Comma separated tools the fake model calls on each turn ('' for none).",
+        )
+        parser.add_argument("--files", type=int, default=50, help="Files to put in the benchmark sandbox.")
+        parser.add_argument("--cache", action="store_true", help="Keep the LLM response cache on.")
+        parser.add_argument("--output", help="Write the JSON results to this file.")
+
+    def handle(self, *args, **options):
+        names = [n.strip() for n in options["scenarios"].split(",") if n.strip()]
+        tool_calls = [{"name": n.strip(), "args": {}} for n in options["tool_calls"].split(",") if n.strip()]
+
+        server = FakeOllamaServer(
+            latency=options["latency"],
+            token_rate=options["token_rate"],
+            reply_tokens=options["reply_tokens"],
+            tool_calls=tool_calls,
+        )
+
+        results = {}
+        with bench_database(), server, bench_environment(server.base_url, use_cache=options["cache"]) as user:
+            paths = seed_sandbox(user, max(1, options["files"]))
+            available = scenarios(user, paths)
+            unknown = [n for n in names if n not in available]
+            if unknown:
+                raise CommandError(f"unknown scenarios: {', '.join(unknown)} (have: {', '.join(available)})")
+
+            for name in names:
+                self.stdout.write(f"Running {name} ({options['requests']} requests x {options['concurrency']} clients)...")
+                results[name] = run_load(available[name], options["requests"], options["concurrency"])
+                r = results[name]
+                self.stdout.write(
+                    f"  p50={r['p50_ms']}ms p95={r['p95_ms']}ms p99={r['p99_ms']}ms "
+                    f"rps={r['throughput_rps']} queries={r['queries_mean']} errors={r['errors']}"
+                )
+
+            model_requests = server.requests
+
+        report = {
+            "meta": {
+                "timestamp": datetime.now(timezone.utc).isoformat(),
+                "git_revision": _git_revision(),
+                "python": platform.python_version(),
+                "django": django.get_version(),
+                "db_vendor": settings.DATABASES["default"]["ENGINE"],
+                "fake_model_requests": model_requests,
+                "config": {
+                    k: options[k]
+                    for k in (
+                        "requests",
+                        "concurrency",
+                        "latency",
+                        "token_rate",
+                        "reply_tokens",
+                        "tool_calls",
+                        "files",
+                        "cache",
+                    )
+                },
+            },
+            "results": results,
+        }
+
+        text = json.dumps(report, indent=2)
+        if options["output"]:
+            with open(options["output"], "w", encoding="utf-8") as f:
+                f.write(text + "\n")
+            self.stdout.write(self.style.SUCCESS(f"Results written to {options['output']}"))
+        else:
+            self.stdout.write(text)
@@ -0,0 +1,55 @@
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from core.fs_cas import get_store, reachable_objects
+
+
+class Command(BaseCommand):
+    help = (
+        "Delete objects of the content-addressed sandbox storage (SANDBOX_STORAGE['BACKEND'] = 'cas') "
+        "that no user head or snapshot uses any more."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--grace",
+            type=int,
+            default=3600,
+            help="Keep objects written in the last N seconds (a write may not have saved its head yet).",
+        )
+        parser.add_argument("--dry-run", action="store_true", help="Only report what would be deleted.")
+
+    def handle(self, *args, **options):
+        store = get_store()
+        cutoff = time.time() - options["grace"]
+        # Objects are only read after the walk: anything written meanwhile is
+        # younger than the grace period
+        keep = reachable_objects()
+
+        deleted = 0
+        freed = 0
+        for digest, path in store.iter_objects():
+            if digest in keep:
+                continue
+            try:
+                st = path.stat()
+            except FileNotFoundError:
+                continue
+            if st.st_mtime > cutoff:
+                continue
+            deleted += 1
+            freed += st.st_size
+            if not options["dry_run"]:
+                path.unlink(missing_ok=True)
+
+        # Temp files left by crashed writes
+        for path in store.tmp.iterdir():
+            if path.stat().st_mtime <= cutoff and not options["dry_run"]:
+                path.unlink(missing_ok=True)
+
+        verb = "Would delete" if options["dry_run"] else "Deleted"
+        self.stdout.write(
+            self.style.SUCCESS(f"{verb} {deleted} objects ({freed} bytes), {len(keep)} in use in {settings.SANDBOX_STORAGE['DIR']}.")
+        )
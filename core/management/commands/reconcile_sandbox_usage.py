@@ -0,0 +1,32 @@
+from pathlib import Path
+
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.core.management.base import BaseCommand
+
+from core.models import SandboxUsage
+from core.quota import reconcile_usage
+
+
+class Command(BaseCommand):
+    help = "Recount users' sandbox bytes/files from the disk (fixes drift in the quota counters)."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--user", type=int, action="append", help="Only this user id (repeatable).")
+
+    def handle(self, *args, **options):
+        user_ids = options["user"] or self._users_with_sandbox()
+        for user_id in user_ids:
+            usage = reconcile_usage(user_id)
+            if options["verbosity"] > 1:
+                self.stdout.write(f"user {user_id}: {usage['bytes']} bytes in {usage['files']} files")
+        self.stdout.write(self.style.SUCCESS(f"Done. {len(user_ids)} users reconciled."))
+
+    def _users_with_sandbox(self) -> list[int]:
+        # Users with a sandbox folder or a usage row (others have nothing to count)
+        root = Path(settings.FILE_SANDBOX_ROOT)
+        ids = set(SandboxUsage.objects.values_list("owner_id", flat=True))
+        if root.is_dir():
+            ids.update(int(p.name) for p in root.iterdir() if p.is_dir() and p.name.isdigit())
+        # Folders of deleted users are skipped
+        return list(get_user_model().objects.filter(id__in=ids).order_by("id").values_list("id", flat=True))
@@ -0,0 +1,71 @@
+import os
+import socket
+import threading
+import time
+
+from django.core.management.base import BaseCommand
+from django.db import close_old_connections, connection
+
+from core.jobs import claim_job, fail_abandoned_jobs, run_job
+from core.llm_pool import start_health_checks
+
+
+class Command(BaseCommand):
+    help = "Run a pool of workers that process queued chat replies (AgentJob rows)."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--workers", type=int, default=4, help="Number of worker threads.")
+        parser.add_argument("--lease", type=int, default=300, help="Seconds a claimed job stays reserved.")
+        parser.add_argument("--poll", type=float, default=1.0, help="Seconds to sleep when the queue is empty.")
+        parser.add_argument("--once", action="store_true", help="Exit when the queue is empty.")
+
+    def handle(self, *args, **options):
+        # Keep the Ollama backends' status (and resident models) fresh for the workers
+        start_health_checks()
+        stop = threading.Event()
+        base_id = f"{socket.gethostname()}:{os.getpid()}"
+
+        def worker(n):
+            worker_id = f"{base_id}:{n}"
+            try:
+                while not stop.is_set():
+                    # Drop DB connections that went stale while we were idle/busy
+                    close_old_connections()
+                    job = claim_job(worker_id, lease_seconds=options["lease"])
+                    if job is None:
+                        if options["once"]:
+                            return
+                        stop.wait(options["poll"])
+                        continue
+
+                    self.stdout.write(f"{worker_id} running job {job.id}")
+                    run_job(job, worker_id, lease_seconds=options["lease"])
+            finally:
+                # Each thread has its own DB connection
+                connection.close()
+
+        threads = [
+            threading.Thread(target=worker, args=(n,), name=f"agent-worker-{n}", daemon=True)
+            for n in range(options["workers"])
+        ]
+        for t in threads:
+            t.start()
+
+        self.stdout.write(self.style.SUCCESS(f"Started {len(threads)} workers ({base_id})."))
+
+        try:
+            while any(t.is_alive() for t in threads):
+                # The main thread's connection sits idle between rounds too
+                close_old_connections()
+                # Housekeeping: give up on jobs that keep losing their worker
+                failed = fail_abandoned_jobs()
+                if failed:
+                    self.stdout.write(self.style.WARNING(f"Marked {failed} abandoned jobs as failed."))
+                time.sleep(max(options["poll"], 1.0))
+        except KeyboardInterrupt:
+            self.stdout.write("Stopping workers (finishing current jobs)...")
+            stop.set()
+            for t in threads:
+                t.join()
+
+        self.stdout.write(self.style.SUCCESS("Done."))
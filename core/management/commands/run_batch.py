@@ -0,0 +1,82 @@
+import json
+from pathlib import Path
+
+from django.core.management.base import BaseCommand, CommandError
+
+from core.batch import run_batch
+
+
+class Command(BaseCommand):
+    help = (
+        "Run agent turns for every {user, prompt, conversation} record of a JSONL file "
+        "and append the replies to a JSONL output file (see core.batch)."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("input", help="JSONL file, one record per line.")
+        parser.add_argument("--output", required=True, help="JSONL results file (also the checkpoint for --resume).")
+        parser.add_argument("--workers", type=int, default=4, help="Records run at once.")
+        parser.add_argument(
+            "--pool",
+            choices=["thread", "process"],
+            default="thread",
+            help="Run the workers as threads (the model calls are I/O) or as separate processes.",
+        )
+        parser.add_argument("--resume", action="store_true", help="Skip the records already in --output.")
+        parser.add_argument("--retry-errors", action="store_true", help="With --resume, run failed records again.")
+        parser.add_argument("--limit", type=int, help="Run at most N records.")
+        parser.add_argument("--progress-every", type=int, default=100, help="Print progress every N records.")
+        parser.add_argument("--stats", help="Also write the final stats as JSON to this file.")
+
+    def handle(self, *args, **options):
+        if not Path(options["input"]).is_file():
+            raise CommandError(f"No such file: {options['input']}")
+        if options["workers"] < 1:
+            raise CommandError("--workers must be at least 1")
+        output = Path(options["output"])
+        if output.exists() and output.stat().st_size and not options["resume"]:
+            raise CommandError(f"{output} already has results, pass --resume to continue it (or remove it).")
+
+        every = max(1, options["progress_every"])
+
+        def progress(result, stats):
+            if result.get("error"):
+                self.stderr.write(f"line {result['line']}: {result['error']}")
+            finished = stats.ok + stats.errors
+            if finished % every == 0:
+                s = stats.summary()
+                self.stdout.write(
+                    f"{finished} records ({s['errors']} errors), {s['throughput_rps']}/s, "
+                    f"p50 {s['p50_ms']} ms, p95 {s['p95_ms']} ms"
+                )
+
+        stats = run_batch(
+            options["input"],
+            output,
+            workers=options["workers"],
+            pool=options["pool"],
+            resume=options["resume"],
+            retry_errors=options["retry_errors"],
+            limit=options["limit"],
+            on_result=progress,
+        )
+
+        if options["stats"]:
+            Path(options["stats"]).write_text(json.dumps(stats, indent=2))
+
+        self.stdout.write(
+            f"records: {stats['records']} ({stats['ok']} ok, {stats['errors']} errors, "
+            f"{stats['skipped']} already done)"
+        )
+        self.stdout.write(f"wall: {stats['wall_s']} s, throughput: {stats['throughput_rps']} records/s")
+        self.stdout.write(
+            f"latency: p50 {stats['p50_ms']} ms, p95 {stats['p95_ms']} ms, p99 {stats['p99_ms']} ms, "
+            f"mean {stats['mean_ms']} ms, max {stats['max_ms']} ms"
+        )
+        if stats["models"]:
+            self.stdout.write("models: " + ", ".join(f"{m} {n}" for m, n in sorted(stats["models"].items())))
+
+        if stats["interrupted"]:
+            self.stdout.write(self.style.WARNING(f"Interrupted, continue with --resume --output {output}"))
+        else:
+            self.stdout.write(self.style.SUCCESS("Done."))
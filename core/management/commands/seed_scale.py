@@ -0,0 +1,74 @@
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+
+from core.bench.seed import Seeder, rate
+
+
+class Command(BaseCommand):
+    help = (
+        "Create production-sized fake data: N users with M conversations of K messages each "
+        "and optional sandbox trees (see core.bench.seed). Use seed_users for the demo logins."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--users", type=int, default=100, help="Users to create.")
+        parser.add_argument("--conversations", type=int, default=20, help="Conversations per user (mean).")
+        parser.add_argument("--messages", type=int, default=12, help="Messages per conversation (mean).")
+        parser.add_argument(
+            "--spread",
+            type=float,
+            default=0.6,
+            help="Log-normal sigma of the per-user/per-conversation counts (0 = exactly the mean).",
+        )
+        parser.add_argument("--days", type=int, default=365, help="Spread the dates over the last N days.")
+        parser.add_argument("--files", type=int, default=0, help="Sandbox files per user.")
+        parser.add_argument("--depth", type=int, default=2, help="Sandbox folder depth.")
+        parser.add_argument("--fanout", type=int, default=3, help="Subfolders per sandbox folder.")
+        parser.add_argument("--file-bytes", type=int, default=2048, help="Median sandbox file size.")
+        parser.add_argument("--prefix", default="load", help="Username prefix (prefix000000, prefix000001, ...).")
+        parser.add_argument("--password", default="user12345", help="Password of every generated user.")
+        parser.add_argument("--batch-size", type=int, default=20000, help="Rows per transaction.")
+        parser.add_argument("--seed", type=int, help="Random seed, for the same data on every run.")
+
+    def handle(self, *args, **options):
+        for name in ("users", "conversations", "messages", "files", "depth", "fanout"):
+            if options[name] < 0:
+                raise CommandError(f"--{name} can't be negative")
+        if options["messages"] < 1 or options["file_bytes"] < 1:
+            raise CommandError("--messages and --file-bytes must be at least 1")
+
+        seeder = Seeder(
+            conversations=options["conversations"],
+            messages=options["messages"],
+            spread=options["spread"],
+            days=options["days"],
+            batch_size=options["batch_size"],
+            seed=options["seed"],
+            log=self.stdout.write,
+        )
+
+        started = time.perf_counter()
+        user_ids = seeder.create_users(options["prefix"], options["users"], options["password"])
+        skipped = options["users"] - len(user_ids)
+        if skipped:
+            self.stdout.write(self.style.WARNING(f"{skipped} users already existed, left as they are."))
+        self.stdout.write(f"users: {rate(len(user_ids), started)}")
+
+        started = time.perf_counter()
+        seeder.create_conversations(user_ids)
+        self.stdout.write(
+            f"conversations: {seeder.created['conversations']}, messages: {rate(seeder.created['messages'], started)}"
+        )
+
+        if options["files"]:
+            started = time.perf_counter()
+            for n, user_id in enumerate(user_ids, start=1):
+                seeder.create_sandbox(
+                    user_id, options["files"], options["depth"], options["fanout"], options["file_bytes"]
+                )
+                if n % 100 == 0:
+                    self.stdout.write(f"sandboxes: {n}/{len(user_ids)}")
+            self.stdout.write(f"files: {rate(seeder.created['files'], started)}, {seeder.created['bytes']} bytes")
+
+        self.stdout.write(self.style.SUCCESS("Done."))
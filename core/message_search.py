@@ -0,0 +1,173 @@
+# Full-text search over chat messages.
+#
+# `content LIKE '%word%'` has to read every message, so it gets slow once the
+# message table is large. Instead:
+#   - SQLite: an FTS5 table (core_message_fts) indexes Message.content. It is an
+#     "external content" table (the text stays in core_message only) kept in sync
+#     by triggers on insert/update/delete (see migration 0008_message_search)
+#   - PostgreSQL: a GIN index on to_tsvector('simple', content), which Postgres
+#     keeps up to date by itself
+#   - any other database (or SQLite built without FTS5): plain icontains
+# Used by the per-user search endpoint (/api/chat/search/) and the admin.
+import re
+from datetime import timezone as dt_timezone
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.db import connection
+from django.db.models.expressions import RawSQL
+from django.utils import timezone
+
+from .models import Message
+
+FTS_TABLE = "core_message_fts"
+
+# Highlight markers around matched words in snippets (plain text, safe in JSON)
+SNIPPET_START = "["
+SNIPPET_END = "]"
+# Roughly how many words a snippet shows
+SNIPPET_WORDS = 16
+
+# At most this many query words are used
+MAX_TERMS = 8
+
+WORD_RE = re.compile(r"\w+", re.UNICODE)
+
+
+def _terms(query: str) -> list[str]:
+    return WORD_RE.findall(query or "")[:MAX_TERMS]
+
+
+def fts_query(query: str) -> str:
+    # User text -> FTS5 query: every word must match, the last one as a prefix
+    # (so results show up while typing). Words are quoted, so FTS5 operators
+    # (AND, NEAR, *, ...) in the user text are just words.
+    terms = [f'"{t}"' for t in _terms(query)]
+    if terms:
+        terms[-1] += "*"
+    return " ".join(terms)
+
+
+def backend() -> str:
+    # "fts5", "postgres" or "like"
+    if connection.vendor == "postgresql":
+        return "postgres"
+    if connection.vendor == "sqlite" and _has_fts_table():
+        return "fts5"
+    return "like"
+
+
+def _has_fts_table() -> bool:
+    with connection.cursor() as cursor:
+        cursor.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = %s", [FTS_TABLE])
+        return cursor.fetchone() is not None
+
+
+def matching(queryset, query: str):
+    # Filter a Message queryset down to messages matching `query` (for the admin:
+    # no ranking, but composes with the admin's own filters and ordering)
+    terms = _terms(query)
+    if not terms:
+        return queryset.none()
+    kind = backend()
+    if kind == "fts5":
+        ids = RawSQL(f"SELECT rowid FROM {FTS_TABLE} WHERE {FTS_TABLE} MATCH %s", [fts_query(query)])
+        return queryset.filter(pk__in=ids)
+    if kind == "postgres":
+        ids = RawSQL(
+            "SELECT id FROM core_message WHERE to_tsvector('simple', content) @@ plainto_tsquery('simple', %s)",
+            [" ".join(terms)],
+        )
+        return queryset.filter(pk__in=ids)
+    for term in terms:
+        queryset = queryset.filter(content__icontains=term)
+    return queryset
+
+
+def _row(message_id, conversation_id, title, role, created_at, snippet, rank) -> dict:
+    # Raw SQLite rows have naive datetimes (stored in UTC)
+    if settings.USE_TZ and timezone.is_naive(created_at):
+        created_at = timezone.make_aware(created_at, dt_timezone.utc)
+    return {
+        "message_id": message_id,
+        "conversation_id": conversation_id,
+        "conversation_title": title,
+        "role": role,
+        "created_at": created_at.isoformat(),
+        "snippet": snippet,
+        "rank": round(float(rank), 4),
+    }
+
+
+def _search_fts5(user_id: int, query: str, limit: int) -> list[dict]:
+    # bm25() is lower = better; snippet() cuts the text around the matches
+    sql = f"""
+        SELECT m.id, m.conversation_id, c.title, m.role, m.created_at,
+               snippet({FTS_TABLE}, 0, %s, %s, '…', %s),
+               bm25({FTS_TABLE}) AS rank
+        FROM {FTS_TABLE}
+        JOIN core_message m ON m.id = {FTS_TABLE}.rowid
+        JOIN core_conversation c ON c.id = m.conversation_id
+        WHERE {FTS_TABLE} MATCH %s AND c.owner_id = %s
+        ORDER BY rank
+        LIMIT %s
+    """
+    params = [SNIPPET_START, SNIPPET_END, SNIPPET_WORDS, fts_query(query), user_id, limit]
+    with connection.cursor() as cursor:
+        cursor.execute(sql, params)
+        rows = cursor.fetchall()
+    # Report "higher = better" like the other backends
+    return [_row(*r[:6], -r[6]) for r in rows]
+
+
+def _search_postgres(user_id: int, query: str, limit: int) -> list[dict]:
+    sql = """
+        SELECT m.id, m.conversation_id, c.title, m.role, m.created_at,
+               ts_headline('simple', m.content, q, %s),
+               ts_rank(to_tsvector('simple', m.content), q) AS rank
+        FROM core_message m
+        JOIN core_conversation c ON c.id = m.conversation_id,
+             plainto_tsquery('simple', %s) q
+        WHERE c.owner_id = %s AND to_tsvector('simple', m.content) @@ q
+        ORDER BY rank DESC
+        LIMIT %s
+    """
+    options = f"StartSel={SNIPPET_START}, StopSel={SNIPPET_END}, MaxWords={SNIPPET_WORDS}, MinWords=4"
+    with connection.cursor() as cursor:
+        cursor.execute(sql, [options, " ".join(_terms(query)), user_id, limit])
+        return [_row(*r) for r in cursor.fetchall()]
+
+
+def _like_snippet(content: str, terms: list[str]) -> str:
+    lowered = content.lower()
+    pos = min((p for p in (lowered.find(t.lower()) for t in terms) if p >= 0), default=0)
+    start = max(0, pos - 40)
+    text = content[start : start + 160]
+    for term in terms:
+        text = re.sub(f"({re.escape(term)})", rf"{SNIPPET_START}\1{SNIPPET_END}", text, flags=re.IGNORECASE)
+    return ("…" if start else "") + text
+
+
+def _search_like(user_id: int, query: str, limit: int) -> list[dict]:
+    terms = _terms(query)
+    qs = matching(Message.objects.filter(conversation__owner_id=user_id), query)
+    rows = qs.select_related("conversation").order_by("-created_at")[:limit]
+    return [
+        _row(m.id, m.conversation_id, m.conversation.title, m.role, m.created_at, _like_snippet(m.content, terms), 0)
+        for m in rows
+    ]
+
+
+def search_messages(user_id: int, query: str, limit: int = 20) -> list[dict]:
+    # Best matches first among the user's own messages, with a highlighted snippet
+    if not _terms(query):
+        return []
+    kind = backend()
+    if kind == "fts5":
+        return _search_fts5(user_id, query, limit)
+    if kind == "postgres":
+        return _search_postgres(user_id, query, limit)
+    return _search_like(user_id, query, limit)
+
+
+asearch_messages = sync_to_async(search_messages)
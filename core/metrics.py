@@ -0,0 +1,173 @@
+# In-process metrics in the Prometheus text format.
+#
+# A tiny counter/histogram/gauge registry so we don't need an extra dependency.
+# Values live in this process only: with several web/worker processes each one
+# serves its own numbers on /metrics (scrape them all, or run one process).
+import math
+import threading
+
+# Default latency buckets (seconds): from a fast DB query up to a slow model turn
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+
+def _label_key(label_names: tuple, labels: dict) -> tuple:
+    return tuple(str(labels.get(name, "")) for name in label_names)
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _format_labels(label_names: tuple, key: tuple, extra: dict | None = None) -> str:
+    pairs = list(zip(label_names, key))
+    if extra:
+        pairs += list(extra.items())
+    if not pairs:
+        return ""
+    return "{" + ",".join(f'{name}="{_escape(value)}"' for name, value in pairs) + "}"
+
+
+def _format_value(value: float) -> str:
+    if value == math.inf:
+        return "+Inf"
+    if float(value).is_integer():
+        return str(int(value))
+    return repr(float(value))
+
+
+class Counter:
+    type = "counter"
+
+    def __init__(self, name: str, help_text: str, labels: tuple = ()):
+        self.name = name
+        self.help = help_text
+        self.label_names = tuple(labels)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, amount: float = 1, **labels) -> None:
+        key = _label_key(self.label_names, labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def value(self, **labels) -> float:
+        return self._values.get(_label_key(self.label_names, labels), 0)
+
+    def lines(self) -> list[str]:
+        with self._lock:
+            items = sorted(self._values.items())
+        return [f"{self.name}{_format_labels(self.label_names, key)} {_format_value(v)}" for key, v in items]
+
+
+class Gauge(Counter):
+    type = "gauge"
+
+    def set(self, value: float, **labels) -> None:
+        key = _label_key(self.label_names, labels)
+        with self._lock:
+            self._values[key] = value
+
+
+class Histogram:
+    type = "histogram"
+
+    def __init__(self, name: str, help_text: str, labels: tuple = (), buckets: tuple = DEFAULT_BUCKETS):
+        self.name = name
+        self.help = help_text
+        self.label_names = tuple(labels)
+        self.buckets = tuple(sorted(buckets)) + (math.inf,)
+        # label key -> [bucket counts..., sum, count]
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value: float, **labels) -> None:
+        key = _label_key(self.label_names, labels)
+        with self._lock:
+            row = self._values.get(key)
+            if row is None:
+                row = self._values[key] = [0] * len(self.buckets) + [0.0, 0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    row[i] += 1
+            row[-2] += value
+            row[-1] += 1
+
+    def count(self, **labels) -> int:
+        row = self._values.get(_label_key(self.label_names, labels))
+        return row[-1] if row else 0
+
+    def lines(self) -> list[str]:
+        with self._lock:
+            items = sorted((key, list(row)) for key, row in self._values.items())
+        out = []
+        for key, row in items:
+            for bound, n in zip(self.buckets, row):
+                labels = _format_labels(self.label_names, key, {"le": _format_value(bound)})
+                out.append(f"{self.name}_bucket{labels} {n}")
+            labels = _format_labels(self.label_names, key)
+            out.append(f"{self.name}_sum{labels} {_format_value(round(row[-2], 6))}")
+            out.append(f"{self.name}_count{labels} {row[-1]}")
+        return out
+
+
+class Registry:
+    def __init__(self):
+        self._metrics = {}
+        self._collectors = []
+        self._lock = threading.Lock()
+
+    def _get_or_create(self, cls, name, help_text, labels, **kwargs):
+        with self._lock:
+            metric = self._metrics.get(name)
+            if metric is None:
+                metric = self._metrics[name] = cls(name, help_text, labels, **kwargs)
+            return metric
+
+    def counter(self, name: str, help_text: str, labels: tuple = ()) -> Counter:
+        return self._get_or_create(Counter, name, help_text, labels)
+
+    def gauge(self, name: str, help_text: str, labels: tuple = ()) -> Gauge:
+        return self._get_or_create(Gauge, name, help_text, labels)
+
+    def histogram(self, name: str, help_text: str, labels: tuple = (), buckets: tuple = DEFAULT_BUCKETS) -> Histogram:
+        return self._get_or_create(Histogram, name, help_text, labels, buckets=buckets)
+
+    def add_collector(self, fn) -> None:
+        # fn() is called on every scrape, e.g. to copy cache stats into gauges
+        with self._lock:
+            if fn not in self._collectors:
+                self._collectors.append(fn)
+
+    def render(self) -> str:
+        for fn in list(self._collectors):
+            try:
+                fn()
+            except Exception:
+                # One broken collector must not take /metrics down
+                pass
+        lines = []
+        with self._lock:
+            metrics = sorted(self._metrics.values(), key=lambda m: m.name)
+        for metric in metrics:
+            lines.append(f"# HELP {metric.name} {metric.help}")
+            lines.append(f"# TYPE {metric.name} {metric.type}")
+            lines.extend(metric.lines())
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = Registry()
+
+# Metrics shared by the tracing layer (core.tracing) and the views
+HTTP_REQUESTS = REGISTRY.counter("http_requests_total", "HTTP requests handled.", ("method", "view", "status"))
+HTTP_SECONDS = REGISTRY.histogram("http_request_seconds", "Time to build the HTTP response.", ("view",))
+SPAN_SECONDS = REGISTRY.histogram("span_seconds", "Time spent per traced step.", ("span",))
+DB_QUERIES = REGISTRY.counter("db_queries_total", "ORM queries run inside traced requests/jobs.")
+DB_SECONDS = REGISTRY.histogram("db_query_seconds", "Time per ORM query.")
+LLM_CALLS = REGISTRY.counter("llm_calls_total", "Model calls.", ("model", "cached"))
+LLM_TOKENS = REGISTRY.counter("llm_tokens_total", "Tokens reported by the model.", ("model", "kind"))
+AGENT_STEPS = REGISTRY.histogram(
+    "agent_steps", "Model calls per agent turn.", buckets=(1, 2, 3, 4, 5, 6, 8, 10)
+)
+TOOL_CALLS = REGISTRY.counter("tool_calls_total", "Tool calls run for the model.", ("tool", "outcome"))
+TOOL_OUTPUT_TOKENS = REGISTRY.counter("tool_output_tokens_total", "Prompt tokens used by tool results.", ("tool",))
+TOOL_OUTPUT_TRUNCATED = REGISTRY.counter("tool_output_truncated_total", "Tool results cut to fit the prompt.", ("tool",))
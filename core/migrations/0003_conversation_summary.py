@@ -0,0 +1,23 @@
+# Generated by Django 6.0.2 on 2026-10-18 07:33
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0002_agent_jobs'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='conversation',
+            name='summary',
+            field=models.TextField(blank=True, default=''),
+        ),
+        migrations.AddField(
+            model_name='conversation',
+            name='summary_upto_id',
+            field=models.BigIntegerField(blank=True, null=True),
+        ),
+    ]
@@ -0,0 +1,23 @@
+# Generated by Django 6.0.2 on 2026-10-18 07:44
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0006_sandbox_index'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='message',
+            name='model',
+            field=models.CharField(blank=True, default='', max_length=100),
+        ),
+        migrations.AddField(
+            model_name='message',
+            name='routing',
+            field=models.JSONField(blank=True, default=dict),
+        ),
+    ]
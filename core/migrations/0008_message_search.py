@@ -0,0 +1,85 @@
+# Full-text index over Message.content (see core/message_search.py).
+# SQLite: FTS5 table + sync triggers, PostgreSQL: GIN index on a tsvector.
+# Other databases get nothing (search falls back to icontains).
+
+from django.db import migrations
+
+SQLITE_FORWARD = [
+    # External content table: only the index is stored, the text stays in core_message
+    """
+    CREATE VIRTUAL TABLE IF NOT EXISTS core_message_fts
+    USING fts5(content, content='core_message', content_rowid='id')
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS core_message_fts_insert AFTER INSERT ON core_message BEGIN
+        INSERT INTO core_message_fts(rowid, content) VALUES (new.id, new.content);
+    END
+    """,
+    # Pending assistant replies are filled in later by an UPDATE
+    """
+    CREATE TRIGGER IF NOT EXISTS core_message_fts_update AFTER UPDATE OF content ON core_message BEGIN
+        INSERT INTO core_message_fts(core_message_fts, rowid, content) VALUES ('delete', old.id, old.content);
+        INSERT INTO core_message_fts(rowid, content) VALUES (new.id, new.content);
+    END
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS core_message_fts_delete AFTER DELETE ON core_message BEGIN
+        INSERT INTO core_message_fts(core_message_fts, rowid, content) VALUES ('delete', old.id, old.content);
+    END
+    """,
+    # Index the messages that already exist
+    "INSERT INTO core_message_fts(core_message_fts) VALUES ('rebuild')",
+]
+
+SQLITE_BACKWARD = [
+    "DROP TRIGGER IF EXISTS core_message_fts_insert",
+    "DROP TRIGGER IF EXISTS core_message_fts_update",
+    "DROP TRIGGER IF EXISTS core_message_fts_delete",
+    "DROP TABLE IF EXISTS core_message_fts",
+]
+
+POSTGRES_FORWARD = [
+    "CREATE INDEX IF NOT EXISTS core_msg_content_tsv_idx ON core_message USING GIN (to_tsvector('simple', content))",
+]
+
+POSTGRES_BACKWARD = [
+    "DROP INDEX IF EXISTS core_msg_content_tsv_idx",
+]
+
+
+def _run(schema_editor, statements):
+    for sql in statements:
+        schema_editor.execute(sql)
+
+
+def _sqlite_has_fts5(schema_editor) -> bool:
+    with schema_editor.connection.cursor() as cursor:
+        cursor.execute("PRAGMA compile_options")
+        return any(row[0] == "ENABLE_FTS5" for row in cursor.fetchall())
+
+
+def create_index(apps, schema_editor):
+    vendor = schema_editor.connection.vendor
+    if vendor == "sqlite" and _sqlite_has_fts5(schema_editor):
+        _run(schema_editor, SQLITE_FORWARD)
+    elif vendor == "postgresql":
+        _run(schema_editor, POSTGRES_FORWARD)
+
+
+def drop_index(apps, schema_editor):
+    vendor = schema_editor.connection.vendor
+    if vendor == "sqlite":
+        _run(schema_editor, SQLITE_BACKWARD)
+    elif vendor == "postgresql":
+        _run(schema_editor, POSTGRES_BACKWARD)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0007_message_routing'),
+    ]
+
+    operations = [
+        migrations.RunPython(create_index, drop_index),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 6.0.2 on 2026-10-18 10:05
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0010_sandbox_snapshots'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='sandboxusage',
+            name='version',
+            field=models.BigIntegerField(default=0),
+        ),
+    ]
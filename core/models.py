@@ -1,21 +1,209 @@
 from django.conf import settings
-from django.db import models
+from django.db import models, transaction
+from django.db.models import F
+from django.utils import timezone
 import uuid
 
+TITLE_LENGTH = 80
+PREVIEW_LENGTH = 160
+
+
+def make_title(text: str) -> str:
+    # First line of the first user message
+    first_line = text.strip().splitlines()[0] if text.strip() else ""
+    return first_line[:TITLE_LENGTH]
+
+
+def make_preview(text: str) -> str:
+    return " ".join(text.split())[:PREVIEW_LENGTH]
+
 
 class Conversation(models.Model):
     owner = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.CASCADE)
     session_id = models.UUIDField(default=uuid.uuid4, editable=False, unique=True)
     created_at = models.DateTimeField(auto_now_add=True)
+    # Rolling summary of older turns that no longer fit the model context
+    # (see core.context), covering messages up to summary_upto_id
+    summary = models.TextField(blank=True, default="")
+    summary_upto_id = models.BigIntegerField(null=True, blank=True)
+
+    # Denormalized for the home page (kept up to date by add_message,
+    # fill in old rows with `manage.py backfill_conversation_stats`)
+    title = models.CharField(max_length=TITLE_LENGTH, blank=True, default="")
+    preview = models.CharField(max_length=PREVIEW_LENGTH, blank=True, default="")
+    message_count = models.PositiveIntegerField(default=0)
+    last_message_at = models.DateTimeField(default=timezone.now)
+
+    class Meta:
+        indexes = [
+            # Home page: a user's conversations by date
+            models.Index(fields=["owner", "created_at"], name="core_conv_owner_created_idx"),
+            # Home page: a user's conversations by recent activity
+            models.Index(fields=["owner", "last_message_at"], name="core_conv_owner_activity_idx"),
+        ]
 
     def __str__(self):
         return f"Conversation {self.id} ({self.owner})"
 
+    def add_message(
+        self,
+        role: str,
+        content: str,
+        status: str = "done",
+        model: str = "",
+        routing: dict | None = None,
+    ) -> "Message":
+        # Insert a message and update the conversation stats in the same transaction,
+        # use this instead of Message.objects.create
+        with transaction.atomic():
+            msg = Message.objects.create(
+                conversation=self,
+                role=role,
+                content=content,
+                status=status,
+                model=model,
+                routing=routing or {},
+            )
+
+            fields = {"message_count": F("message_count") + 1, "last_message_at": msg.created_at}
+            if content:
+                fields["preview"] = make_preview(content)
+            Conversation.objects.filter(pk=self.pk).update(**fields)
+
+            # The first user message names the conversation
+            if role == "user" and not self.title:
+                self.title = make_title(content)
+                Conversation.objects.filter(pk=self.pk, title="").update(title=self.title)
+        return msg
+
+    def message_updated(self, content: str) -> None:
+        # A pending message got its final content (background jobs)
+        Conversation.objects.filter(pk=self.pk).update(
+            preview=make_preview(content),
+            last_message_at=timezone.now(),
+        )
+
 class Message(models.Model):
+    STATUS_PENDING = "pending"  # assistant reply is queued/being generated
+    STATUS_DONE = "done"
+    STATUS_FAILED = "failed"
+
     conversation = models.ForeignKey(Conversation, on_delete=models.CASCADE, related_name="messages")
     role = models.CharField(max_length=20)  # "user" or "assistant"
     content = models.TextField()
+    status = models.CharField(max_length=20, default=STATUS_DONE)
     created_at = models.DateTimeField(auto_now_add=True)
+    # Assistant replies: the model that produced the answer and how it was picked
+    # (see core.routing: initial model, reason, escalations to the large model)
+    model = models.CharField(max_length=100, blank=True, default="")
+    routing = models.JSONField(blank=True, default=dict)
+
+    # content also has a full-text index (FTS5 table + triggers on SQLite,
+    # GIN tsvector index on PostgreSQL), created by migration 0008_message_search.
+    # On SQLite a migration that rebuilds core_message drops the triggers:
+    # such a migration must run that migration's SQL again.
+
+    class Meta:
+        indexes = [
+            # Chat page / model history: one conversation's messages by date
+            models.Index(fields=["conversation", "created_at"], name="core_msg_conv_created_idx"),
+        ]
 
     def __str__(self):
         return f"{self.role}: {self.content[:30]}"
+
+
+# One queued agent turn, processed by `manage.py run_agent_workers`.
+# The web request only creates this row (plus a pending assistant Message)
+# and returns, a worker claims it with a time-limited lease and fills in the message.
+class AgentJob(models.Model):
+    STATUS_QUEUED = "queued"
+    STATUS_RUNNING = "running"
+    STATUS_DONE = "done"
+    STATUS_FAILED = "failed"
+
+    message = models.OneToOneField(Message, on_delete=models.CASCADE, related_name="job")
+    user_text = models.TextField()
+    status = models.CharField(max_length=20, default=STATUS_QUEUED)
+    attempts = models.PositiveIntegerField(default=0)
+    # Which worker holds the job and until when (an expired lease can be re-claimed)
+    lease_owner = models.CharField(max_length=100, blank=True)
+    lease_expires_at = models.DateTimeField(null=True, blank=True)
+    error = models.TextField(blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+    started_at = models.DateTimeField(null=True, blank=True)
+    finished_at = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        indexes = [models.Index(fields=["status", "id"])]
+
+    def __str__(self):
+        return f"AgentJob {self.id} ({self.status})"
+
+
+# Per-user index of sandbox files (see core.fs_index), kept up to date by
+# write_file and reconciled against the disk for changes made outside the app
+class SandboxFile(models.Model):
+    owner = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.CASCADE)
+    path = models.CharField(max_length=1024)  # relative to the user's sandbox root
+    size = models.BigIntegerField()
+    mtime_ns = models.BigIntegerField()
+    content_hash = models.CharField(max_length=32, blank=True)
+    indexed_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=["owner", "path"], name="core_sandboxfile_owner_path_uniq"),
+        ]
+
+    def __str__(self):
+        return f"{self.owner_id}:{self.path}"
+
+
+# Inverted index: which of a user's files contain which word (and how often)
+class SandboxTerm(models.Model):
+    owner = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.CASCADE)
+    file = models.ForeignKey(SandboxFile, on_delete=models.CASCADE, related_name="terms")
+    term = models.CharField(max_length=64)
+    count = models.PositiveIntegerField()
+
+    class Meta:
+        indexes = [models.Index(fields=["owner", "term"], name="core_term_owner_term_idx")]
+
+    def __str__(self):
+        return f"{self.term} x{self.count}"
+
+
+# Running total of a user's sandbox size (see core.quota): updated with the
+# size change of every write, so checking a quota or showing usage is one row
+# read instead of a walk over the files. reconcile() resets it from the disk.
+class SandboxUsage(models.Model):
+    owner = models.OneToOneField(settings.AUTH_USER_MODEL, on_delete=models.CASCADE, primary_key=True)
+    bytes = models.BigIntegerField(default=0)
+    files = models.IntegerField(default=0)
+    reconciled_at = models.DateTimeField(null=True, blank=True)
+    # Bumped on every change to the sandbox (writes, reconciled outside
+    # changes, restores): with bytes/files the model cache's sandbox fingerprint
+    version = models.BigIntegerField(default=0)
+
+    def __str__(self):
+        return f"{self.owner_id}: {self.bytes} bytes in {self.files} files"
+
+
+# Snapshot of a user's sandbox with the content-addressed storage backend
+# (see core.fs_cas, SANDBOX_STORAGE["BACKEND"] = "cas"): the hash of the root
+# tree at that moment. Taking one is a row insert, nothing is copied, restoring
+# one points the user's head back at its tree. Agent turns take one before
+# writing files.
+class SandboxSnapshot(models.Model):
+    owner = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.CASCADE)
+    conversation = models.ForeignKey(Conversation, on_delete=models.SET_NULL, null=True, blank=True)
+    tree = models.CharField(max_length=64)
+    label = models.CharField(max_length=200, blank=True, default="")
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        indexes = [models.Index(fields=["owner", "created_at"], name="core_snap_owner_created_idx")]
+
+    def __str__(self):
+        return f"Snapshot {self.id} of {self.owner_id} ({self.label})"
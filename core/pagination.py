@@ -0,0 +1,69 @@
+# Keyset (cursor) pagination.
+#
+# OFFSET pagination gets slower the further back you page, because the DB
+# still walks every skipped row. Here the cursor is the (timestamp, id) of the
+# last row already shown and the next page is "rows strictly before it",
+# which is a single index range scan no matter how long the list is.
+import base64
+from datetime import datetime
+
+from django.db.models import Q
+
+# Rows per page when the caller doesn't say, and the most it may ask for
+DEFAULT_PAGE_SIZE = 50
+MAX_PAGE_SIZE = 200
+
+
+def encode_cursor(value: datetime, pk: int) -> str:
+    raw = f"{value.isoformat()}|{pk}"
+    return base64.urlsafe_b64encode(raw.encode()).decode().rstrip("=")
+
+
+def decode_cursor(cursor: str) -> tuple[datetime, int]:
+    # Raises ValueError for anything that isn't a cursor we produced
+    try:
+        padded = cursor + "=" * (-len(cursor) % 4)
+        raw = base64.urlsafe_b64decode(padded.encode()).decode()
+        value, pk = raw.rsplit("|", 1)
+        return datetime.fromisoformat(value), int(pk)
+    except Exception as exc:
+        raise ValueError("invalid cursor") from exc
+
+
+def parse_limit(raw, default: int = DEFAULT_PAGE_SIZE) -> int:
+    try:
+        limit = int(raw)
+    except (TypeError, ValueError):
+        return default
+    return max(1, min(limit, MAX_PAGE_SIZE))
+
+
+def _page_queryset(queryset, field: str, cursor: str | None, limit: int):
+    qs = queryset
+    if cursor:
+        value, pk = decode_cursor(cursor)
+        qs = qs.filter(Q(**{f"{field}__lt": value}) | Q(**{field: value, "pk__lt": pk}))
+    # One extra row tells us whether there is another page
+    return qs.order_by(f"-{field}", "-pk")[: limit + 1]
+
+
+def _split_page(rows: list, field: str, limit: int):
+    next_cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        last = rows[-1]
+        next_cursor = encode_cursor(getattr(last, field), last.pk)
+    return rows, next_cursor
+
+
+def keyset_page(queryset, field: str, cursor: str | None = None, limit: int = DEFAULT_PAGE_SIZE):
+    # Newest first page of `queryset` ordered by (field, id), starting after `cursor`.
+    # Returns (rows, next_cursor); next_cursor is None on the last page.
+    rows = list(_page_queryset(queryset, field, cursor, limit))
+    return _split_page(rows, field, limit)
+
+
+async def akeyset_page(queryset, field: str, cursor: str | None = None, limit: int = DEFAULT_PAGE_SIZE):
+    # keyset_page for async views (async ORM iteration)
+    rows = [row async for row in _page_queryset(queryset, field, cursor, limit)]
+    return _split_page(rows, field, limit)
@@ -0,0 +1,183 @@
+# Per-user sandbox quotas.
+#
+# SandboxUsage keeps a running total of each user's bytes and files. Every write
+# reserves its size change (new size - old size, +1 file for a new file) with one
+# conditional UPDATE *before* the file is written, so:
+#   - a write that would go over SANDBOX_QUOTA is rejected without touching the disk
+#   - concurrent writes can't both squeeze under the limit (the check and the
+#     update are one statement)
+#   - usage is one row read, no walk over the files
+# Streamed writes (uploads, appends) don't know their size up front: they
+# reserve as the data comes in, before each chunk is written (StreamReservation).
+# A failed write gives its reservation back. The totals can still drift (files
+# changed outside the app, a crash between reserve and write), so
+# fs_index.reconcile() / `manage.py reconcile_sandbox_usage` reset them from the disk.
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.db.models import F
+from django.utils import timezone
+
+from .models import SandboxUsage
+
+
+class QuotaExceeded(ValueError):
+    pass
+
+
+def limits() -> tuple[int, int]:
+    # (max bytes, max files) per user, 0 = no limit
+    conf = getattr(settings, "SANDBOX_QUOTA", {})
+    return conf.get("MAX_BYTES", 0), conf.get("MAX_FILES", 0)
+
+
+def _walk_totals(user_id: int) -> tuple[int, int]:
+    from .fs_local import iter_tree
+
+    total_bytes = 0
+    total_files = 0
+    for item in iter_tree(user_id, with_meta=True):
+        if not item["is_dir"]:
+            total_bytes += item["size"]
+            total_files += 1
+    return total_bytes, total_files
+
+
+def _ensure_row(user_id: int) -> None:
+    # First use for this user: count what's already on disk (once)
+    if not SandboxUsage.objects.filter(owner_id=user_id).exists():
+        total_bytes, total_files = _walk_totals(user_id)
+        SandboxUsage.objects.get_or_create(
+            owner_id=user_id,
+            defaults={"bytes": total_bytes, "files": total_files, "reconciled_at": timezone.now()},
+        )
+
+
+def get_usage(user_id: int) -> dict:
+    _ensure_row(user_id)
+    usage = SandboxUsage.objects.get(owner_id=user_id)
+    max_bytes, max_files = limits()
+    return {
+        "bytes": usage.bytes,
+        "files": usage.files,
+        "max_bytes": max_bytes or None,
+        "max_files": max_files or None,
+        "reconciled_at": usage.reconciled_at.isoformat() if usage.reconciled_at else None,
+    }
+
+
+aget_usage = sync_to_async(get_usage)
+
+
+def _add(user_id: int, delta_bytes: int, delta_files: int) -> bool:
+    max_bytes, max_files = limits()
+    rows = SandboxUsage.objects.filter(owner_id=user_id)
+    if max_bytes and delta_bytes > 0:
+        rows = rows.filter(bytes__lte=max_bytes - delta_bytes)
+    if max_files and delta_files > 0:
+        rows = rows.filter(files__lte=max_files - delta_files)
+    return rows.update(bytes=F("bytes") + delta_bytes, files=F("files") + delta_files) > 0
+
+
+def reserve(user_id: int, delta_bytes: int, delta_files: int = 0) -> None:
+    # Add a write's size change to the user's usage, or raise QuotaExceeded.
+    # Only growth is checked: shrinking a file is always allowed,
+    # even when the user is already over a (lowered) quota.
+    if not delta_bytes and not delta_files:
+        return
+    if _add(user_id, delta_bytes, delta_files):
+        return
+    # No row yet, or over the limit
+    if not SandboxUsage.objects.filter(owner_id=user_id).exists():
+        _ensure_row(user_id)
+        if _add(user_id, delta_bytes, delta_files):
+            return
+    max_bytes, max_files = limits()
+    raise QuotaExceeded(f"sandbox quota exceeded (limit {max_bytes or 'unlimited'} bytes, {max_files or 'unlimited'} files)")
+
+
+def release(user_id: int, delta_bytes: int, delta_files: int = 0) -> None:
+    # Undo a reserve() whose write failed
+    if delta_bytes or delta_files:
+        SandboxUsage.objects.filter(owner_id=user_id).update(
+            bytes=F("bytes") - delta_bytes, files=F("files") - delta_files
+        )
+
+
+# Streamed writes reserve ahead in steps of this many bytes (not one UPDATE per chunk)
+RESERVE_STEP_BYTES = 1024 * 1024
+
+
+class StreamReservation:
+    # Quota for a write whose size is only known at the end (uploads, appends).
+    # grow() reserves before each chunk goes to disk, settle() trims the
+    # reservation to the final size change, cancel() gives it all back.
+
+    def __init__(self, user_id: int, old_size: int | None):
+        # old_size: the file this write replaces or appends to (None = new file)
+        self.user_id = user_id
+        self.base = old_size or 0
+        self.files = 1 if old_size is None else 0
+        self.reserved = 0
+        reserve(user_id, 0, self.files)
+
+    def grow(self, size: int) -> None:
+        # The file is about to be `size` bytes long (raises QuotaExceeded)
+        need = size - self.base - self.reserved
+        if need <= 0:
+            return
+        step = max(need, RESERVE_STEP_BYTES)
+        try:
+            reserve(self.user_id, step)
+        except QuotaExceeded:
+            if step == need:
+                raise
+            # Close to the limit: the step doesn't fit, maybe the chunk does
+            reserve(self.user_id, need)
+            step = need
+        self.reserved += step
+
+    def settle(self, size: int) -> None:
+        # The write is done and the file is `size` bytes long
+        release(self.user_id, self.reserved - (size - self.base))
+        self.reserved = size - self.base
+
+    def cancel(self) -> None:
+        release(self.user_id, self.reserved, self.files)
+        self.reserved = self.files = 0
+
+
+def set_usage(user_id: int, total_bytes: int, total_files: int, changed: bool = False) -> None:
+    # Reset the totals from a walk over the disk (reconciliation),
+    # changed: the walk found files that changed outside the app
+    now = timezone.now()
+    fields = {"bytes": total_bytes, "files": total_files, "reconciled_at": now}
+    if changed:
+        fields["version"] = F("version") + 1
+    if not SandboxUsage.objects.filter(owner_id=user_id).update(**fields):
+        SandboxUsage.objects.get_or_create(
+            owner_id=user_id,
+            defaults={"bytes": total_bytes, "files": total_files, "reconciled_at": now},
+        )
+
+
+def mark_changed(user_id: int) -> None:
+    # A file was written: the sandbox fingerprint must change, even when the
+    # size didn't (same-size rewrite)
+    if not SandboxUsage.objects.filter(owner_id=user_id).update(version=F("version") + 1):
+        _ensure_row(user_id)
+        SandboxUsage.objects.filter(owner_id=user_id).update(version=F("version") + 1)
+
+
+def fingerprint(user_id: int) -> str:
+    # Changes whenever the sandbox does: one row read
+    row = SandboxUsage.objects.filter(owner_id=user_id).values_list("bytes", "files", "version").first()
+    if row is None:
+        _ensure_row(user_id)
+        row = SandboxUsage.objects.filter(owner_id=user_id).values_list("bytes", "files", "version").first()
+    return "{}:{}:{}".format(*row)
+
+
+def reconcile_usage(user_id: int) -> dict:
+    total_bytes, total_files = _walk_totals(user_id)
+    set_usage(user_id, total_bytes, total_files)
+    return {"bytes": total_bytes, "files": total_files}
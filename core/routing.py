@@ -0,0 +1,96 @@
+# Small/large model routing.
+#
+# Most turns are plain conversation, which the small model (OLLAMA_SMALL_MODEL)
+# answers much faster. Tool use is where it's weak, so we go to the large model
+# (OLLAMA_MODEL) when:
+#   - the user message looks like a file task (tools will be needed)
+#   - the prompt is long (small models lose track of long contexts)
+#   - the small model asks for a tool anyway, returns a malformed tool call
+#     or an empty answer (escalation: the step is redone on the large model)
+# Once a turn is on the large model it stays there.
+import re
+
+from django.conf import settings
+
+from .context import message_tokens
+from .metrics import REGISTRY
+
+ROUTES = REGISTRY.counter("llm_routes_total", "Turns started per model and routing reason.", ("model", "reason"))
+ESCALATIONS = REGISTRY.counter("llm_escalations_total", "Steps redone on the large model.", ("reason",))
+
+# Extensions that make "name.ext" in a user message a file name
+# (not "3.5", "e.g" or "D.C")
+FILE_EXTENSIONS = (
+    "txt", "md", "markdown", "rst", "csv", "tsv", "json", "jsonl", "yaml", "yml", "toml", "ini", "cfg", "conf",
+    "env", "log", "xml", "html", "htm", "css", "js", "ts", "jsx", "tsx", "py", "ipynb", "rb", "go", "rs", "java",
+    "kt", "cpp", "hpp", "cs", "php", "sh", "sql", "pdf", "doc", "docx", "xls", "xlsx", "ppt", "pptx", "rtf",
+)
+
+# Words/shapes in a user message that usually mean a file tool is needed.
+# Verbs like read/write/list/find are left out: "write a poem", "list three
+# reasons" are chat. A file task the regex misses still reaches the large
+# model through escalation, when the small model asks for a tool.
+TOOL_HINT_RE = re.compile(
+    r"\b(files?|file ?names?|folders?|subfolders?|dir|directory|directories|sandbox)\b"
+    r"|\w\.(" + "|".join(FILE_EXTENSIONS) + r")\b"  # a file name like notes.txt
+    # a path like docs/readme (not 24/7, 1/2, and/or, w/o)
+    r"|(?<![\w.-])(?!(?:and|either)/or\b|w/o\b)[A-Za-z_][\w.-]*/[A-Za-z_]",
+    re.IGNORECASE,
+)
+
+
+class Route:
+    # Which model a turn uses and why, plus any escalations on the way.
+    # as_dict() is stored on the assistant Message (Message.routing).
+
+    def __init__(self, model: str, reason: str, large_model: str):
+        self.model = model
+        self.reason = reason
+        self.large_model = large_model
+        self.initial_model = model
+        self.escalations = []
+
+    @property
+    def on_large(self) -> bool:
+        return self.model == self.large_model
+
+    def escalate(self, reason: str, step: int) -> None:
+        self.escalations.append({"from": self.model, "to": self.large_model, "reason": reason, "step": step})
+        self.model = self.large_model
+        ESCALATIONS.inc(reason=reason)
+
+    def as_dict(self) -> dict:
+        return {
+            "initial_model": self.initial_model,
+            "reason": self.reason,
+            "model": self.model,
+            "escalations": self.escalations,
+        }
+
+
+def choose_route(user_text: str, msgs: list) -> Route:
+    large = settings.OLLAMA_MODEL
+    small = getattr(settings, "OLLAMA_SMALL_MODEL", "") or ""
+
+    if not small or small == large:
+        route = Route(large, "single_model", large)
+    elif TOOL_HINT_RE.search(user_text or ""):
+        route = Route(large, "tools_likely", large)
+    elif sum(message_tokens(str(m.content)) for m in msgs) > settings.ROUTING_LARGE_CONTEXT_TOKENS:
+        route = Route(large, "large_context", large)
+    else:
+        route = Route(small, "chat", large)
+
+    ROUTES.inc(model=route.model, reason=route.reason)
+    return route
+
+
+def escalation_reason(resp) -> str | None:
+    # Why a small-model response should be redone on the large model (None = keep it)
+    if getattr(resp, "invalid_tool_calls", None):
+        return "malformed_tool_call"
+    if getattr(resp, "tool_calls", None):
+        return "tool_call"
+    if not str(resp.content).strip():
+        return "empty_reply"
+    return None
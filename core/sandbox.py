@@ -0,0 +1,188 @@
+# Per-user sandbox handles.
+#
+# Every file operation happens relative to an open file descriptor of the
+# user's sandbox folder (openat-style calls: os.open(..., dir_fd=...)), one path
+# component at a time and with O_NOFOLLOW, so:
+#   - a path is checked as a string (no "..", not absolute), no resolve() calls
+#   - a symlink inside the sandbox can't lead outside of it, not even when it is
+#     swapped in between our check and our use: the kernel refuses to follow it
+#   - the user folder is opened once and kept open (an LRU of handles), instead of
+#     a mkdir + resolve() on every call
+import errno
+import os
+import stat
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
+from pathlib import Path
+
+from django.conf import settings
+
+# Open sandbox folders kept per process
+MAX_OPEN_HANDLES = 256
+
+DIR_FLAGS = os.O_RDONLY | os.O_DIRECTORY | os.O_NOFOLLOW | os.O_CLOEXEC
+FILE_FLAGS = os.O_NOFOLLOW | os.O_CLOEXEC
+
+
+def clean_parts(rel_path: str) -> tuple[str, ...]:
+    # "docs/./a.txt" -> ("docs", "a.txt"). Pure string work: ".." may only
+    # step back inside the path itself, absolute paths are refused.
+    # clean common junk the model may pass
+    rel_path = rel_path.strip().strip("`").strip('"').strip("'")
+    if "\0" in rel_path:
+        raise ValueError("invalid path")
+    if rel_path.startswith("/"):
+        raise ValueError("absolute paths not allowed")
+    parts = []
+    for part in rel_path.split("/"):
+        if part in ("", "."):
+            continue
+        if part == "..":
+            if not parts:
+                raise ValueError("path escapes sandbox")
+            parts.pop()
+            continue
+        parts.append(part)
+    return tuple(parts)
+
+
+def _no_symlinks(exc: OSError, dir_fd: int | None = None, name: str = ""):
+    # O_NOFOLLOW hit a symlink: ELOOP, or ENOTDIR when a folder was expected
+    is_link = exc.errno == errno.ELOOP
+    if not is_link and exc.errno == errno.ENOTDIR and dir_fd is not None:
+        try:
+            is_link = stat.S_ISLNK(os.stat(name, dir_fd=dir_fd, follow_symlinks=False).st_mode)
+        except OSError:
+            pass
+    if is_link:
+        return ValueError("symlinks are not allowed in the sandbox")
+    return exc
+
+
+class Sandbox:
+    def __init__(self, user_id: int, path: Path):
+        self.user_id = user_id
+        self.path = path
+        path.mkdir(parents=True, exist_ok=True)
+        self.fd = os.open(path, os.O_RDONLY | os.O_DIRECTORY | os.O_CLOEXEC)
+        # Threads using the handle right now; an evicted handle is closed by the last one
+        self.users = 0
+        self.evicted = False
+
+    def is_stale(self) -> bool:
+        # The folder was deleted (e.g. rmtree) and maybe created again
+        return os.fstat(self.fd).st_nlink == 0
+
+    def close(self) -> None:
+        os.close(self.fd)
+
+    def open_dir(self, parts: tuple[str, ...], create: bool = False) -> int:
+        # fd of the folder at `parts` (the caller closes it), creating missing folders if asked
+        fd = os.open(".", DIR_FLAGS, dir_fd=self.fd)
+        part = ""
+        try:
+            for part in parts:
+                try:
+                    sub = os.open(part, DIR_FLAGS, dir_fd=fd)
+                except FileNotFoundError:
+                    if not create:
+                        raise
+                    try:
+                        os.mkdir(part, 0o755, dir_fd=fd)
+                    except FileExistsError:
+                        pass
+                    sub = os.open(part, DIR_FLAGS, dir_fd=fd)
+                os.close(fd)
+                fd = sub
+        except OSError as exc:
+            error = _no_symlinks(exc, fd, part)
+            os.close(fd)
+            if error is exc:
+                raise
+            raise error from exc
+        return fd
+
+    @contextmanager
+    def parent(self, parts: tuple[str, ...], create: bool = False):
+        # (fd of the containing folder, file name) for a file path
+        if not parts:
+            raise ValueError("path is the sandbox folder itself")
+        if len(parts) == 1:
+            # Top level file: the root fd itself (never scanned, so safe to share)
+            yield self.fd, parts[0]
+            return
+        dir_fd = self.open_dir(parts[:-1], create=create)
+        try:
+            yield dir_fd, parts[-1]
+        finally:
+            os.close(dir_fd)
+
+    def open(self, parts: tuple[str, ...], flags: int = os.O_RDONLY, mode: int = 0o644) -> int:
+        with self.parent(parts) as (dir_fd, name):
+            try:
+                return os.open(name, flags | FILE_FLAGS, mode, dir_fd=dir_fd)
+            except OSError as exc:
+                error = _no_symlinks(exc)
+                if error is exc:
+                    raise
+                raise error from exc
+
+
+def sandbox_path(user_id: int) -> Path:
+    return Path(settings.FILE_SANDBOX_ROOT) / str(user_id)
+
+
+# (sandbox root, user_id) -> Sandbox, least recently used first
+_handles: OrderedDict = OrderedDict()
+_handles_lock = threading.Lock()
+
+
+def _acquire(user_id: int) -> Sandbox:
+    path = sandbox_path(user_id)
+    key = (str(path), user_id)
+    with _handles_lock:
+        sb = _handles.get(key)
+        if sb is not None and sb.is_stale():
+            _evict(_handles.pop(key))
+            sb = None
+        if sb is None:
+            sb = Sandbox(user_id, path)
+            _handles[key] = sb
+            while len(_handles) > MAX_OPEN_HANDLES:
+                _evict(_handles.popitem(last=False)[1])
+        else:
+            _handles.move_to_end(key)
+        sb.users += 1
+        return sb
+
+
+def _evict(sb: Sandbox) -> None:
+    # (with _handles_lock held)
+    sb.evicted = True
+    if not sb.users:
+        sb.close()
+
+
+def _release(sb: Sandbox) -> None:
+    with _handles_lock:
+        sb.users -= 1
+        if sb.evicted and not sb.users:
+            sb.close()
+
+
+@contextmanager
+def sandbox(user_id: int):
+    # The user's sandbox handle, kept open while the block runs
+    sb = _acquire(user_id)
+    try:
+        yield sb
+    finally:
+        _release(sb)
+
+
+def close_all() -> None:
+    # Close every cached handle (e.g. in tests that delete sandbox folders)
+    with _handles_lock:
+        while _handles:
+            _evict(_handles.popitem()[1])
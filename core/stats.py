@@ -0,0 +1,22 @@
+# Latency statistics shared by the benchmarks (core.bench.runner) and batch
+# runs (core.batch).
+
+
+def percentile(sorted_values: list[float], pct: float) -> float:
+    # Nearest-rank percentile of an already sorted list
+    if not sorted_values:
+        return 0.0
+    rank = max(1, int(round(pct / 100.0 * len(sorted_values))))
+    return sorted_values[min(rank, len(sorted_values)) - 1]
+
+
+def latency_summary(latencies: list[float]) -> dict:
+    # p50/p95/p99/mean/max in milliseconds of latencies given in seconds
+    lat = sorted(latencies)
+    return {
+        "p50_ms": round(percentile(lat, 50) * 1000, 2),
+        "p95_ms": round(percentile(lat, 95) * 1000, 2),
+        "p99_ms": round(percentile(lat, 99) * 1000, 2),
+        "mean_ms": round(sum(lat) / len(lat) * 1000, 2) if lat else 0.0,
+        "max_ms": round(lat[-1] * 1000, 2) if lat else 0.0,
+    }
@@ -1,3 +1,1440 @@
-from django.test import TestCase
+import asyncio
+import io
+import json
+import os
+import shutil
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta, timezone as dt_timezone
+from pathlib import Path
+from unittest import mock
 
-# Create your tests here.
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.core.management import call_command
+from django.db import connection
+from django.test import SimpleTestCase, TestCase, TransactionTestCase, override_settings
+from django.utils import timezone
+from langchain_core.messages import AIMessage, AIMessageChunk
+
+from . import admission, assistant, audit, batch, context, fs_cas, fs_index, fs_local, jobs, llm, llm_cache, llm_pool, message_search, metrics, quota, routing, sandbox, stats, tool_output, tools
+from .management.commands.audit_log import read_lines as read_audit_lines
+from .models import AgentJob, Conversation, Message, SandboxFile, make_preview, make_title
+from .pagination import decode_cursor, encode_cursor, keyset_page
+
+User = get_user_model()
+
+
+class FakeLLM:
+    # Stands in for the Ollama client: answers every call with `reply` and
+    # remembers the prompts it got
+    model = "fake"
+
+    def __init__(self, reply="summary"):
+        self.reply = reply
+        self.prompts = []
+
+    def invoke(self, msgs, **kwargs):
+        self.prompts.append(msgs)
+        return AIMessage(content=self.reply)
+
+
+class IsolatedFiles:
+    # Test case mixin: every test gets its own empty sandbox root, CAS and
+    # audit directory, and the audit log is off. Nothing is written under
+    # BASE_DIR/appdata.
+
+    def setUp(self):
+        super().setUp()
+        self.tmp = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmp, ignore_errors=True)
+        settings_override = override_settings(
+            FILE_SANDBOX_ROOT=f"{self.tmp}/users",
+            SANDBOX_STORAGE={**settings.SANDBOX_STORAGE, "DIR": f"{self.tmp}/cas"},
+            AUDIT_LOG={**settings.AUDIT_LOG, "ENABLED": False, "DIR": f"{self.tmp}/audit"},
+        )
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+        # The CAS store is built once per process from the settings
+        fs_cas._store = None
+        self.addCleanup(setattr, fs_cas, "_store", None)
+
+
+class SandboxTestCase(IsolatedFiles, TestCase):
+    def setUp(self):
+        super().setUp()
+        self.user = User.objects.create_user(username="alice", password=None)
+
+
+class SandboxTransactionTestCase(IsolatedFiles, TransactionTestCase):
+    # For tests whose threads use the DB (they only see committed rows)
+    pass
+
+
+class SummaryTests(SandboxTestCase):
+    def setUp(self):
+        super().setUp()
+        self.conv = Conversation.objects.create(owner=self.user)
+        # Each message ~1/4 of the summarizer input: the gap is more than one batch
+        self.text = "word " * (context.SUMMARY_INPUT_TOKENS // 5)
+        self.rows = [self.conv.add_message("user" if i % 2 == 0 else "assistant", self.text) for i in range(10)]
+        self.llm = FakeLLM()
+        patcher = mock.patch.object(context, "get_llm", return_value=self.llm)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def _fitting(self, rows):
+        # Rows the summarizer can read in one call
+        used = 0
+        for n, m in enumerate(rows):
+            used += context.count_tokens(f"{m.role}: {m.content}")
+            if used > context.SUMMARY_INPUT_TOKENS:
+                return n
+        return len(rows)
+
+    def test_summary_covers_only_the_rows_it_read(self):
+        oldest_kept = self.rows[-1].id
+        context._update_summary(self.conv, oldest_kept)
+
+        n = self._fitting(self.rows[:-1])
+        self.assertLess(n, 9)
+        self.conv.refresh_from_db()
+        self.assertEqual(self.conv.summary, "summary")
+        self.assertEqual(self.conv.summary_upto_id, self.rows[n - 1].id)
+
+        # The next update picks up where this one stopped
+        context._update_summary(self.conv, oldest_kept)
+        self.conv.refresh_from_db()
+        self.assertEqual(self.conv.summary_upto_id, self.rows[n - 1 + self._fitting(self.rows[n:-1])].id)
+        self.assertIn(self.rows[n].content.strip(), self.llm.prompts[1][1].content)
+
+    def test_summary_is_updated_after_the_reply_not_while_building_the_prompt(self):
+        msgs = context.build_context(self.conv, "system prompt")
+        self.assertEqual(self.llm.prompts, [])
+        # Older turns are left out, with no summary yet
+        self.assertNotEqual(msgs[1].type, "system")
+        self.assertLess(len(msgs) - 1, len(self.rows))
+
+        context.update_summary(self.conv, "system prompt")
+        self.assertEqual(len(self.llm.prompts), 1)
+        self.conv.refresh_from_db()
+        self.assertIsNotNone(self.conv.summary_upto_id)
+
+        msgs = context.build_context(self.conv, "system prompt")
+        self.assertEqual(len(self.llm.prompts), 1)
+        self.assertIn("summary", msgs[1].content)
+
+    def test_one_huge_message_is_still_summarized(self):
+        self.rows[0].content = "word " * (context.SUMMARY_INPUT_TOKENS * 2)
+        self.rows[0].save()
+        context._update_summary(self.conv, self.rows[1].id)
+        self.conv.refresh_from_db()
+        self.assertEqual(self.conv.summary_upto_id, self.rows[0].id)
+
+
+class DownloadTests(SandboxTestCase):
+    async def test_download_streams_async_chunks(self):
+        data = "0123456789" * (fs_local.DOWNLOAD_CHUNK_BYTES // 4)
+        await sync_to_async(fs_local.write_file)(self.user.id, "docs/big.txt", data)
+        await self.async_client.aforce_login(self.user)
+
+        response = await self.async_client.get("/api/fs/download/", {"path": "docs/big.txt"})
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response.is_async)
+        self.assertEqual(response["Content-Length"], str(len(data)))
+        self.assertIn('filename="big.txt"', response["Content-Disposition"])
+        chunks = [chunk async for chunk in response.streaming_content]
+        self.assertGreater(len(chunks), 1)
+        self.assertEqual(b"".join(chunks).decode(), data)
+
+    async def test_download_missing_file(self):
+        await self.async_client.aforce_login(self.user)
+        response = await self.async_client.get("/api/fs/download/", {"path": "nope.txt"})
+        self.assertEqual(response.status_code, 404)
+
+
+class FakeStreamLLM:
+    # Streams the given chunks (none: an empty reply)
+    def __init__(self, chunks=()):
+        self.chunks = chunks
+
+    async def astream(self, msgs):
+        for chunk in self.chunks:
+            yield chunk
+
+
+@override_settings(LLM_CACHE={"ENABLED": False})
+class ChatStreamTests(SandboxTestCase):
+    def setUp(self):
+        super().setUp()
+        self.conv = Conversation.objects.create(owner=self.user)
+
+    async def _stream(self, llm):
+        await self.async_client.aforce_login(self.user)
+        with mock.patch.object(assistant, "get_llm_with_tools", return_value=llm), self.assertLogs(
+            "core.trace", "INFO"
+        ) as logs:
+            response = await self.async_client.post(f"/chat/{self.conv.id}/stream/", {"message": "hi"})
+            self.assertEqual(response.status_code, 200)
+            body = b"".join([chunk async for chunk in response.streaming_content]).decode()
+        events = [json.loads(frame[len("data: ") :]) for frame in body.split("\n\n") if frame.startswith("data: ")]
+        traces = [json.loads(line.split("trace ", 1)[1]) for line in logs.output]
+        return events, traces
+
+    async def test_stream_is_traced_after_the_request(self):
+        events, traces = await self._stream(FakeStreamLLM([AIMessageChunk(content="hello")]))
+        self.assertEqual(events[-1]["type"], "done")
+        request, stream = traces
+        self.assertEqual(request["trace"], "request")
+        self.assertEqual(stream["trace"], "chat_stream")
+        self.assertEqual(stream["request_trace_id"], request["trace_id"])
+        self.assertEqual(stream["calls"]["llm"], 1)
+
+    async def test_empty_reply_is_an_error_event(self):
+        events, traces = await self._stream(FakeStreamLLM())
+        self.assertEqual(events[-1]["type"], "error")
+        self.assertEqual(events[-1]["reason"], "empty_reply")
+        self.assertNotIn("done", [e["type"] for e in events])
+        roles = [m.role async for m in Message.objects.filter(conversation=self.conv)]
+        self.assertEqual(roles, ["user"])
+
+
+class ScriptedLLM:
+    # Answers every model call (invoke, ainvoke or astream) with the next
+    # scripted reply and keeps the history it was sent
+    def __init__(self, replies):
+        self.replies = list(replies)
+        self.seen = []
+
+    def _next(self, msgs):
+        self.seen.append(list(msgs))
+        return self.replies.pop(0)
+
+    def invoke(self, msgs):
+        return self._next(msgs)
+
+    async def ainvoke(self, msgs):
+        return self._next(msgs)
+
+    async def astream(self, msgs):
+        yield self._next(msgs)
+
+
+def scripted_reply(content="", calls=()):
+    chunks = [{"name": c["name"], "args": json.dumps(c["args"]), "id": c["id"], "index": i} for i, c in enumerate(calls)]
+    return AIMessageChunk(content=content, tool_call_chunks=chunks)
+
+
+@override_settings(LLM_CACHE={"ENABLED": False}, OLLAMA_MODEL="large", OLLAMA_SMALL_MODEL="small")
+class AgentLoopTests(SandboxTransactionTestCase):
+    # generate_reply, agenerate_reply and astream_reply run the same loop.
+    # Tools run on pool threads with their own DB connections: needs committed rows
+
+    def setUp(self):
+        super().setUp()
+        user = User.objects.create_user(username="heidi", password=None)
+        fs_local.write_file(user.id, "notes.txt", "x")
+        self.conv = Conversation.objects.create(owner=user)
+        self.conv.add_message("user", "earlier question")
+        self.conv.add_message("user", "hello there")
+        # The turn's reply placeholder: later messages are not part of its history
+        self.before = self.conv.add_message("user", "sent while the turn was queued").id
+        # small model asks for a tool (escalated), the large one asks again, then answers
+        call = [tool_call("fs_list", 1)]
+        self.llm = ScriptedLLM([scripted_reply(calls=call), scripted_reply(calls=call), scripted_reply("all done")])
+        patcher = mock.patch.object(assistant, "get_llm_with_tools", return_value=self.llm)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def check(self, text, routing):
+        self.assertEqual(text, "all done")
+        self.assertEqual(routing["initial_model"], "small")
+        self.assertEqual(routing["model"], "large")
+        self.assertEqual([e["reason"] for e in routing["escalations"]], ["tool_call"])
+        first, escalated, last = self.llm.seen
+        self.assertEqual(first, escalated)
+        self.assertEqual([m.content for m in first[1:]], ["earlier question", "hello there"])
+        self.assertEqual(last[-1].tool_call_id, "call-1")
+        self.assertIn("notes.txt", last[-1].content)
+
+    def test_generate_reply(self):
+        route_info = {}
+        text = assistant.generate_reply("hello there", self.conv, before_message_id=self.before, route_info=route_info)
+        self.check(text, route_info)
+
+    async def test_agenerate_reply(self):
+        route_info = {}
+        text = await assistant.agenerate_reply("hello there", self.conv, before_message_id=self.before, route_info=route_info)
+        self.check(text, route_info)
+
+    async def test_astream_reply(self):
+        events = [e async for e in assistant.astream_reply("hello there", self.conv, before_message_id=self.before)]
+        self.assertEqual([e["type"] for e in events], ["escalate", "tool_call", "tool_result", "token", "done"])
+        self.assertTrue(events[2]["ok"])
+        self.check(events[-1]["text"], events[-1]["routing"])
+
+
+class JobLeaseTests(SandboxTestCase):
+    def setUp(self):
+        super().setUp()
+        user = User.objects.create_user(username="bob", password=None)
+        self.conv = Conversation.objects.create(owner=user)
+        self.job = jobs.enqueue_reply(self.conv, "hello")
+
+    def expire(self, job_id):
+        AgentJob.objects.filter(id=job_id).update(lease_expires_at=timezone.now() - timedelta(seconds=1))
+
+    def test_running_job_is_not_claimed_twice(self):
+        self.assertEqual(jobs.claim_job("w1").id, self.job.id)
+        self.assertIsNone(jobs.claim_job("w2"))
+
+    def test_expired_lease_is_reclaimed(self):
+        first = jobs.claim_job("w1")
+        self.expire(first.id)
+
+        second = jobs.claim_job("w2")
+        self.assertEqual(second.id, self.job.id)
+        self.assertEqual(second.lease_owner, "w2")
+        self.assertEqual(second.attempts, 2)
+
+        # The first worker lost the job: it can neither renew nor complete it
+        self.assertFalse(jobs.renew_lease(first.id, "w1"))
+        self.assertFalse(jobs._finish(first, "w1", "late reply"))
+        self.assertTrue(jobs._finish(second, "w2", "reply"))
+        self.assertEqual(Message.objects.get(id=self.job.message_id).content, "reply")
+
+    def test_renew_lease_moves_the_expiry(self):
+        job = jobs.claim_job("w1", lease_seconds=1)
+        self.assertTrue(jobs.renew_lease(job.id, "w1", lease_seconds=600))
+        job.refresh_from_db()
+        self.assertGreater(job.lease_expires_at, timezone.now() + timedelta(seconds=500))
+
+    def test_abandoned_job_fails_after_max_attempts(self):
+        for n in range(jobs.MAX_ATTEMPTS):
+            self.assertIsNotNone(jobs.claim_job(f"w{n}"))
+            self.expire(self.job.id)
+        self.assertIsNone(jobs.claim_job("w-last"))
+        self.assertEqual(jobs.fail_abandoned_jobs(), 1)
+        self.assertEqual(Message.objects.get(id=self.job.message_id).status, Message.STATUS_FAILED)
+
+
+class JobHeartbeatTests(SandboxTransactionTestCase):
+    # The heartbeat thread has its own DB connection: needs committed rows
+
+    def test_heartbeat_keeps_a_long_turn_leased(self):
+        user = User.objects.create_user(username="carol", password=None)
+        job = jobs.enqueue_reply(Conversation.objects.create(owner=user), "hello")
+        claimed = jobs.claim_job("w1", lease_seconds=0.6)
+
+        with jobs.lease_heartbeat(claimed, "w1", lease_seconds=0.6):
+            # Longer than the lease: without renewals another worker could take it
+            time.sleep(1.0)
+            self.assertIsNone(jobs.claim_job("w2"))
+        self.assertIsNone(jobs.claim_job("w2"))
+        self.assertEqual(AgentJob.objects.get(id=job.id).lease_owner, "w1")
+
+    def test_run_job_finishes_the_turn(self):
+        user = User.objects.create_user(username="dave", password=None)
+        job = jobs.enqueue_reply(Conversation.objects.create(owner=user), "hello")
+        claimed = jobs.claim_job("w1")
+        with mock.patch.object(jobs, "generate_reply", return_value="hi there"):
+            jobs.run_job(claimed, "w1", lease_seconds=30)
+        job.refresh_from_db()
+        self.assertEqual(job.status, AgentJob.STATUS_DONE)
+        self.assertEqual(job.message.content, "hi there")
+
+
+@override_settings(
+    CACHES={
+        "default": {"BACKEND": "django.core.cache.backends.locmem.LocMemCache"},
+        "llm": {"BACKEND": "django.core.cache.backends.db.DatabaseCache", "LOCATION": "test_llm_cache"},
+    }
+)
+class SharedResponseCacheTests(SandboxTestCase):
+    def setUp(self):
+        super().setUp()
+        call_command("createcachetable", "test_llm_cache", verbosity=0)
+        self.cache = llm_cache.ResponseCache(max_entries=10, ttl=60, shared_alias="llm")
+
+    async def test_async_lookups_use_the_shared_db_cache(self):
+        await self.cache.aset("k", AIMessage(content="cached answer"))
+        # Another process: nothing in its memory tier, the DB cache has the entry
+        self.cache.memory.clear()
+        resp = await self.cache.aget("k")
+        self.assertIsNotNone(resp)
+        self.assertEqual(resp.content, "cached answer")
+        self.assertEqual(self.cache.shared_hits, 1)
+
+
+class WorkerThreadTests(SandboxTransactionTestCase):
+    # The async fs helpers run on executor threads with their own DB connections
+
+    def setUp(self):
+        super().setUp()
+        self.user = User.objects.create_user(username="erin", password=None)
+
+    async def test_worker_thread_closes_its_connection(self):
+        def query():
+            User.objects.count()
+            return connection
+
+        used = await fs_local.in_worker_thread(query)()
+        self.assertIsNone(used.connection)
+
+    async def test_async_write_updates_quota_and_index(self):
+        await fs_local.awrite_file(self.user.id, "notes/a.txt", "hello world")
+        usage = await quota.aget_usage(self.user.id)
+        self.assertEqual((usage["bytes"], usage["files"]), (11, 1))
+        found = await fs_index.asearch(self.user.id, "hello")
+        self.assertEqual([r["path"] for r in found], ["notes/a.txt"])
+
+
+@override_settings(SANDBOX_QUOTA={"MAX_BYTES": 100, "MAX_FILES": 3})
+class QuotaTests(SandboxTestCase):
+    def usage(self):
+        usage = quota.get_usage(self.user.id)
+        return usage["bytes"], usage["files"]
+
+    def test_write_over_the_quota_is_rejected_before_the_disk(self):
+        fs_local.write_file(self.user.id, "a.txt", "a" * 60)
+        with self.assertRaises(quota.QuotaExceeded):
+            fs_local.write_file(self.user.id, "b.txt", "b" * 50)
+        self.assertFalse((fs_local.user_root(self.user.id) / "b.txt").exists())
+        self.assertEqual(self.usage(), (60, 1))
+
+        fs_local.write_file(self.user.id, "b.txt", "b")
+        fs_local.write_file(self.user.id, "c.txt", "c")
+        with self.assertRaisesMessage(quota.QuotaExceeded, "3 files"):
+            fs_local.write_file(self.user.id, "d.txt", "d")
+        self.assertEqual(self.usage(), (62, 3))
+
+    def test_usage_after_overwrite(self):
+        fs_local.write_file(self.user.id, "a.txt", "a" * 60)
+        # Only the size change counts: 60 -> 90 fits in 100
+        fs_local.write_file(self.user.id, "a.txt", "a" * 90)
+        self.assertEqual(self.usage(), (90, 1))
+        fs_local.write_file(self.user.id, "a.txt", "a" * 20)
+        self.assertEqual(self.usage(), (20, 1))
+        self.assertEqual(quota.reconcile_usage(self.user.id), {"bytes": 20, "files": 1})
+
+    def test_usage_after_delete(self):
+        fs_local.write_file(self.user.id, "a.txt", "a" * 60)
+        fs_local.write_file(self.user.id, "docs/b.txt", "b" * 30)
+        with self.assertRaises(quota.QuotaExceeded):
+            fs_local.write_file(self.user.id, "c.txt", "c" * 40)
+
+        (fs_local.user_root(self.user.id) / "a.txt").unlink()
+        fs_index.reconcile(self.user.id, force=True)
+        self.assertEqual(self.usage(), (30, 1))
+        fs_local.write_file(self.user.id, "c.txt", "c" * 40)
+        self.assertEqual(self.usage(), (70, 2))
+
+
+    def test_streamed_writes_reserve_before_the_disk(self):
+        for backend in ("files", "cas"):
+            with self.subTest(backend=backend), override_settings(
+                SANDBOX_STORAGE={**settings.SANDBOX_STORAGE, "BACKEND": backend}
+            ):
+                user_id = User.objects.create_user(username=f"streamer-{backend}", password=None).id
+
+                def usage():
+                    usage = quota.get_usage(user_id)
+                    return usage["bytes"], usage["files"]
+
+                seen = []
+
+                def chunks():
+                    for n in range(3):
+                        yield b"x" * 20
+                        # Counted before the next chunk is asked for
+                        seen.append(usage())
+
+                self.assertEqual(fs_local.write_chunks(user_id, "a.bin", chunks()), 60)
+                self.assertEqual(seen, [(20, 1), (40, 1), (60, 1)])
+                self.assertEqual(usage(), (60, 1))
+
+                # 60 + 50 > 100: fails at the last chunk, nothing is left behind
+                with self.assertRaises(quota.QuotaExceeded):
+                    fs_local.write_chunks(user_id, "b.bin", [b"y" * 20] * 2 + [b"y" * 10])
+                self.assertEqual(usage(), (60, 1))
+                self.assertEqual([i["path"] for i in fs_local.list_entries(user_id)[0]], ["a.bin"])
+
+                # Appends only reserve what they add; a smaller rewrite frees the rest
+                self.assertEqual(fs_local.write_chunks(user_id, "a.bin", [b"z" * 40], append=True), 100)
+                self.assertEqual(usage(), (100, 1))
+                fs_local.write_chunks(user_id, "a.bin", [b"z" * 10])
+                self.assertEqual(usage(), (10, 1))
+
+
+    @override_settings(SANDBOX_QUOTA={"MAX_BYTES": 0, "MAX_FILES": 0})
+    def test_stream_reservation_steps(self):
+        quota.set_usage(self.user.id, 0, 0)
+        step = quota.RESERVE_STEP_BYTES
+        reservation = quota.StreamReservation(self.user.id, None)
+        reservation.grow(10)
+        # Reserved a step ahead: small chunks don't each cost an UPDATE
+        self.assertEqual(self.usage(), (step, 1))
+        reservation.grow(step)
+        self.assertEqual(self.usage(), (step, 1))
+        reservation.grow(step + 1)
+        self.assertEqual(self.usage(), (2 * step, 1))
+        reservation.settle(step + 1)
+        self.assertEqual(self.usage(), (step + 1, 1))
+        reservation.cancel()
+        self.assertEqual(self.usage(), (0, 0))
+
+class CasStorageTests(SandboxTestCase):
+    def setUp(self):
+        super().setUp()
+        storage = override_settings(SANDBOX_STORAGE={**settings.SANDBOX_STORAGE, "BACKEND": "cas"})
+        storage.enable()
+        self.addCleanup(storage.disable)
+
+    def objects(self):
+        return {digest for digest, _ in fs_cas.get_store().iter_objects()}
+
+    def test_same_content_is_stored_once(self):
+        other = User.objects.create_user(username="bob", password=None)
+        text = "shared text\n" * 100
+        fs_local.write_file(self.user.id, "a.txt", text)
+        fs_local.write_file(self.user.id, "copy/b.txt", text)
+        fs_local.write_file(other.id, "c.txt", text)
+        # Three files, one object with their content
+        files = {d for d in self.objects() if fs_cas.get_store().read(d) == text.encode()}
+        self.assertEqual(len(files), 1)
+        self.assertEqual(fs_local.read_file(other.id, "c.txt"), text)
+
+        # Rewriting the same content leaves the sandbox as it is
+        head = fs_cas.get_head(self.user.id)
+        fs_local.write_file(self.user.id, "a.txt", text)
+        self.assertEqual(fs_cas.get_head(self.user.id), head)
+        # Dedup saves disk, not quota
+        self.assertEqual(quota.get_usage(self.user.id)["bytes"], 2 * len(text))
+
+    def test_restore_snapshot(self):
+        fs_local.write_file(self.user.id, "notes/a.txt", "version one")
+        snap = fs_local.snapshot(self.user.id, label="before")
+        fs_local.write_file(self.user.id, "notes/a.txt", "version two, longer")
+        fs_local.write_file(self.user.id, "b.txt", "new file")
+
+        undo = fs_local.restore_snapshot(self.user.id, snap.id)
+        self.assertEqual(fs_local.read_file(self.user.id, "notes/a.txt"), "version one")
+        with self.assertRaises(FileNotFoundError):
+            fs_local.read_file(self.user.id, "b.txt")
+        # Index and quota follow the restored files
+        self.assertEqual([r["path"] for r in fs_index.search(self.user.id, "version")], ["notes/a.txt"])
+        usage = quota.get_usage(self.user.id)
+        self.assertEqual((usage["bytes"], usage["files"]), (len("version one"), 1))
+
+        # The state the restore replaced was saved: the restore can be undone
+        fs_local.restore_snapshot(self.user.id, undo.id)
+        self.assertEqual(fs_local.read_file(self.user.id, "notes/a.txt"), "version two, longer")
+        self.assertEqual(fs_local.read_file(self.user.id, "b.txt"), "new file")
+
+
+class SandboxFingerprintTests(SandboxTestCase):
+    def test_fingerprint_changes_with_the_sandbox_without_a_walk(self):
+        with mock.patch.object(fs_index, "reconcile") as reconcile:
+            before = llm_cache.sandbox_fingerprint(self.user.id)
+            fs_local.write_file(self.user.id, "a.txt", "aaaa")
+            after_write = llm_cache.sandbox_fingerprint(self.user.id)
+            # Same size, different content
+            fs_local.write_file(self.user.id, "a.txt", "bbbb")
+            after_rewrite = llm_cache.sandbox_fingerprint(self.user.id)
+            reconcile.assert_not_called()
+        self.assertEqual(len({before, after_write, after_rewrite}), 3)
+        self.assertEqual(after_rewrite, llm_cache.sandbox_fingerprint(self.user.id))
+
+    def test_reconciled_outside_change_changes_the_fingerprint(self):
+        fs_local.write_file(self.user.id, "a.txt", "aaaa")
+        before = llm_cache.sandbox_fingerprint(self.user.id)
+        (fs_local.user_root(self.user.id) / "a.txt").unlink()
+        fs_index.reconcile(self.user.id, force=True)
+        self.assertNotEqual(before, llm_cache.sandbox_fingerprint(self.user.id))
+
+
+class ShapeTests(SimpleTestCase):
+    def test_cut_points_fs_read_at_the_first_omitted_line(self):
+        lines = [f"line {n} " + "word " * 20 for n in range(1, 101)]
+        resume = tools._resume_read({"path": "a.txt", "start_line": 10})
+        text, tokens, cut = tool_output.shape("\n".join(lines), 200, resume)
+        self.assertTrue(cut)
+        shown = text.split("\n")
+        kept = shown.index(next(line for line in shown if line.startswith("[...")))
+        self.assertEqual(shown[:kept], lines[:kept])
+        self.assertIn(f"start_line={10 + kept}", text)
+
+    def test_first_line_over_budget_is_skipped_by_the_cursor(self):
+        lines = ["x" * 4000] + [f"short {n}" for n in range(5)]
+        resume = tools._resume_read({"path": "a.txt", "start_line": 10})
+        text, tokens, cut = tool_output.shape("\n".join(lines), 200, resume)
+        self.assertTrue(cut)
+        self.assertIn("the first line is too long", text)
+        self.assertTrue(text.startswith("x" * 100))
+        # Everything after line 10 fits in the tail: nothing to resume
+        self.assertNotIn("start_line", text)
+        self.assertTrue(text.endswith("short 4"))
+
+        lines = ["x" * 4000] + ["word " * 30 for _ in range(50)]
+        text, tokens, cut = tool_output.shape("\n".join(lines), 200, resume)
+        tail = len(text.split("\n")) - 2
+        self.assertIn(f"{50 - tail} lines omitted", text)
+        self.assertIn(f"start_line=11 max_lines={50 - tail}", text)
+
+
+class ToolHintTests(SimpleTestCase):
+    def test_file_tasks(self):
+        for text in ("read notes.txt", "what's in report.PDF", "list my files", "open docs/readme", "clean my sandbox"):
+            with self.subTest(text=text):
+                self.assertTrue(routing.TOOL_HINT_RE.search(text))
+
+    def test_chat(self):
+        for text in (
+            "is GPT-3.5 better than 4?",
+            "fruit, e.g. apples",
+            "write a poem about the sea",
+            "list three reasons to learn Go",
+            "add 1/2 cup of sugar",
+            "open 24/7",
+            "tea and/or coffee",
+            "a trip to Washington D.C.",
+        ):
+            with self.subTest(text=text):
+                self.assertIsNone(routing.TOOL_HINT_RE.search(text))
+
+
+def tool_call(name, n, **args):
+    return {"name": name, "args": args, "id": f"call-{n}"}
+
+
+class ToolOrderingTests(SandboxTransactionTestCase):
+    # Tools run on pool threads with their own DB connections: needs committed rows
+
+    def setUp(self):
+        super().setUp()
+        self.user = User.objects.create_user(username="frank", password=None)
+
+    def test_read_after_write_sees_the_new_content(self):
+        fs_local.write_file(self.user.id, "notes/a.txt", "old text")
+        calls = [
+            tool_call("fs_write", 1, path="notes/a.txt", content="new text"),
+            tool_call("fs_read", 2, path="./notes//a.txt"),
+            tool_call("fs_search", 3, query="new"),
+            tool_call("fs_list", 4, path="notes"),
+        ]
+        results = tools.run_tool_calls(calls, self.user.id)
+        self.assertEqual([r.tool_call_id for r in results], ["call-1", "call-2", "call-3", "call-4"])
+        self.assertIn("new text", results[1].content)
+        self.assertIn("notes/a.txt", results[2].content)
+        self.assertIn("a.txt", results[3].content)
+
+    def test_write_waits_for_an_earlier_read_of_the_same_file(self):
+        fs_local.write_file(self.user.id, "a.txt", "before")
+        calls = [tool_call("fs_read", 1, path="a.txt"), tool_call("fs_write", 2, path="./a.txt", content="after")]
+        results = tools.run_tool_calls(calls, self.user.id)
+        self.assertIn("before", results[0].content)
+        self.assertEqual(fs_local.read_file(self.user.id, "a.txt"), "after")
+
+
+class ToolSchedulingTests(TestCase):
+    # Scheduling only, with a fake run_tool_call
+
+    def setUp(self):
+        self.events = []
+        self.lock = threading.Lock()
+        self.write_started = threading.Event()
+
+        def fake_run(call, user_id, max_tokens):
+            with self.lock:
+                self.events.append(("start", call["id"]))
+            if call["name"] == "fs_write":
+                self.write_started.set()
+                time.sleep(0.3)
+            with self.lock:
+                self.events.append(("end", call["id"]))
+            return tools.ToolMessage(content="ok", tool_call_id=call["id"])
+
+        for target, value in (
+            ("run_tool_call", fake_run),
+            ("_executor", ThreadPoolExecutor(max_workers=2)),
+        ):
+            patcher = mock.patch.object(tools, target, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def test_waiting_calls_do_not_hold_pool_threads(self):
+        # Two workers: the write takes one, the read of its path waits without
+        # taking the other, so the unrelated read runs right away
+        calls = [
+            tool_call("fs_write", 1, path="a.txt", content="x"),
+            tool_call("fs_read", 2, path="a.txt"),
+            tool_call("fs_read", 3, path="b.txt"),
+        ]
+        tools.run_tool_calls(calls, 1)
+        order = self.events
+        self.assertLess(order.index(("end", "call-3")), order.index(("end", "call-1")))
+        self.assertLess(order.index(("end", "call-1")), order.index(("start", "call-2")))
+
+    def test_timed_out_waiting_call_never_starts(self):
+        calls = [tool_call("fs_write", 1, path="a.txt", content="x"), tool_call("fs_read", 2, path="a.txt")]
+        with mock.patch.dict(tools.TOOL_TIMEOUTS, {"fs_write": 0.05, "fs_read": 0.05}):
+            results = tools.run_tool_calls(calls, 1)
+        self.assertTrue(all("timed out" in r.content for r in results))
+        time.sleep(0.4)
+        self.assertNotIn(("start", "call-2"), self.events)
+
+
+class BatchResumeTests(SandboxTransactionTestCase):
+    # Records run on a pool thread: needs committed rows (one worker, the
+    # in-memory test database locks tables between concurrent writers)
+
+    def setUp(self):
+        super().setUp()
+        self.user = User.objects.create_user(username="grace", password=None)
+        self.prompts = []
+
+        def fake_reply(prompt, conv, route_info=None):
+            self.prompts.append(prompt)
+            route_info["model"] = "fake"
+            return f"re: {prompt}"
+
+        patcher = mock.patch.object(batch, "generate_reply", fake_reply)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def _write_input(self, records):
+        path = f"{self.tmp}/in.jsonl"
+        with open(path, "w") as f:
+            f.writelines(json.dumps(r) + "\n" for r in records)
+        return path
+
+    def _results(self, path):
+        # Result lines by input line, skipping a line cut off by a crash
+        results = {}
+        with open(path) as f:
+            for line in f:
+                try:
+                    result = json.loads(line)
+                except ValueError:
+                    continue
+                results[result["line"]] = result
+        return results
+
+    def test_resume_skips_finished_lines(self):
+        records = [
+            {"id": n, "user": "grace", "prompt": f"p{n}", "conversation": "thread" if n in (1, 3) else None}
+            for n in range(1, 5)
+        ]
+        path = self._write_input(records)
+        out = f"{self.tmp}/out.jsonl"
+
+        stats = batch.run_batch(path, out, workers=1, limit=2)
+        self.assertEqual(stats["ok"], 2)
+        self.assertEqual(self.prompts, ["p1", "p2"])
+        # A crash mid-write leaves a cut-off line behind
+        with open(out, "a") as f:
+            f.write('{"line": 3, "rep')
+
+        stats = batch.run_batch(path, out, workers=1, resume=True)
+        self.assertEqual((stats["ok"], stats["skipped"]), (2, 2))
+        self.assertCountEqual(self.prompts, ["p1", "p2", "p3", "p4"])
+
+        results = self._results(out)
+        self.assertEqual(sorted(results), [1, 2, 3, 4])
+        # The named conversation goes on in the one the first run created
+        self.assertEqual(results[3]["conversation_id"], results[1]["conversation_id"])
+        self.assertEqual(Conversation.objects.get(id=results[1]["conversation_id"]).message_count, 4)
+
+        stats = batch.run_batch(path, out, workers=1, resume=True)
+        self.assertEqual((stats["records"], stats["skipped"]), (0, 4))
+
+    def test_retry_errors_runs_failed_lines_again(self):
+        path = self._write_input([{"user": "nobody", "prompt": "p1"}, {"user": "grace", "prompt": "p2"}])
+        out = f"{self.tmp}/out.jsonl"
+        batch.run_batch(path, out, workers=1)
+        User.objects.create_user(username="nobody", password=None)
+
+        stats = batch.run_batch(path, out, workers=1, resume=True)
+        self.assertEqual(stats["records"], 0)
+        stats = batch.run_batch(path, out, workers=1, resume=True, retry_errors=True)
+        self.assertEqual((stats["ok"], stats["skipped"]), (1, 1))
+        self.assertEqual(self.prompts, ["p2", "p1"])
+
+
+class AuditWriterTests(IsolatedFiles, SimpleTestCase):
+    def writer(self, **kwargs):
+        writer = audit.AuditWriter(Path(self.tmp) / "audit", flush_seconds=0.05, **kwargs)
+        self.addCleanup(writer.flush)
+        return writer
+
+    def records(self, directory):
+        lines = [line for path in audit.log_files(directory) for line in read_audit_lines(path)]
+        return [json.loads(line) for line in lines]
+
+    def test_batches_rotate_and_read_back(self):
+        for compress in (False, True):
+            with self.subTest(compress=compress):
+                writer = self.writer(compress=compress, batch_size=4, max_bytes=150)
+                for n in range(20):
+                    writer.submit({"event": "e", "n": n, "pad": "x" * 20})
+                self.assertTrue(writer.flush())
+
+                files = audit.log_files(writer.directory)
+                self.assertGreater(len(files), 1)
+                suffix = ".jsonl.zst" if compress else ".jsonl"
+                self.assertTrue(all(p.name.endswith(suffix) for p in files))
+                self.assertTrue(all(audit.parse_file_start(p.name) for p in files))
+                self.assertEqual([r["n"] for r in self.records(writer.directory)], list(range(20)))
+                shutil.rmtree(writer.directory)
+
+    def test_oldest_files_are_deleted(self):
+        writer = self.writer(batch_size=1, max_bytes=1, keep_files=3)
+        for n in range(6):
+            writer.submit({"n": n})
+            writer.flush()
+        self.assertEqual(len(audit.log_files(writer.directory)), 3)
+        self.assertEqual([r["n"] for r in self.records(writer.directory)], [3, 4, 5])
+
+    def test_full_queue_drops_records(self):
+        writer = self.writer(queue_size=2)
+        before = audit.DROPPED.value()
+        # No writer thread: nothing takes records off the queue
+        with mock.patch.object(writer, "_ensure_started"):
+            for n in range(5):
+                writer.submit({"n": n})
+        self.assertEqual(audit.DROPPED.value() - before, 3)
+
+    def test_audit_adds_the_context_fields(self):
+        with override_settings(AUDIT_LOG={**settings.AUDIT_LOG, "ENABLED": True, "FLUSH_SECONDS": 0.05}):
+            audit._writer = None
+            self.addCleanup(setattr, audit, "_writer", None)
+            with audit.audit_context(conversation_id=7):
+                audit.audit("tool_call", user_id=3, tool="fs_read")
+            audit.audit("chat_message", user_id=3)
+            self.assertTrue(audit.flush())
+            records = self.records(Path(settings.AUDIT_LOG["DIR"]))
+        self.assertEqual([r["event"] for r in records], ["tool_call", "chat_message"])
+        self.assertEqual(records[0]["conversation_id"], 7)
+        self.assertNotIn("conversation_id", records[1])
+        self.assertTrue(records[0]["ts"].endswith("Z"))
+
+
+class AuditLogCommandTests(IsolatedFiles, TestCase):
+    def setUp(self):
+        super().setUp()
+        self.alice = User.objects.create_user(username="alice", password=None)
+        self.bob = User.objects.create_user(username="bob", password=None)
+        self.directory = Path(self.tmp) / "audit"
+        # Records 10, 20, ... 60 minutes after the first file was started
+        self.start = datetime.now(dt_timezone.utc)
+        for compress, minutes in ((False, (10, 20, 30)), (True, (40, 50, 60))):
+            writer = audit.AuditWriter(self.directory, compress=compress, flush_seconds=0.05)
+            for m in minutes:
+                user = self.alice if m % 20 else self.bob
+                writer.submit(
+                    {
+                        "ts": audit._timestamp((self.start + timedelta(minutes=m)).timestamp()),
+                        "event": "chat_message" if m <= 30 else "tool_call",
+                        "user_id": user.id,
+                        "conversation_id": m // 10,
+                        "minute": m,
+                    }
+                )
+            writer.flush()
+            # The last write of the file (what --since compares to)
+            last = (self.start + timedelta(minutes=minutes[-1])).timestamp()
+            for path in audit.log_files(self.directory):
+                if path.name.endswith(".zst") == compress:
+                    os.utime(path, (last, last))
+
+    def query(self, *args):
+        out = io.StringIO()
+        call_command("audit_log", "--dir", str(self.directory), *args, stdout=out)
+        return [json.loads(line)["minute"] for line in out.getvalue().splitlines()]
+
+    def at(self, minutes):
+        return (self.start + timedelta(minutes=minutes)).isoformat()
+
+    def test_filters(self):
+        self.assertEqual(self.query(), [10, 20, 30, 40, 50, 60])
+        self.assertEqual(self.query("--user", "alice"), [10, 30, 50])
+        self.assertEqual(self.query("--user", str(self.bob.id)), [20, 40, 60])
+        self.assertEqual(self.query("--conversation", "4"), [40])
+        self.assertEqual(self.query("--event", "tool_call", "--user", "bob"), [40, 60])
+        self.assertEqual(self.query("--limit", "2"), [10, 20])
+
+    def test_time_range(self):
+        self.assertEqual(self.query("--since", self.at(25), "--until", self.at(45)), [30, 40])
+        # Files entirely before --since are not opened
+        with mock.patch("core.management.commands.audit_log.read_lines", wraps=read_audit_lines) as read:
+            self.assertEqual(self.query("--since", self.at(35)), [40, 50, 60])
+        self.assertEqual(read.call_count, 1)
+
+    def test_count(self):
+        out = io.StringIO()
+        call_command("audit_log", "--dir", str(self.directory), "--user", "alice", "--count", stdout=out)
+        self.assertEqual(out.getvalue().strip(), "3")
+
+
+class AdmissionTests(SimpleTestCase):
+    def controller(self, **kwargs):
+        conf = {"max_concurrent": 2, "max_per_user": 1, "max_queue": 3, "max_queue_per_user": 2, "max_wait": 5}
+        return admission.AdmissionController(**{**conf, **kwargs})
+
+    def enter(self, controller, user_id, granted):
+        # Queue without blocking; granted gets user_id when the slot is handed over
+        return controller._enter(user_id, lambda: granted.append(user_id))
+
+    def test_global_and_per_user_limits(self):
+        c = self.controller()
+        granted = []
+        self.assertIsNone(self.enter(c, 1, granted))
+        # User 1 is at their limit and waits, user 2 queues behind (no barging)
+        # but gets the free slot right away
+        self.assertIsNotNone(self.enter(c, 1, granted))
+        self.enter(c, 2, granted)
+        self.assertEqual(granted, [2])
+        # Both slots taken
+        self.assertIsNotNone(self.enter(c, 3, granted))
+        self.assertEqual((c.running, c.waiting), (2, 2))
+
+        # User 2's slot can't go to user 1 (still running): user 3 gets it
+        c._leave(2, time.monotonic())
+        self.assertEqual(granted, [2, 3])
+        c._leave(1, time.monotonic())
+        self.assertEqual(granted, [2, 3, 1])
+        self.assertEqual((c.running, c.waiting), (2, 0))
+
+    def test_free_slots_go_round_robin(self):
+        c = self.controller(max_concurrent=1, max_per_user=5, max_queue=10)
+        granted = []
+        self.assertIsNone(self.enter(c, 1, granted))
+        for user_id in (2, 2, 3):
+            self.enter(c, user_id, granted)
+        self.enter(c, 4, granted)
+        # Each finished run hands the slot to the next user in line; user 2's
+        # second request waits until everyone else had a turn
+        running = 1
+        for _ in range(4):
+            c._leave(running, time.monotonic())
+            running = granted[-1]
+        self.assertEqual(granted, [2, 3, 4, 2])
+
+    def test_rejections(self):
+        c = self.controller(max_concurrent=1, max_queue=3, max_queue_per_user=2)
+        self.enter(c, 1, [])
+        self.enter(c, 2, [])
+        self.enter(c, 2, [])
+        with self.assertRaises(admission.Overloaded) as caught:
+            self.enter(c, 2, [])
+        self.assertEqual(caught.exception.reason, "user_queue_full")
+        self.enter(c, 3, [])
+        with self.assertRaises(admission.Overloaded) as caught:
+            self.enter(c, 4, [])
+        self.assertEqual(caught.exception.reason, "queue_full")
+
+    def test_wait_timeout_leaves_the_queue(self):
+        c = self.controller(max_concurrent=1, max_wait=0.05)
+        c.acquire(1)
+        with self.assertRaises(admission.Overloaded) as caught:
+            c.acquire(2)
+        self.assertEqual(caught.exception.reason, "wait_timeout")
+        self.assertEqual((c.running, c.waiting, dict(c.queues)), (1, 0, {}))
+
+    def test_retry_after(self):
+        c = self.controller(max_concurrent=2, max_queue=2)
+        c.avg_run_seconds = 10
+        for user_id in (1, 2, 3, 4):
+            self.enter(c, user_id, [])
+        with self.assertRaises(admission.Overloaded) as caught:
+            self.enter(c, 5, [])
+        # Two waiting plus this request, two at a time, 10 s each
+        self.assertEqual(caught.exception.retry_after, 15)
+
+    def test_release_is_idempotent(self):
+        c = self.controller()
+        release = c.acquire(1)
+        release()
+        release()
+        self.assertEqual((c.running, c.running_by_user), (0, {}))
+
+    async def test_slot_granted_after_cancel_is_given_back(self):
+        c = self.controller(max_concurrent=1)
+        release = c.acquire(1)
+        task = asyncio.ensure_future(c.aacquire(2))
+        await asyncio.sleep(0)
+        self.assertEqual(c.waiting, 1)
+        # The client goes away, and the slot is handed over before the task sees it
+        task.cancel()
+        release()
+        with self.assertRaises(asyncio.CancelledError):
+            await task
+        self.assertEqual((c.running, c.waiting, c.running_by_user), (0, 0, {}))
+
+
+class AdmissionViewTests(SandboxTestCase):
+    def test_busy_server_answers_429_with_retry_after(self):
+        conv = Conversation.objects.create(owner=self.user)
+        conf = {**settings.ADMISSION, "MAX_CONCURRENT": 1, "MAX_QUEUE": 0}
+        with override_settings(ADMISSION=conf, AGENT_JOBS_ENABLED=False):
+            admission._controller = None
+            self.addCleanup(setattr, admission, "_controller", None)
+            # Someone else holds the only slot
+            admission.get_controller().acquire(self.user.id + 1)
+            self.client.force_login(self.user)
+            response = self.client.post(f"/chat/{conv.id}/stream/", {"message": "hi"})
+        self.assertEqual(response.status_code, 429)
+        self.assertEqual(response["Retry-After"], str(response.json()["retry_after"]))
+        self.assertGreaterEqual(int(response["Retry-After"]), 1)
+        # A rejected message is not saved
+        self.assertFalse(Message.objects.filter(conversation=conv).exists())
+
+
+class MessageSearchTests(SandboxTestCase):
+    def setUp(self):
+        super().setUp()
+        if message_search.backend() != "fts5":
+            self.skipTest("SQLite without FTS5")
+        self.conv = Conversation.objects.create(owner=self.user)
+
+    def found(self, query, user=None):
+        return [r["message_id"] for r in message_search.search_messages((user or self.user).id, query)]
+
+    def indexed(self, word):
+        with connection.cursor() as cursor:
+            cursor.execute(
+                f"SELECT rowid FROM {message_search.FTS_TABLE} WHERE {message_search.FTS_TABLE} MATCH %s",
+                [message_search.fts_query(word)],
+            )
+            return [row[0] for row in cursor.fetchall()]
+
+    def test_insert_is_indexed(self):
+        msg = self.conv.add_message("user", "the quick brown fox")
+        self.assertEqual(self.found("quick"), [msg.id])
+        # The last term is a prefix
+        self.assertEqual(self.found("brown fo"), [msg.id])
+        hit = message_search.search_messages(self.user.id, "fox")[0]
+        self.assertEqual(hit["conversation_id"], self.conv.id)
+        self.assertIn("[fox]", hit["snippet"])
+
+    def test_pending_reply_is_reindexed_when_finished(self):
+        msg = self.conv.add_message("assistant", "", status=Message.STATUS_PENDING)
+        Message.objects.filter(id=msg.id).update(content="thinking about walruses")
+        Message.objects.filter(id=msg.id).update(content="the answer is penguins", status=Message.STATUS_DONE)
+        self.assertEqual(self.found("penguins"), [msg.id])
+        self.assertEqual(self.found("walruses"), [])
+        self.assertEqual(self.indexed("walruses"), [])
+
+    def test_delete_is_unindexed(self):
+        msg = self.conv.add_message("user", "ephemeral note")
+        msg.delete()
+        self.assertEqual(self.found("ephemeral"), [])
+        self.assertEqual(self.indexed("ephemeral"), [])
+
+    def test_fts_query_escaping(self):
+        self.assertEqual(message_search.fts_query('say "hi" NEAR/2 x*'), '"say" "hi" "NEAR" "2" "x"*')
+        self.assertEqual(message_search.fts_query('AND OR ( ) ^'), '"AND" "OR"*')
+        self.assertEqual(message_search.fts_query('"" * -'), "")
+        # Operators in the query are plain words, not FTS syntax errors
+        msg = self.conv.add_message("user", "NEAR the AND gate")
+        self.assertEqual(self.found('NEAR( "AND'), [msg.id])
+        self.assertEqual(self.found('"'), [])
+
+    def test_only_own_messages(self):
+        bob = get_user_model().objects.create_user("bob", password="pw")
+        other = Conversation.objects.create(owner=bob)
+        theirs = other.add_message("user", "shared secret word")
+        mine = self.conv.add_message("user", "another secret word")
+        self.assertEqual(self.found("secret"), [mine.id])
+        self.assertEqual(self.found("secret", user=bob), [theirs.id])
+
+    def test_admin_matching(self):
+        bob = get_user_model().objects.create_user("bob", password="pw")
+        other = Conversation.objects.create(owner=bob)
+        a = self.conv.add_message("user", "lighthouse keeper")
+        b = other.add_message("assistant", "the lighthouse is closed")
+        self.conv.add_message("user", "nothing relevant")
+        matches = message_search.matching(Message.objects.all(), "lighthouse")
+        self.assertEqual(set(matches.values_list("id", flat=True)), {a.id, b.id})
+        self.assertEqual(set(message_search.matching(Message.objects.filter(role="user"), "lighthouse")), {a})
+        self.assertFalse(message_search.matching(Message.objects.all(), "!!").exists())
+
+        admin = get_user_model().objects.create_superuser("root", password="pw")
+        self.client.force_login(admin)
+        resp = self.client.get("/admin/core/message/", {"q": "keeper"})
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(list(resp.context["cl"].result_list), [a])
+
+
+class SandboxHandleTests(IsolatedFiles, SimpleTestCase):
+    def setUp(self):
+        super().setUp()
+        self.addCleanup(sandbox.close_all)
+        self.outside = Path(self.tmp) / "outside"
+        self.outside.mkdir()
+        (self.outside / "secret.txt").write_text("top secret")
+
+    def is_open(self, fd):
+        try:
+            os.fstat(fd)
+        except OSError:
+            return False
+        return True
+
+    def test_clean_parts(self):
+        self.assertEqual(sandbox.clean_parts("docs/./a.txt"), ("docs", "a.txt"))
+        self.assertEqual(sandbox.clean_parts(" `docs//b/../a.txt` "), ("docs", "a.txt"))
+        for bad in ("../x", "a/../../x", "..", "/etc/passwd", '"/etc/passwd"', "a\0b"):
+            with self.subTest(bad=bad), self.assertRaises(ValueError):
+                sandbox.clean_parts(bad)
+
+    def test_symlinks_are_refused(self):
+        root = sandbox.sandbox_path(1)
+        (root / "docs").mkdir(parents=True)
+        (root / "docs" / "real.txt").write_text("ok")
+        os.symlink(self.outside, root / "dirlink")
+        os.symlink(self.outside, root / "docs" / "dirlink")
+        os.symlink(self.outside / "secret.txt", root / "filelink")
+        os.symlink(root / "docs" / "real.txt", root / "docs" / "inner.txt")
+        with sandbox.sandbox(1) as sb:
+            fd = sb.open(("docs", "real.txt"))
+            os.close(fd)
+            for parts in (("dirlink",), ("docs", "dirlink")):
+                with self.subTest(parts=parts), self.assertRaisesRegex(ValueError, "symlinks"):
+                    sb.open_dir(parts)
+            # A link in the middle of the path, or as the file itself
+            for parts in (("dirlink", "secret.txt"), ("docs", "dirlink", "secret.txt"), ("filelink",), ("docs", "inner.txt")):
+                with self.subTest(parts=parts), self.assertRaisesRegex(ValueError, "symlinks"):
+                    os.close(sb.open(parts))
+            with self.assertRaisesRegex(ValueError, "symlinks"):
+                with sb.parent(("dirlink", "new.txt"), create=True):
+                    pass
+        self.assertFalse((self.outside / "new.txt").exists())
+
+    def test_parent_creates_folders(self):
+        with sandbox.sandbox(1) as sb:
+            with sb.parent(("a", "b", "c.txt"), create=True) as (dir_fd, name):
+                self.assertEqual(name, "c.txt")
+                os.close(os.open(name, os.O_WRONLY | os.O_CREAT, 0o644, dir_fd=dir_fd))
+            with self.assertRaises(FileNotFoundError):
+                sb.open_dir(("missing",))
+        self.assertTrue((sandbox.sandbox_path(1) / "a" / "b" / "c.txt").is_file())
+
+    def test_lru_eviction(self):
+        with mock.patch.object(sandbox, "MAX_OPEN_HANDLES", 2):
+            with sandbox.sandbox(1) as busy:
+                with sandbox.sandbox(2) as idle:
+                    pass
+                with sandbox.sandbox(3):
+                    pass
+                # User 1 was least recently used but is still in use: evicted, not closed
+                self.assertTrue(busy.evicted)
+                self.assertTrue(self.is_open(busy.fd))
+                self.assertFalse(idle.evicted)
+                with sandbox.sandbox(4):
+                    pass
+                # An idle evicted handle is closed right away
+                self.assertTrue(idle.evicted)
+                self.assertFalse(self.is_open(idle.fd))
+                self.assertEqual(len(sandbox._handles), 2)
+                with sandbox.sandbox(1) as again:
+                    self.assertIsNot(again, busy)
+                self.assertTrue(self.is_open(busy.fd))
+            # ... and the busy one by its last user
+            self.assertEqual(busy.users, 0)
+            self.assertFalse(self.is_open(busy.fd))
+
+    def test_stale_handle_is_replaced(self):
+        with sandbox.sandbox(1) as first:
+            pass
+        shutil.rmtree(sandbox.sandbox_path(1))
+        with sandbox.sandbox(1) as second:
+            self.assertIsNot(second, first)
+            self.assertTrue(sandbox.sandbox_path(1).is_dir())
+        self.assertTrue(first.evicted)
+
+
+class HealthCheckTests(SimpleTestCase):
+    def setUp(self):
+        llm_pool.reset_pool()
+        self.addCleanup(llm_pool.reset_pool)
+        self.addCleanup(llm_pool.stop_health_checks)
+
+    def checkers(self):
+        return [t for t in threading.enumerate() if t.name == "ollama-health" and t.is_alive()]
+
+    def test_model_calls_do_not_start_the_checker(self):
+        llm_pool.get_pool()
+        self.assertIsNone(llm_pool._stop_checks)
+        self.assertEqual(self.checkers(), [])
+
+    def test_started_once(self):
+        with override_settings(OLLAMA_HEALTH_CHECK_SECONDS=0):
+            self.assertFalse(llm_pool.start_health_checks())
+        with override_settings(OLLAMA_HEALTH_CHECK_SECONDS=60):
+            self.assertTrue(llm_pool.start_health_checks())
+            self.assertFalse(llm_pool.start_health_checks())
+        self.assertEqual(len(self.checkers()), 1)
+
+    def test_server_startup(self):
+        with mock.patch.object(llm, "warm_up") as warm_up, mock.patch.object(llm, "start_health_checks") as start:
+            with override_settings(OLLAMA_WARM_UP_ON_STARTUP=False):
+                llm.warm_up_if_enabled()
+            warm_up.assert_not_called()
+            with override_settings(OLLAMA_WARM_UP_ON_STARTUP=True):
+                llm.warm_up_if_enabled()
+            warm_up.assert_called_once_with()
+        self.assertEqual(start.call_count, 2)
+
+    @override_settings(OLLAMA_RESIDENT_MODELS=["big"], OLLAMA_BACKENDS=[])
+    def test_models_load_off_the_check_round(self):
+        pool = llm_pool.get_pool()
+        backend = pool.backends[0]
+        release = threading.Event()
+        posts = []
+
+        def slow_load(url, **kwargs):
+            posts.append(kwargs["json"]["model"])
+            release.wait(5)
+
+        ps = mock.Mock(json=mock.Mock(return_value={"models": []}))
+        with mock.patch.object(llm_pool.httpx, "get", return_value=ps), mock.patch.object(
+            llm_pool.httpx, "post", side_effect=slow_load
+        ):
+            started = time.monotonic()
+            pool.check()
+            # The next round doesn't queue a second load of the same model
+            pool.check()
+            self.assertLess(time.monotonic() - started, 1)
+            release.set()
+            for t in threading.enumerate():
+                if t.name == "ollama-load":
+                    t.join(5)
+        self.assertTrue(backend.healthy)
+        self.assertEqual(posts, ["big"])
+        self.assertEqual(pool._loading, set())
+
+
+class PaginationTests(SandboxTestCase):
+    def setUp(self):
+        super().setUp()
+        self.conv = Conversation.objects.create(owner=self.user)
+        self.rows = [self.conv.add_message("user", f"message {n}") for n in range(7)]
+        # Rows 1-5 share one timestamp: every page boundary below falls inside it
+        same = timezone.now() - timedelta(hours=1)
+        Message.objects.filter(id__in=[m.id for m in self.rows[1:6]]).update(created_at=same)
+        Message.objects.filter(id=self.rows[0].id).update(created_at=same - timedelta(seconds=1))
+        # Newest first, ties broken by id
+        self.expected = [m.id for m in reversed(self.rows)]
+
+    def test_cursor_round_trip(self):
+        value = datetime(2026, 3, 1, 12, 30, 15, 123456, tzinfo=dt_timezone.utc)
+        cursor = encode_cursor(value, 42)
+        self.assertNotIn("=", cursor)
+        self.assertEqual(decode_cursor(cursor), (value, 42))
+        # ... the last one is base64 of "not|a date"
+        for bad in ("", "not a cursor", encode_cursor(value, 42)[:-3], "bm90fGEgZGF0ZQ"):
+            with self.subTest(bad=bad), self.assertRaises(ValueError):
+                decode_cursor(bad)
+
+    def test_pages_with_equal_timestamps(self):
+        for limit in (1, 2, 3, 4):
+            with self.subTest(limit=limit):
+                seen, cursor = [], None
+                while True:
+                    rows, cursor = keyset_page(self.conv.messages.all(), "created_at", cursor, limit)
+                    self.assertLessEqual(len(rows), limit)
+                    seen.extend(m.id for m in rows)
+                    if cursor is None:
+                        break
+                self.assertEqual(seen, self.expected)
+
+    def test_history_api_pages(self):
+        self.client.force_login(self.user)
+        url = f"/api/chat/{self.conv.id}/messages/"
+        seen, cursor = [], None
+        while True:
+            params = {"limit": 3, **({"before": cursor} if cursor else {})}
+            data = self.client.get(url, params).json()
+            # Each page is oldest -> newest, pages go back in time
+            ids = [m["id"] for m in data["messages"]]
+            self.assertEqual(ids, [i for i in self.expected[::-1] if i in ids])
+            seen = ids + seen
+            cursor = data["next_cursor"]
+            if cursor is None:
+                break
+        self.assertEqual(seen, self.expected[::-1])
+
+    def test_invalid_cursor(self):
+        self.client.force_login(self.user)
+        resp = self.client.get(f"/api/chat/{self.conv.id}/messages/", {"before": "garbage"})
+        self.assertEqual(resp.status_code, 400)
+        self.assertEqual(resp.json(), {"error": "invalid cursor"})
+        resp = self.client.get("/", {"before": "garbage"})
+        self.assertRedirects(resp, "/", fetch_redirect_response=False)
+
+
+class ListingTests(SandboxTestCase):
+    # Walk order: names sorted per folder, so "b/..." comes before "b-x.txt"
+    # even though "b-" < "b/" as strings
+    ORDER = ["a.txt", "b", "b/c.txt", "b/d", "b/d/e.txt", "b/d/f", "b/d/f/g.txt", "b-x.txt", "z"]
+
+    def setUp(self):
+        super().setUp()
+        for path in ("a.txt", "b/c.txt", "b/d/e.txt", "b/d/f/g.txt", "b-x.txt"):
+            fs_local.write_file(self.user.id, path, path)
+        root = fs_local.user_root(self.user.id)
+        (root / "z").mkdir()
+        # In-flight temp file of a write: never listed
+        (root / "b" / ".c.txt.1234.tmp").write_text("partial")
+
+    def paths(self, items):
+        return [item["path"] for item in items]
+
+    def page_through(self, limit, **kwargs):
+        seen, cursor, pages = [], "", 0
+        while True:
+            items, cursor = fs_local.list_entries(self.user.id, limit=limit, cursor=cursor or "", **kwargs)
+            pages += 1
+            if cursor is not None:
+                # A full page, resumed after its last entry
+                self.assertEqual(len(items), limit)
+                self.assertEqual(cursor, items[-1]["path"])
+            seen.extend(self.paths(items))
+            if cursor is None:
+                return seen, pages
+
+    def test_full_listing(self):
+        items, cursor = fs_local.list_entries(self.user.id)
+        self.assertIsNone(cursor)
+        self.assertEqual(self.paths(items), self.ORDER)
+        self.assertEqual([i["depth"] for i in items], [1, 1, 2, 2, 3, 3, 4, 1, 1])
+
+    def test_depth_limit(self):
+        items, _ = fs_local.list_entries(self.user.id, max_depth=1)
+        self.assertEqual(self.paths(items), ["a.txt", "b", "b-x.txt", "z"])
+        items, _ = fs_local.list_entries(self.user.id, max_depth=2)
+        self.assertEqual(self.paths(items), ["a.txt", "b", "b/c.txt", "b/d", "b-x.txt", "z"])
+        items, _ = fs_local.list_entries(self.user.id, "b", max_depth=1)
+        self.assertEqual(self.paths(items), ["c.txt", "d"])
+
+    def test_pages_neither_repeat_nor_skip(self):
+        for limit in range(1, len(self.ORDER) + 1):
+            with self.subTest(limit=limit):
+                seen, pages = self.page_through(limit)
+                self.assertEqual(seen, self.ORDER)
+                # No empty last page: a cursor means there is more
+                self.assertEqual(pages, -(-len(self.ORDER) // limit))
+
+    def test_pages_with_depth_and_pattern(self):
+        seen, _ = self.page_through(2, max_depth=3, pattern="*.txt")
+        self.assertEqual(seen, ["a.txt", "b/c.txt", "b/d/e.txt", "b-x.txt"])
+
+    def test_resume_inside_a_subtree(self):
+        items, _ = fs_local.list_entries(self.user.id, cursor="b/d")
+        self.assertEqual(self.paths(items), self.ORDER[self.ORDER.index("b/d") + 1 :])
+        # The entry the cursor names may be gone by now
+        items, _ = fs_local.list_entries(self.user.id, cursor="b/cc.txt")
+        self.assertEqual(self.paths(items), self.ORDER[self.ORDER.index("b/d") :])
+
+
+class SeedTests(SandboxTestCase):
+    def test_seed_run(self):
+        out = io.StringIO()
+        call_command(
+            "seed_scale", users=3, conversations=2, messages=5, spread=0, days=30,
+            files=4, depth=1, fanout=2, prefix="seed", seed=7, stdout=out,
+        )
+        users = User.objects.filter(username__startswith="seed")
+        self.assertEqual(users.count(), 3)
+        convs = Conversation.objects.filter(owner__in=users)
+        self.assertEqual(convs.count(), 6)
+        self.assertEqual(Message.objects.filter(conversation__in=convs).count(), 30)
+
+        # The stats stored on each conversation match its messages
+        for conv in convs:
+            msgs = list(conv.messages.order_by("created_at", "id"))
+            self.assertEqual(conv.message_count, len(msgs))
+            self.assertEqual([m.role for m in msgs], ["user", "assistant"] * 2 + ["user"])
+            self.assertEqual(conv.title, make_title(msgs[0].content))
+            self.assertEqual(conv.preview, make_preview(msgs[-1].content))
+            self.assertEqual(conv.last_message_at, msgs[-1].created_at)
+            self.assertGreater(timezone.now() - msgs[0].created_at, timedelta(minutes=1))
+
+        # Files went through write_file: on disk, indexed and counted
+        for user in users:
+            items, _ = fs_local.list_entries(user.id, pattern="*.*")
+            self.assertEqual(len(items), 4)
+            self.assertEqual(SandboxFile.objects.filter(owner=user).count(), 4)
+            self.assertEqual(quota.get_usage(user.id)["files"], 4)
+        self.assertIn("Done.", out.getvalue())
+
+
+class MetricsTests(SandboxTestCase):
+    def test_access(self):
+        with override_settings(METRICS_ALLOWED_IPS=[]):
+            self.assertEqual(self.client.get("/metrics").status_code, 403)
+            self.client.force_login(self.user)
+            self.assertEqual(self.client.get("/metrics").status_code, 403)
+            self.user.is_staff = True
+            self.user.save()
+            self.assertEqual(self.client.get("/metrics").status_code, 200)
+            self.client.logout()
+        with override_settings(METRICS_ALLOWED_IPS=["10.0.0.9"]):
+            self.assertEqual(self.client.get("/metrics", REMOTE_ADDR="10.0.0.9").status_code, 200)
+            self.assertEqual(self.client.get("/metrics", REMOTE_ADDR="10.0.0.10").status_code, 403)
+
+    def test_exposition_format(self):
+        registry = metrics.Registry()
+        hits = registry.counter("hits_total", "Hits.", ("path",))
+        hits.inc(path='/a"b\\')
+        hits.inc(2, path="/")
+        registry.gauge("queue_depth", "Waiting turns.").set(1.5)
+        latency = registry.histogram("latency_seconds", "Latency.", buckets=(0.1, 1))
+        latency.observe(0.05)
+        latency.observe(0.5)
+        self.assertEqual(
+            registry.render(),
+            "# HELP hits_total Hits.\n"
+            "# TYPE hits_total counter\n"
+            'hits_total{path="/"} 2\n'
+            'hits_total{path="/a\\"b\\\\"} 1\n'
+            "# HELP latency_seconds Latency.\n"
+            "# TYPE latency_seconds histogram\n"
+            'latency_seconds_bucket{le="0.1"} 1\n'
+            'latency_seconds_bucket{le="1"} 2\n'
+            'latency_seconds_bucket{le="+Inf"} 2\n'
+            "latency_seconds_sum 0.55\n"
+            "latency_seconds_count 2\n"
+            "# HELP queue_depth Waiting turns.\n"
+            "# TYPE queue_depth gauge\n"
+            "queue_depth 1.5\n",
+        )
+
+    def test_endpoint_serves_the_registry(self):
+        resp = self.client.get("/metrics")
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(resp["Content-Type"], "text/plain; version=0.0.4; charset=utf-8")
+        body = resp.content.decode()
+        self.assertIn("# TYPE http_requests_total counter\n", body)
+        self.assertIn("# TYPE http_request_seconds histogram\n", body)
+
+
+class StatsTests(SimpleTestCase):
+    def test_percentile(self):
+        values = [float(n) for n in range(1, 11)]
+        self.assertEqual(stats.percentile([], 50), 0.0)
+        self.assertEqual(stats.percentile(values, 50), 5.0)
+        self.assertEqual(stats.percentile(values, 95), 10.0)
+        self.assertEqual(stats.percentile(values, 1), 1.0)
+        self.assertEqual(stats.percentile([3.0], 99), 3.0)
+
+    def test_latency_summary(self):
+        self.assertEqual(
+            stats.latency_summary([0.3, 0.1, 0.2]),
+            {"p50_ms": 200.0, "p95_ms": 300.0, "p99_ms": 300.0, "mean_ms": 200.0, "max_ms": 300.0},
+        )
+        self.assertEqual(stats.latency_summary([])["max_ms"], 0.0)
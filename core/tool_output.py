@@ -0,0 +1,152 @@
+# Token-aware shaping of tool results.
+#
+# Tool results go into the prompt as they are and the model context is small
+# (LLM_OPTIONS["num_ctx"]), so one big file could push the system prompt and
+# the history out. Instead:
+#   - every result is counted and cut to its share of the room left in the
+#     prompt: the start and the end are kept, the middle is replaced by a note
+#     with a cursor the model can follow (e.g. fs_read start_line=...)
+#   - reading the same unchanged file again in the same turn returns a short
+#     note instead of the same text twice
+#   - the tokens each tool result takes are recorded (tool spans, the trace
+#     line, tool_output_tokens_total, the audit log)
+#   - once tool results fill the prompt, the oldest history messages are dropped
+#     (never the system prompt, the summary or the current turn)
+import contextvars
+import threading
+from contextlib import contextmanager
+
+import xxhash
+from langchain_core.messages import ToolMessage
+
+from .context import count_tokens, fit_prompt, prompt_tokens, prompt_limit, truncate_to_tokens
+from .metrics import REGISTRY
+
+DEDUPLICATED = REGISTRY.counter(
+    "tool_output_deduplicated_total", "Tool results replaced by a note: same output earlier in the turn.", ("tool",)
+)
+
+# Tokens one tool result may use at most / at least (when many calls share a step)
+TOOL_OUTPUT_MAX_TOKENS = 600
+TOOL_OUTPUT_MIN_TOKENS = 80
+
+# Share of a cut result's budget that goes to its start (the rest to its end)
+HEAD_SHARE = 0.7
+
+# Tokens kept free for the "[... omitted ...]" note
+NOTE_TOKENS = 40
+
+# Tools whose repeated identical results are replaced by a note
+DEDUPED_TOOLS = {"fs_read", "fs_list"}
+
+# Token budget of the tool call running in this context (see output_budget())
+_budget = contextvars.ContextVar("tool_output_budget", default=TOOL_OUTPUT_MAX_TOKENS)
+
+
+def output_budget() -> int:
+    # Tokens the running tool's result may use: tools that can page
+    # (fs_list) stop there themselves and return their own cursor
+    return _budget.get()
+
+
+@contextmanager
+def output_budget_scope(max_tokens: int):
+    # Budget for the tool call run inside the block
+    token = _budget.set(max_tokens)
+    try:
+        yield
+    finally:
+        _budget.reset(token)
+
+
+def output_digest(text: str) -> str:
+    return xxhash.xxh3_64_hexdigest(text.encode("utf-8"))
+
+
+def fit_lines(lines: list[str], max_tokens: int) -> int:
+    # How many of the first lines fit in max_tokens
+    used = 0
+    for n, line in enumerate(lines):
+        used += count_tokens(line + "\n")
+        if used > max_tokens:
+            return n
+    return len(lines)
+
+
+def shape(text: str, max_tokens: int, resume=None) -> tuple[str, int, bool]:
+    # (text cut to max_tokens, its tokens, whether it was cut).
+    # A cut keeps whole lines from the start and the end; resume(kept, omitted)
+    # says how to get the omitted lines (kept = lines kept from the start).
+    tokens = count_tokens(text)
+    if tokens <= max_tokens:
+        return text, tokens, False
+
+    lines = text.split("\n")
+    head_budget = int((max_tokens - NOTE_TOKENS) * HEAD_SHARE)
+    tail_budget = max_tokens - NOTE_TOKENS - head_budget
+    head = lines[: fit_lines(lines, head_budget)]
+    # A first line longer than the whole head budget: show its beginning and
+    # count it as kept, so the cursor goes past it (reading it again wouldn't fit either)
+    partial = not head
+    if partial:
+        head = [truncate_to_tokens(lines[0], head_budget)]
+    kept = len(head)
+    rest = lines[kept:]
+    tail = rest[len(rest) - fit_lines(rest[::-1], tail_budget) :] if rest else []
+    omitted = len(lines) - kept - len(tail)
+
+    parts = ["the first line is too long, only its start is shown"] if partial else []
+    if omitted or not partial:
+        part = f"{omitted} lines omitted"
+        if resume is not None and omitted:
+            part += f": {resume(kept, omitted)}"
+        parts.append(part)
+    note = f"[... {'; '.join(parts)} ...]"
+    shaped = "\n".join(head + [note] + tail)
+    return shaped, count_tokens(shaped), True
+
+
+class ToolRun:
+    # Tool results of one agent turn: the per-call budget, repeated reads and
+    # the prompt size. `msgs` is the turn's message list, changed in place.
+
+    def __init__(self, msgs: list):
+        self.msgs = msgs
+        # The current turn starts with the last message of the history (the user's)
+        self.turn_start = max(len(msgs) - 1, 0)
+        # (tool, args) -> hash of its result earlier in this turn
+        self._seen = {}
+        self._lock = threading.Lock()
+
+    def call_budget(self, n_calls: int) -> int:
+        # Tokens for each of the next n_calls results: what's left of the
+        # prompt once the system prompt and this turn so far are in
+        # (older history can be dropped to make room)
+        protected = self.msgs[: self._first_history()] + self.msgs[self.turn_start :]
+        available = prompt_limit() - prompt_tokens(protected)
+        return max(TOOL_OUTPUT_MIN_TOKENS, min(TOOL_OUTPUT_MAX_TOKENS, available // max(1, n_calls)))
+
+    def _first_history(self) -> int:
+        n = 0
+        while n < len(self.msgs) and self.msgs[n].type == "system":
+            n += 1
+        return n
+
+    def dedupe(self, call: dict, message: ToolMessage) -> ToolMessage:
+        # Same call with the same (full, uncut) result earlier in the turn: a note instead
+        name = call.get("name")
+        if name in DEDUPED_TOOLS and not str(message.content).startswith("ERROR"):
+            key = (name, repr(sorted((call.get("args") or {}).items())))
+            digest = (message.artifact or {}).get("output_hash") or output_digest(str(message.content))
+            with self._lock:
+                repeated = self._seen.get(key) == digest
+                self._seen[key] = digest
+            if repeated:
+                DEDUPLICATED.inc(tool=name)
+                content = f"(unchanged: same result as the earlier {name} call with these arguments in this turn)"
+                message = ToolMessage(content=content, tool_call_id=message.tool_call_id)
+        return message
+
+    def fit(self) -> None:
+        # After adding tool results: drop the oldest history until the prompt fits
+        self.turn_start = fit_prompt(self.msgs, self.turn_start)
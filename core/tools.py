@@ -0,0 +1,339 @@
+# LLM-callable tools for the assistant.
+#
+# The tools are defined once at import time (not per chat turn) so LangChain only
+# builds their pydantic/JSON schemas once per process.
+# The sandbox owner is NOT captured in a closure: it is an injected argument
+# that the model never sees and that we fill in when the tool actually runs.
+import contextvars
+import threading
+import time
+from concurrent.futures import CancelledError, Future, ThreadPoolExecutor, TimeoutError as FutureTimeout
+from typing import Annotated
+
+from django.db import close_old_connections
+from langchain_core.messages import ToolMessage
+from langchain_core.tools import InjectedToolArg, tool
+
+# Local file-system helper functions (our shared business logic layer)
+from .fs_index import search as search_files
+from .fs_local import format_entries, list_entries, read_lines, write_file
+from .sandbox import clean_parts
+from .audit import audit
+# Results are cut to their share of the prompt (see core.tool_output)
+from .tool_output import NOTE_TOKENS, TOOL_OUTPUT_MAX_TOKENS, fit_lines, output_budget, output_budget_scope, output_digest, shape
+from .tracing import record_tool_call, record_tool_output, span
+
+# Listing size for one fs_list call: small, the model context is only 2048 tokens
+TOOL_LIST_LIMIT = 50
+
+
+@tool
+def fs_list(
+    path: str = "",
+    max_depth: int = 2,
+    pattern: str = "",
+    cursor: str = "",
+    user_id: Annotated[int, InjectedToolArg] = 0,
+) -> str:
+    """List files/folders in this user's sandbox at a relative path.
+
+    max_depth: how many folder levels to show (1 = only direct children).
+    pattern: optional glob filter such as "*.py" or "docs/*.md".
+    cursor: pass the cursor from a previous result to get the next page.
+    """
+    items, next_cursor = list_entries(
+        user_id,
+        path,
+        max_depth=max(1, max_depth),
+        pattern=pattern,
+        limit=TOOL_LIST_LIMIT,
+        cursor=cursor,
+    )
+    if not items:
+        return "(no files)"
+
+    lines = format_entries(items, flat=bool(pattern))
+    # Stop where the listing would outgrow its token budget, the cursor continues from there
+    fit = max(1, fit_lines(lines, output_budget() - NOTE_TOKENS))
+    if fit < len(lines):
+        lines = lines[:fit]
+        next_cursor = items[fit - 1]["path"]
+    if next_cursor:
+        lines.append(f"... more entries: call fs_list again with cursor=\"{next_cursor}\"")
+    return "\n".join(lines)
+
+
+# Lines per fs_read call when the model doesn't ask for fewer
+TOOL_READ_LINES = 100
+
+
+@tool
+def fs_read(
+    path: str,
+    start_line: int = 1,
+    max_lines: int = TOOL_READ_LINES,
+    user_id: Annotated[int, InjectedToolArg] = 0,
+) -> str:
+    """Read one text file from this user's sandbox.
+
+    Big files are returned in parts: start_line (1-based) and max_lines pick
+    which lines to read.
+    """
+    try:
+        chunk = read_lines(user_id, path, start_line, min(max(1, max_lines), TOOL_READ_LINES))
+    except (FileNotFoundError, IsADirectoryError):
+        # Return a clean tool error string (instead of crashing the run)
+        return "ERROR: file not found"
+
+    text = chunk["content"]
+    if chunk["next_line"] is not None:
+        text += f"\n... more lines: call fs_read with start_line={chunk['next_line']}"
+    return text
+
+
+@tool
+def fs_write(path: str, content: str, user_id: Annotated[int, InjectedToolArg] = 0) -> str:
+    """Create or overwrite a text file in this user's sandbox."""
+    write_file(user_id, path, content)
+    return f"OK: wrote {path}"
+
+
+@tool
+def fs_search(query: str, user_id: Annotated[int, InjectedToolArg] = 0) -> str:
+    """Find files in this user's sandbox whose name or content contains the query words."""
+    results = search_files(user_id, query, limit=10)
+    if not results:
+        return "(no matching files)"
+
+    lines = []
+    for r in results:
+        line = r["path"]
+        if r.get("snippet"):
+            line += f"  [line {r['snippet']}]"
+        lines.append(line)
+    return "\n".join(lines)
+
+
+# Registered tools (order is the order the model sees them)
+TOOLS = [fs_list, fs_read, fs_write, fs_search]
+
+# Name -> tool lookup so we don't scan the list for every call
+TOOLS_BY_NAME = {t.name: t for t in TOOLS}
+
+# Tools that change the user's files (a turn snapshots the sandbox before running one)
+FILE_WRITING_TOOLS = {"fs_write"}
+
+
+def _resume_read(args: dict):
+    # The lines a cut fs_read result left out, as an fs_read call
+    path = str(args.get("path", ""))
+    try:
+        start = max(1, int(args.get("start_line") or 1))
+    except (TypeError, ValueError):
+        start = 1
+    return lambda kept, omitted: f'call fs_read with path="{path}" start_line={start + kept} max_lines={omitted}'
+
+
+def _resume_search(args: dict):
+    return lambda kept, omitted: "use more specific query words to narrow the results"
+
+
+# Tool name -> how to continue a cut result of it (from the call arguments)
+RESUME_HINTS = {"fs_read": _resume_read, "fs_search": _resume_search}
+
+
+def run_tool_call(call: dict, user_id: int, max_tokens: int = TOOL_OUTPUT_MAX_TOKENS) -> ToolMessage:
+    # max_tokens: how much of the prompt the result may take (see core.tool_output)
+    tool_name = call.get("name")
+    tool_args = call.get("args", {}) or {}
+    tool_id = call.get("id")
+
+    with span("tool", tool=tool_name) as attrs, output_budget_scope(max_tokens):
+        selected_tool = TOOLS_BY_NAME.get(tool_name)
+        if selected_tool is None:
+            tool_output = f"ERROR: unknown tool '{tool_name}'"
+        else:
+            try:
+                # Scope the tool to the conversation owner.
+                # This prevents the assistant from reading/writing another user's files,
+                # even if the model tries to pass its own user_id.
+                tool_output = selected_tool.invoke({**tool_args, "user_id": user_id})
+            except Exception as exc:
+                # Keep loop alive even if one tool execution fails
+                tool_output = f"ERROR: tool failed: {exc}"
+        tool_output = str(tool_output)
+        # Hash of the full result: a repeat is recognised even when it gets cut differently
+        output_hash = output_digest(tool_output)
+        resume = RESUME_HINTS.get(tool_name)
+        tool_output, tokens, truncated = shape(
+            tool_output, max_tokens, resume(tool_args) if resume is not None else None
+        )
+        attrs["ok"] = not tool_output.startswith("ERROR")
+        attrs["chars"] = len(tool_output)
+        attrs["tokens"] = tokens
+        attrs["truncated"] = truncated
+    record_tool_call(tool_name, attrs["ok"])
+    record_tool_output(tool_name, tokens, truncated)
+    audit(
+        "tool_call",
+        user_id=user_id,
+        tool=tool_name,
+        path=str(tool_args.get("path", "")),
+        ok=attrs["ok"],
+        output_chars=attrs["chars"],
+        output_tokens=tokens,
+        truncated=truncated,
+    )
+
+    # ToolMessage connects output to the exact tool call ID
+    # (the artifact is for us, it isn't sent to the model)
+    return ToolMessage(content=tool_output, tool_call_id=tool_id, artifact={"output_hash": output_hash})
+
+
+# Tool calls from one model step run in this shared, bounded pool.
+# Bounded so a model asking for many tools (or many users at once) can't
+# spawn an unlimited number of threads.
+TOOL_MAX_WORKERS = 8
+_executor = ThreadPoolExecutor(max_workers=TOOL_MAX_WORKERS, thread_name_prefix="tool")
+
+# Seconds each tool may run before we give the model a timeout error
+TOOL_TIMEOUTS = {
+    "fs_list": 15,
+    "fs_read": 15,
+    "fs_write": 30,
+    "fs_search": 15,
+}
+DEFAULT_TOOL_TIMEOUT = 15
+
+
+def _tool_path(call: dict) -> str:
+    # The path as the sandbox resolves it ("./a.txt", "dir//a.txt" -> "a.txt",
+    # "dir/a.txt"), so calls on the same file are recognized as such
+    args = call.get("args") or {}
+    path = str(args.get("path", ""))
+    try:
+        return "/".join(clean_parts(path))
+    except ValueError:
+        # The tool itself will refuse it
+        return path.strip()
+
+
+def _run_pooled(call: dict, user_id: int, max_tokens: int) -> ToolMessage:
+    # Pool threads aren't request threads: start and end each call like a
+    # request does, so the DB connection a tool opens (index, quota) is closed
+    close_old_connections()
+    try:
+        return run_tool_call(call, user_id, max_tokens)
+    finally:
+        close_old_connections()
+
+
+def _copy_outcome(source: Future, target: Future) -> None:
+    if source.cancelled():
+        target.set_exception(CancelledError())
+    elif source.exception() is not None:
+        target.set_exception(source.exception())
+    else:
+        target.set_result(source.result())
+
+
+def _submit_after(deps: list, submit) -> Future:
+    # A future for a call that may only start once `deps` are done. No pool
+    # thread waits for them: the last one to finish submits the call
+    # (a call cancelled meanwhile, e.g. its step timed out, never starts).
+    result = Future()
+    remaining = [len(deps)]
+    lock = threading.Lock()
+
+    def dep_done(_):
+        with lock:
+            remaining[0] -= 1
+            if remaining[0]:
+                return
+        if not result.set_running_or_notify_cancel():
+            return
+        try:
+            inner = submit()
+        except BaseException as exc:
+            result.set_exception(exc)
+            return
+        inner.add_done_callback(lambda f: _copy_outcome(f, result))
+
+    for dep in deps:
+        dep.add_done_callback(dep_done)
+    return result
+
+
+# Tools that look at the whole sandbox: they run after every earlier write of the step
+SCAN_TOOLS = {"fs_list", "fs_search"}
+
+
+def run_tool_calls(calls: list[dict], user_id: int, run=None) -> list[ToolMessage]:
+    # Run all tool calls of one model step concurrently and return their
+    # ToolMessages in the original call order.
+    #
+    # run (a core.tool_output.ToolRun for the turn): sizes each result to its
+    # share of the room left in the prompt and replaces repeated reads.
+    #
+    # Calls are independent except around writes: a call that touches a path
+    # written earlier in the same step (or an fs_list/fs_search after any
+    # write) starts after that write, and a write after earlier calls on its
+    # path and earlier listings/searches, so "write a.txt, then read a.txt"
+    # still behaves in order.
+    max_tokens = run.call_budget(len(calls)) if run is not None else TOOL_OUTPUT_MAX_TOKENS
+    futures = []
+    writes_by_path = {}
+    calls_by_path = {}
+    all_writes = []
+    scans = []
+    for call in calls:
+        name = call.get("name")
+        path = _tool_path(call)
+
+        if name in SCAN_TOOLS:
+            deps = list(all_writes)
+        elif name == "fs_write":
+            deps = calls_by_path.get(path, []) + scans
+        else:
+            deps = list(writes_by_path.get(path, []))
+
+        # Run in a copy of our context so the tool spans land in the caller's trace
+        ctx = contextvars.copy_context()
+
+        def submit(ctx=ctx, call=call):
+            return _executor.submit(ctx.run, _run_pooled, call, user_id, max_tokens)
+
+        future = _submit_after(deps, submit) if deps else submit()
+        futures.append(future)
+
+        if name in SCAN_TOOLS:
+            scans.append(future)
+        else:
+            calls_by_path.setdefault(path, []).append(future)
+        if name == "fs_write":
+            writes_by_path.setdefault(path, []).append(future)
+            all_writes.append(future)
+
+    # Each call gets its own deadline, counted from when the step started
+    start = time.monotonic()
+    results = []
+    for call, future in zip(calls, futures):
+        timeout = TOOL_TIMEOUTS.get(call.get("name"), DEFAULT_TOOL_TIMEOUT)
+        remaining = max(0.0, start + timeout - time.monotonic())
+        try:
+            results.append(future.result(timeout=remaining))
+        except FutureTimeout:
+            # A running thread can't be killed, it finishes in the background,
+            # but the model gets an answer now and the turn can continue.
+            # A call that hasn't started yet never will.
+            future.cancel()
+            results.append(
+                ToolMessage(
+                    content=f"ERROR: tool '{call.get('name')}' timed out after {timeout}s",
+                    tool_call_id=call.get("id"),
+                )
+            )
+    if run is not None:
+        # In call order, so a repeat within this step points at the earlier one
+        results = [run.dedupe(call, message) for call, message in zip(calls, results)]
+    return results
@@ -0,0 +1,230 @@
+# Per-request timing breakdown.
+#
+# A "trace" covers one HTTP request (TracingMiddleware) or one background job.
+# Inside it, span("llm") / span("tool") / span("context") ... time the
+# interesting steps, and every ORM query is timed through a DB execute wrapper.
+# When the trace ends we log one structured (JSON) line with the breakdown:
+# how much of the request went to the DB, the model, tools, etc.
+#
+# Every span is also observed in the Prometheus histograms of core.metrics,
+# so the same numbers show up on /metrics.
+import contextvars
+import json
+import logging
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+from django.db import connection
+from django.urls import Resolver404, resolve
+
+from .metrics import (
+    AGENT_STEPS,
+    DB_QUERIES,
+    DB_SECONDS,
+    HTTP_REQUESTS,
+    HTTP_SECONDS,
+    LLM_CALLS,
+    LLM_TOKENS,
+    SPAN_SECONDS,
+    TOOL_CALLS,
+    TOOL_OUTPUT_TOKENS,
+    TOOL_OUTPUT_TRUNCATED,
+)
+
+logger = logging.getLogger("core.trace")
+
+# Max spans kept per trace for the log line (counters still add up all of them)
+MAX_LOGGED_SPANS = 50
+
+_current = contextvars.ContextVar("core_trace", default=None)
+
+
+class Trace:
+    def __init__(self, name: str, **attrs):
+        self.trace_id = uuid.uuid4().hex[:16]
+        self.name = name
+        self.attrs = attrs
+        self.start = time.perf_counter()
+        # span name -> [calls, seconds]
+        self.totals = {}
+        self.spans = []
+        # Token counts, agent steps, ...
+        self.counts = {}
+        # Tool spans run on pool threads, so updates need a lock
+        self._lock = threading.Lock()
+
+    def add_span(self, name: str, seconds: float, attrs: dict) -> None:
+        with self._lock:
+            total = self.totals.setdefault(name, [0, 0.0])
+            total[0] += 1
+            total[1] += seconds
+            if len(self.spans) < MAX_LOGGED_SPANS:
+                self.spans.append({"span": name, "ms": round(seconds * 1000, 2), **attrs})
+
+    def incr(self, key: str, amount: int = 1) -> None:
+        with self._lock:
+            self.counts[key] = self.counts.get(key, 0) + amount
+
+    def summary(self) -> dict:
+        total = time.perf_counter() - self.start
+        with self._lock:
+            breakdown = {name: round(t[1] * 1000, 2) for name, t in self.totals.items()}
+            calls = {name: t[0] for name, t in self.totals.items()}
+            spans = list(self.spans)
+            counts = dict(self.counts)
+        return {
+            "trace_id": self.trace_id,
+            "trace": self.name,
+            **self.attrs,
+            "total_ms": round(total * 1000, 2),
+            "breakdown_ms": breakdown,
+            "calls": calls,
+            **counts,
+            "spans": spans,
+        }
+
+
+def current_trace() -> Trace | None:
+    return _current.get()
+
+
+def _db_wrapper(execute, sql, params, many, context):
+    # Times every ORM query of the traced thread
+    start = time.perf_counter()
+    try:
+        return execute(sql, params, many, context)
+    finally:
+        elapsed = time.perf_counter() - start
+        DB_QUERIES.inc()
+        DB_SECONDS.observe(elapsed)
+        trace = _current.get()
+        if trace is not None:
+            trace.add_span("db", elapsed, {})
+
+
+@contextmanager
+def start_trace(name: str, **attrs):
+    # Trace everything inside the block, then log the breakdown
+    trace = Trace(name, **attrs)
+    token = _current.set(trace)
+    try:
+        with connection.execute_wrapper(_db_wrapper):
+            yield trace
+    finally:
+        _current.reset(token)
+        summary = trace.summary()
+        # Individual DB queries would flood the log, their total is in breakdown_ms
+        summary["spans"] = [s for s in summary["spans"] if s["span"] != "db"]
+        logger.info("trace %s", json.dumps(summary, default=str))
+
+
+@contextmanager
+def span(name: str, **attrs):
+    # Time one step. The yielded dict can be filled with more attributes
+    # (e.g. token counts) before the block ends.
+    start = time.perf_counter()
+    try:
+        yield attrs
+    finally:
+        elapsed = time.perf_counter() - start
+        SPAN_SECONDS.observe(elapsed, span=name)
+        trace = _current.get()
+        if trace is not None:
+            trace.add_span(name, elapsed, attrs)
+        logger.debug("span %s", json.dumps({"span": name, "ms": round(elapsed * 1000, 2), **attrs}, default=str))
+
+
+def record_llm_call(attrs: dict, model: str, resp, cached: bool = False) -> None:
+    # Count one model call and the tokens Ollama reported for it
+    # (usage_metadata is filled from prompt_eval_count / eval_count)
+    LLM_CALLS.inc(model=model, cached="true" if cached else "false")
+    attrs["cached"] = cached
+    usage = getattr(resp, "usage_metadata", None) or {}
+    if cached or not usage:
+        return
+    prompt = usage.get("input_tokens", 0) or 0
+    completion = usage.get("output_tokens", 0) or 0
+    attrs["prompt_tokens"] = prompt
+    attrs["completion_tokens"] = completion
+    LLM_TOKENS.inc(prompt, model=model, kind="prompt")
+    LLM_TOKENS.inc(completion, model=model, kind="completion")
+    trace = _current.get()
+    if trace is not None:
+        trace.incr("prompt_tokens", prompt)
+        trace.incr("completion_tokens", completion)
+
+
+def record_agent_steps(steps: int) -> None:
+    AGENT_STEPS.observe(steps)
+    trace = _current.get()
+    if trace is not None:
+        trace.incr("agent_steps", steps)
+
+
+def record_tool_call(name: str, ok: bool) -> None:
+    TOOL_CALLS.inc(tool=name or "unknown", outcome="ok" if ok else "error")
+
+
+def record_tool_output(name: str, tokens: int, truncated: bool) -> None:
+    # How much of the prompt one tool result takes (see core.tool_output)
+    TOOL_OUTPUT_TOKENS.inc(tokens, tool=name or "unknown")
+    if truncated:
+        TOOL_OUTPUT_TRUNCATED.inc(tool=name or "unknown")
+    trace = _current.get()
+    if trace is not None:
+        trace.incr("tool_tokens", tokens)
+
+
+def _view_name(request) -> str:
+    # Route name (not the raw path) so metric labels stay few
+    match = getattr(request, "resolver_match", None)
+    if match is None:
+        try:
+            match = resolve(request.path_info)
+        except Resolver404:
+            return "unmatched"
+    return match.url_name or match.view_name or "unknown"
+
+
+class TracingMiddleware:
+    # One trace per request + request count/latency metrics per view.
+    # Works sync and async: a sync-only middleware would make Django run async
+    # views (chat_stream) one at a time through async_to_sync.
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        self.is_async = iscoroutinefunction(get_response)
+        if self.is_async:
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if self.is_async:
+            return self.__acall__(request)
+        start = time.perf_counter()
+        with start_trace("request", method=request.method, path=request.path) as trace:
+            response = self.get_response(request)
+            self._finish(request, response, trace, start)
+        response["X-Trace-Id"] = trace.trace_id
+        return response
+
+    async def __acall__(self, request):
+        # ORM queries of async views run in worker threads, whose DB
+        # connections the wrapper of start_trace doesn't see: spans still count
+        start = time.perf_counter()
+        with start_trace("request", method=request.method, path=request.path) as trace:
+            response = await self.get_response(request)
+            self._finish(request, response, trace, start)
+        response["X-Trace-Id"] = trace.trace_id
+        return response
+
+    def _finish(self, request, response, trace: Trace, start: float) -> None:
+        view = _view_name(request)
+        trace.attrs["view"] = view
+        trace.attrs["status"] = response.status_code
+        HTTP_REQUESTS.inc(method=request.method, view=view, status=response.status_code)
+        HTTP_SECONDS.observe(time.perf_counter() - start, view=view)
@@ -2,25 +2,80 @@ from django.contrib.auth import login
 from django.contrib.auth.forms import UserCreationForm
 from django.contrib.auth.decorators import login_required
 from django.shortcuts import render, redirect
-from django.shortcuts import get_object_or_404
-from .models import Conversation, Message
-from .assistant import generate_reply
+from django.shortcuts import get_object_or_404, aget_object_or_404
+from .models import Conversation, Message, SandboxSnapshot
+from .assistant import agenerate_reply, astream_reply, summarize_history
+from .jobs import enqueue_reply, queued_jobs_for
+from .admission import Overloaded, get_controller
+from .audit import audit
+from .pagination import akeyset_page, parse_limit
+from .message_search import asearch_messages
+from .metrics import REGISTRY
+from .tracing import current_trace, span, start_trace
+from django.conf import settings
+import json
 import logging
+import mimetypes
+from asgiref.sync import sync_to_async
 
 # File system imports
-from django.http import JsonResponse
+from django.http import Http404, HttpResponse, HttpResponseForbidden, JsonResponse, StreamingHttpResponse
+from django.utils.http import content_disposition_header
 from django.views.decorators.http import require_POST
-from .fs_local import list_tree, read_file, write_file
+from .fs_index import asearch as asearch_files
+from .quota import QuotaExceeded, aget_usage
+from .fs_local import (
+    LIST_DEFAULT_LIMIT,
+    FileTooLarge,
+    aappend_file,
+    alist_entries,
+    aiter_file,
+    aopen_for_download,
+    aread_text_range,
+    arestore_snapshot,
+    awrite_chunks,
+    awrite_file,
+    format_entries,
+    list_tree,
+    read_text_range,
+    write_file,
+)
 
 
 # Add the logger so we can add admin audit
 logger = logging.getLogger(__name__)
 
 
+# Conversations per page on the home page
+HOME_PAGE_SIZE = 20
+
+# Most views are async: under ASGI a request waiting on the DB, the disk or
+# (mostly) the model doesn't hold a thread, so one process can serve many
+# conversations at once. ORM calls use the async API, file operations the
+# a* helpers of core.fs_local (run in worker threads).
+
+
+async def _arender(request, template: str, context: dict):
+    # Templates read request.user (a lazy, sync DB lookup), so render in a thread
+    with span("render", template=template):
+        return await sync_to_async(render)(request, template, context)
+
+
 @login_required
-def home(request):
-    conversations = Conversation.objects.filter(owner=request.user).order_by("-created_at")
-    return render(request, "home.html", {"conversations": conversations})
+async def home(request):
+    # Most recently active first, one page at a time (?before=<cursor>).
+    # Title/preview/counts are stored on Conversation, so this is one query.
+    user = await request.auser()
+    try:
+        conversations, older_cursor = await akeyset_page(
+            Conversation.objects.filter(owner=user),
+            "last_message_at",
+            request.GET.get("before"),
+            HOME_PAGE_SIZE,
+        )
+    except ValueError:
+        return redirect("home")
+    return await _arender(request, "home.html", {"conversations": conversations, "older_cursor": older_cursor})
 
 
 def signup(request):
@@ -36,81 +91,475 @@ def signup(request):
 
 
 @login_required
-def new_chat(request):
-    conv = Conversation.objects.create(owner=request.user)
+async def new_chat(request):
+    conv = await Conversation.objects.acreate(owner=await request.auser())
     return redirect("chat", conversation_id=conv.id)
 
+def _overloaded(exc: Overloaded) -> JsonResponse:
+    # 429 + Retry-After: the server is busy with other agent runs
+    response = JsonResponse(
+        {"error": "The assistant is busy, please try again shortly.", "retry_after": exc.retry_after},
+        status=429,
+    )
+    response["Retry-After"] = str(exc.retry_after)
+    return response
+
+
+class _ReleasingStream:
+    # Async iterator for StreamingHttpResponse that calls `release` when Django
+    # closes the response, even if the client left before the stream started
+    def __init__(self, events, release):
+        self.events = events
+        self.release = release
+
+    def __aiter__(self):
+        return self.events.__aiter__()
+
+    def close(self):
+        self.release()
+
+
 @login_required
-def chat(request, conversation_id):
-    conv = get_object_or_404(Conversation, id=conversation_id, owner=request.user)
+async def chat(request, conversation_id):
+    user = await request.auser()
+    conv = await aget_object_or_404(Conversation, id=conversation_id, owner=user)
 
     if request.method == "POST":
         user_text = request.POST.get("message", "").strip()
-        if user_text:
-            Message.objects.create(conversation=conv, role="user", content=user_text)
 
+        # Admission control, before anything is saved: a rejected message
+        # is not added to the conversation
+        release = None
+        if user_text and settings.AGENT_JOBS_ENABLED:
+            # Workers bound how many turns run at once, here we only stop
+            # one user from filling the queue
+            max_queued = settings.ADMISSION.get("MAX_QUEUED_JOBS_PER_USER", 3)
+            if await sync_to_async(queued_jobs_for)(user.id) >= max_queued:
+                return _overloaded(Overloaded("user_jobs_queued", get_controller().retry_after()))
+        elif user_text:
+            # Wait (on the event loop) for a free agent slot, or give up with a 429
+            try:
+                release = await get_controller().aacquire(user.id)
+            except Overloaded as exc:
+                return _overloaded(exc)
+
+        try:
+            if user_text:
+                await sync_to_async(conv.add_message)("user", user_text)
+
+
+                # Audit events are queued and written in the background (core.audit)
+                audit(
+                    "chat_message",
+                    user_id=user.id,
+                    username=user.username,
+                    conversation_id=conv.id,
+                    session_id=str(conv.session_id),
+                    text_len=len(user_text),
+                )
+
+
+                if settings.AGENT_JOBS_ENABLED:
+                    # Queue the turn for `manage.py run_agent_workers` and return now,
+                    # the page polls chat_message_status until the reply is ready
+                    job = await sync_to_async(enqueue_reply)(conv, user_text)
+                    audit(
+                        "assistant_reply_queued",
+                        user_id=user.id,
+                        username=user.username,
+                        conversation_id=conv.id,
+                        session_id=str(conv.session_id),
+                        job_id=job.id,
+                    )
+                else:
+                    route_info = {}
+                    assistant_text = await agenerate_reply(user_text, conv, route_info=route_info)
+                    await sync_to_async(conv.add_message)(
+                        "assistant", assistant_text, model=route_info.get("model", ""), routing=route_info
+                    )
+
+                    audit(
+                        "assistant_reply",
+                        user_id=user.id,
+                        username=user.username,
+                        conversation_id=conv.id,
+                        session_id=str(conv.session_id),
+                        reply_len=len(assistant_text),
+                        model=route_info.get("model", ""),
+                    )
+                    # Reply saved: extend the summary for the next turns (with
+                    # AGENT_JOBS_ENABLED the worker does this)
+                    await sync_to_async(summarize_history)(conv)
+        finally:
+            if release is not None:
+                release()
 
-            logger.info(
-                "chat_message user=%s conv_id=%s session_id=%s text_len=%s",
-                request.user.username,
-                conv.id,
-                conv.session_id,
-                len(user_text),
-            )
+        return redirect("chat", conversation_id=conv.id)
 
+    # Only the latest page of messages, older ones load on demand (keyset pagination),
+    # so the page costs the same no matter how long the conversation is
+    try:
+        msgs, older_cursor = await akeyset_page(conv.messages.all(), "created_at", request.GET.get("before"))
+    except ValueError:
+        return redirect("chat", conversation_id=conv.id)
+    msgs.reverse()
+
+    return await _arender(
+        request,
+        "chat.html",
+        {
+            "conversation": conv,
+            "messages": msgs,
+            "older_cursor": older_cursor,
+            # With background jobs the form posts normally and pending replies are polled,
+            # otherwise the reply is streamed straight from the model
+            "streaming": not settings.AGENT_JOBS_ENABLED,
+        },
+    )
+
+
+# One page of a conversation's history (oldest -> newest within the page)
+# ?before=<cursor> pages further back, ?limit= sets the page size
+@login_required
+async def chat_history_api(request, conversation_id):
+    conv = await aget_object_or_404(Conversation, id=conversation_id, owner=await request.auser())
+    limit = parse_limit(request.GET.get("limit"))
+    try:
+        rows, older_cursor = await akeyset_page(conv.messages.all(), "created_at", request.GET.get("before"), limit)
+    except ValueError:
+        return JsonResponse({"error": "invalid cursor"}, status=400)
+    rows.reverse()
+
+    return JsonResponse(
+        {
+            "messages": [
+                {
+                    "id": m.id,
+                    "role": m.role,
+                    "content": m.content,
+                    "status": m.status,
+                    "model": m.model,
+                    "created_at": m.created_at.isoformat(),
+                }
+                for m in rows
+            ],
+            "next_cursor": older_cursor,
+        }
+    )
+
+
+# Search the user's own messages (full-text index, see core.message_search)
+# ?q=<words> ?limit= max results, best match first with a highlighted snippet
+@login_required
+async def chat_search_api(request):
+    query = (request.GET.get("q") or "").strip()
+    if not query:
+        return JsonResponse({"error": "missing q"}, status=400)
+    limit = parse_limit(request.GET.get("limit"), default=20)
+    user = await request.auser()
+    with span("search", kind="messages"):
+        results = await asearch_messages(user.id, query, limit)
+    return JsonResponse({"results": results})
+
+
+# Poll endpoint for a queued (background) assistant reply
+@login_required
+async def chat_message_status(request, conversation_id, message_id):
+    msg = await aget_object_or_404(
+        Message,
+        id=message_id,
+        conversation_id=conversation_id,
+        conversation__owner=await request.auser(),
+    )
+    return JsonResponse({"id": msg.id, "status": msg.status, "content": msg.content})
 
-            # Dummy assistant reply for now
-            assistant_text = generate_reply(user_text, conv)
-            Message.objects.create(conversation=conv, role="assistant", content=assistant_text)
 
+def _sse(event: dict) -> str:
+    # One Server-Sent Events frame
+    return f"data: {json.dumps(event)}\n\n"
 
-            logger.info(
-                "assistant_reply user=%s conv_id=%s session_id=%s reply_len=%s",
-                request.user.username,
-                conv.id,
-                conv.session_id,
-                len(assistant_text),
-            )
 
+# Streaming chat (needs an ASGI server, see config/asgi.py)
+# Sends model tokens and tool progress to the browser while the agent runs,
+# then saves the finished reply as a Message.
+@require_POST
+@login_required
+async def chat_stream(request, conversation_id):
+    user = await request.auser()
+    conv = await aget_object_or_404(Conversation, id=conversation_id, owner=user)
 
+    user_text = request.POST.get("message", "").strip()
+    if not user_text:
+        return JsonResponse({"error": "missing message"}, status=400)
 
-        return redirect("chat", conversation_id=conv.id)
+    # Wait (on the event loop) for a free agent slot, or reject with a 429.
+    # The slot is held until the stream is closed.
+    try:
+        release = await get_controller().aacquire(user.id)
+    except Overloaded as exc:
+        return _overloaded(exc)
 
-    msgs = conv.messages.order_by("created_at")
-    return render(request, "chat.html", {"conversation": conv, "messages": msgs})
+    try:
+        await sync_to_async(conv.add_message)("user", user_text)
+    except BaseException:
+        release()
+        raise
+
+    audit(
+        "chat_message",
+        user_id=user.id,
+        username=user.username,
+        conversation_id=conv.id,
+        session_id=str(conv.session_id),
+        text_len=len(user_text),
+    )
+
+    # TracingMiddleware's trace ends when the view returns the response, before
+    # the stream body runs: the turn gets its own trace, linked to the request's
+    request_trace = current_trace()
+
+    async def events():
+        try:
+            with start_trace(
+                "chat_stream",
+                conversation_id=conv.id,
+                user_id=user.id,
+                request_trace_id=request_trace.trace_id if request_trace is not None else "",
+            ):
+                async for frame in run():
+                    yield frame
+        finally:
+            release()
+
+    async def run():
+        try:
+            assistant_text = ""
+            route_info = {}
+            async for event in astream_reply(user_text, conv):
+                if event["type"] == "done":
+                    assistant_text = event["text"]
+                    route_info = event.get("routing") or {}
+                elif event["type"] == "error":
+                    # Nothing to save: the page shows the error instead of a reply
+                    logger.warning("chat_stream_empty_reply conv_id=%s", conv.id)
+                    yield _sse({"type": "error", "reason": event["reason"], "text": event["text"]})
+                    return
+                else:
+                    yield _sse(event)
+        except Exception:
+            logger.exception("chat_stream_failed conv_id=%s", conv.id)
+            yield _sse({"type": "error", "text": "The assistant failed. Please try again."})
+            return
+
+        model = route_info.get("model", "")
+        await sync_to_async(conv.add_message)("assistant", assistant_text, model=model, routing=route_info)
+
+        audit(
+            "assistant_reply",
+            user_id=user.id,
+            username=user.username,
+            conversation_id=conv.id,
+            session_id=str(conv.session_id),
+            reply_len=len(assistant_text),
+            model=model,
+        )
+
+        yield _sse({"type": "done", "text": assistant_text, "model": model})
+        # The page has the whole reply: extend the summary for the next turns
+        # before the stream closes
+        await sync_to_async(summarize_history)(conv)
+
+    response = StreamingHttpResponse(_ReleasingStream(events(), release), content_type="text/event-stream")
+    # Don't let proxies buffer or cache the event stream
+    response["Cache-Control"] = "no-cache"
+    response["X-Accel-Buffering"] = "no"
+    return response
 
 # API
 # Show what files are in the user folder
+# Optional GET params: path, depth, glob, limit, cursor, meta=1 (size/mtime)
 @login_required
-def fs_list_api(request):
-    items = list_tree(request.user.id, "")
-    return JsonResponse({"items": items})
+async def fs_list_api(request):
+    path = (request.GET.get("path") or "").strip()
+    pattern = (request.GET.get("glob") or "").strip()
+    with_meta = request.GET.get("meta") == "1"
+    try:
+        depth = int(request.GET["depth"]) if request.GET.get("depth") else None
+        limit = int(request.GET.get("limit") or LIST_DEFAULT_LIMIT)
+    except ValueError:
+        return JsonResponse({"error": "depth and limit must be numbers"}, status=400)
+
+    user = await request.auser()
+    try:
+        entries, next_cursor = await alist_entries(
+            user.id,
+            path,
+            max_depth=depth,
+            pattern=pattern,
+            limit=limit,
+            cursor=request.GET.get("cursor") or "",
+            with_meta=with_meta,
+        )
+    except ValueError as exc:
+        return JsonResponse({"error": str(exc)}, status=400)
+
+    data = {"items": format_entries(entries, flat=bool(pattern)), "next_cursor": next_cursor}
+    if with_meta:
+        data["entries"] = entries
+    return JsonResponse(data)
+
+# Find files by name/content words: ?q=<words>&limit=
+@login_required
+async def fs_search_api(request):
+    query = (request.GET.get("q") or "").strip()
+    if not query:
+        return JsonResponse({"error": "missing q"}, status=400)
+    limit = parse_limit(request.GET.get("limit"), default=20)
+    user = await request.auser()
+    return JsonResponse({"results": await asearch_files(user.id, query, limit)})
+
+# Sandbox size and quota: read from the running totals (core.quota), no walk over the files
+@login_required
+async def fs_usage_api(request):
+    user = await request.auser()
+    return JsonResponse(await aget_usage(user.id))
+
+# Most recent sandbox snapshots first (taken before agent turns that write files,
+# only with the "cas" storage backend, see core.fs_cas)
+SNAPSHOTS_API_LIMIT = 50
+
+@login_required
+async def fs_snapshots_api(request):
+    user = await request.auser()
+    snapshots = [
+        {
+            "id": snap.id,
+            "label": snap.label,
+            "conversation_id": snap.conversation_id,
+            "created_at": snap.created_at.isoformat(),
+        }
+        async for snap in SandboxSnapshot.objects.filter(owner=user).order_by("-id")[:SNAPSHOTS_API_LIMIT]
+    ]
+    return JsonResponse({"snapshots": snapshots})
+
+# Put the user's files back the way they were at a snapshot (POST param: snapshot)
+# The replaced state becomes a snapshot too (undo_snapshot_id)
+@require_POST
+@login_required
+async def fs_restore_api(request):
+    try:
+        snapshot_id = int(request.POST.get("snapshot") or "")
+    except ValueError:
+        return JsonResponse({"error": "snapshot must be a number"}, status=400)
+
+    user = await request.auser()
+    try:
+        undo = await arestore_snapshot(user.id, snapshot_id)
+    except SandboxSnapshot.DoesNotExist:
+        return JsonResponse({"ok": False, "error": "snapshot not found"}, status=404)
+    except ValueError as exc:
+        return JsonResponse({"ok": False, "error": str(exc)}, status=400)
+    return JsonResponse({"ok": True, "undo_snapshot_id": undo.id})
 
 # Create or overwrite a file inside the user folder
+# mode=append adds the content to the end instead (for uploading in pieces)
 @require_POST
 @login_required
-def fs_write_api(request):
+async def fs_write_api(request):
     path = (request.POST.get("path") or "").strip()
     content = request.POST.get("content") or ""
     if not path:
         return JsonResponse({"error": "missing path"}, status=400)
 
-    write_file(request.user.id, path, content)
+    user = await request.auser()
+    try:
+        if request.POST.get("mode") == "append":
+            size = await aappend_file(user.id, path, content)
+            return JsonResponse({"ok": True, "size": size})
+        await awrite_file(user.id, path, content)
+    except FileTooLarge as exc:
+        return JsonResponse({"ok": False, "error": str(exc)}, status=413)
+    except QuotaExceeded as exc:
+        return JsonResponse({"ok": False, "error": str(exc)}, status=507)
+    except ValueError as exc:
+        return JsonResponse({"ok": False, "error": str(exc)}, status=400)
     return JsonResponse({"ok": True})
 
-# Read a text file from the user folder
+# Default bytes per fs_read_api call (clients page with offset/next_offset)
+READ_API_DEFAULT_BYTES = 256 * 1024
+
+# Read a text file from the user folder, one byte range at a time
+# Optional POST params: offset (default 0), length (bytes)
 @require_POST
 @login_required
-def fs_read_api(request):
+async def fs_read_api(request):
     path = (request.POST.get("path") or "").strip()
     if not path:
         return JsonResponse({"error": "missing path"}, status=400)
 
     try:
-        content = read_file(request.user.id, path)
-        return JsonResponse({"ok": True, "content": content})
-    except FileNotFoundError:
+        offset = int(request.POST.get("offset") or 0)
+        length = int(request.POST.get("length") or READ_API_DEFAULT_BYTES)
+    except ValueError:
+        return JsonResponse({"error": "offset and length must be numbers"}, status=400)
+
+    user = await request.auser()
+    try:
+        chunk = await aread_text_range(user.id, path, offset, length)
+        return JsonResponse({"ok": True, **chunk})
+    except (FileNotFoundError, IsADirectoryError):
         return JsonResponse({"ok": False, "error": "not found"}, status=404)
+    except ValueError as exc:
+        return JsonResponse({"ok": False, "error": str(exc)}, status=400)
+
+# Stream a whole file to the client (no size limit, never loaded in memory)
+@login_required
+async def fs_download_api(request):
+    path = (request.GET.get("path") or "").strip()
+    if not path:
+        return JsonResponse({"error": "missing path"}, status=400)
+
+    user = await request.auser()
+    try:
+        f, size = await aopen_for_download(user.id, path)
+    except (FileNotFoundError, IsADirectoryError):
+        raise Http404("file not found")
+    except ValueError as exc:
+        return JsonResponse({"error": str(exc)}, status=400)
+
+    # Async chunks: a plain file in an async view would be read whole into memory first
+    filename = path.rsplit("/", 1)[-1]
+    content_type = mimetypes.guess_type(filename)[0] or "application/octet-stream"
+    response = StreamingHttpResponse(aiter_file(f), content_type=content_type)
+    response["Content-Length"] = str(size)
+    response["Content-Disposition"] = content_disposition_header(True, filename)
+    return response
+
+# Upload a file (multipart field "file"), written to disk in chunks
+# Optional POST params: path (defaults to the uploaded name), mode=append
+@require_POST
+@login_required
+async def fs_upload_api(request):
+    upload = request.FILES.get("file")
+    if upload is None:
+        return JsonResponse({"error": "missing file"}, status=400)
+    path = (request.POST.get("path") or upload.name or "").strip()
+
+    user = await request.auser()
+    try:
+        size = await awrite_chunks(
+            user.id,
+            path,
+            upload.chunks(),
+            append=request.POST.get("mode") == "append",
+        )
+    except FileTooLarge as exc:
+        return JsonResponse({"ok": False, "error": str(exc)}, status=413)
+    except QuotaExceeded as exc:
+        return JsonResponse({"ok": False, "error": str(exc)}, status=507)
+    except ValueError as exc:
+        return JsonResponse({"ok": False, "error": str(exc)}, status=400)
+    return JsonResponse({"ok": True, "path": path, "size": size})
 
 
 # UI FS for testing 
@@ -128,8 +577,11 @@ def fs_page(request):
             if not path:
                 result = "Missing path"
             else:
-                write_file(request.user.id, path, content)
-                result = f"Wrote: {path}"
+                try:
+                    write_file(request.user.id, path, content)
+                    result = f"Wrote: {path}"
+                except ValueError as exc:
+                    result = f"Error: {exc}"
 
         elif action == "read":
             path = (request.POST.get("path") or "").strip()
@@ -137,9 +589,21 @@ def fs_page(request):
                 result = "Missing path"
             else:
                 try:
-                    result = read_file(request.user.id, path)
-                except FileNotFoundError:
+                    chunk = read_text_range(request.user.id, path, 0, READ_API_DEFAULT_BYTES)
+                    result = chunk["content"]
+                    if chunk["next_offset"] is not None:
+                        result += f"\n\n[... showing the first {chunk['next_offset']} of {chunk['size']} bytes]"
+                except (FileNotFoundError, IsADirectoryError):
                     result = "File not found"
 
     items = list_tree(request.user.id, "")
-    return render(request, "fs.html", {"result": result, "items": items})
\ No newline at end of file
+    return render(request, "fs.html", {"result": result, "items": items})
+
+
+# Prometheus scrape endpoint (counters/histograms from core.metrics)
+# Open to staff users and to the addresses in METRICS_ALLOWED_IPS
+def metrics(request):
+    allowed = request.META.get("REMOTE_ADDR") in settings.METRICS_ALLOWED_IPS
+    if not allowed and not request.user.is_staff:
+        return HttpResponseForbidden("forbidden")
+    return HttpResponse(REGISTRY.render(), content_type="text/plain; version=0.0.4; charset=utf-8")